@@ -1,12 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 from config import Config
 from models import Database, AuthService, Investment, Organism, OrganismRating, InvestmentMessage, OrganismMessage
 from google_sheets_service import google_sheets_service  # ✅ Correcto
-from market_history_model import save_daily_snapshot, get_market_history, get_latest_prices
-from market_scheduler import start_scheduler, manual_snapshot, get_scheduler_status
+from market_history_model import (save_daily_snapshot, get_market_history, get_latest_prices, get_symbol_history,
+                                  get_market_history_page, iter_market_history, get_daily_summaries,
+                                  select_history_resolution)
+from market_scheduler import start_scheduler, manual_snapshot, get_scheduler_status, get_job_status
 from datetime import datetime, date, timedelta
 import threading
 import logging
+import json
+import csv
+import io
+from market_analytics import analyze_symbols
 from portfolio_model_improved import portfolio_manager
 
 app = Flask(__name__)
@@ -99,20 +105,11 @@ def dashboard():
     
     # Obtener datos de mercado (con manejo de errores)
     try:
-        # Por esto:
-        market_summary = google_sheets_service.get_market_data()
-        if market_summary and market_summary.get('data'):
+        snapshot = google_sheets_service.get_price_snapshot()
+        if snapshot:
             # Crear resumen para el dashboard
-            market_count = len(market_summary['data'])
-            prices = []
-            for item in market_summary['data']:
-                try:
-                    price_str = str(item.get('price', '')).replace('$', '').replace(',', '').strip()
-                    if price_str and price_str not in ['#N/A', 'N/A', '']:
-                        prices.append(float(price_str))
-                except (ValueError, TypeError):
-                    continue
-            market_avg = sum(prices) / len(prices) if prices else 0
+            market_count = len(snapshot)
+            market_avg = snapshot.average_price()
         else:
             market_count = 0
             market_avg = 0
@@ -495,15 +492,16 @@ def market_data():
     """Página para mostrar datos de mercado desde Google Sheets"""
     try:
         # Obtener datos del Google Sheet
-        # Por esto:
-        market_data = google_sheets_service.get_market_data()
+        snapshot = google_sheets_service.get_price_snapshot()
         
-        if market_data is None:
+        if snapshot is None:
             flash('Error al obtener datos de Google Sheets', 'warning')
-            market_data = {'data': []}
+            market_data = []
+        else:
+            market_data = snapshot.to_list()
         
         return render_template('market_data.html', 
-                             market_data=market_data.get('data', []),
+                             market_data=market_data,
                              user_email=session.get('user_email'))
     
     except Exception as e:
@@ -517,15 +515,14 @@ def market_data():
 @app.route('/api/market-data')
 def api_market_data():
     try:
-        print("Iniciando api_market_data")
+        logger.debug("Iniciando api_market_data")
         
-        # Obtener datos de Google Sheets
-        data = google_sheets_service.get_market_data()
-        print("Datos obtenidos: %s", type(data))
+        # Obtener datos de Google Sheets (o el último snapshot válido si está caído)
+        snapshot = google_sheets_service.get_price_snapshot()
         
         # Manejar caso de timeout o None
-        if data is None:
-            print("❌ No se pudieron obtener datos (timeout o error)")
+        if snapshot is None:
+            logger.error("❌ No se pudieron obtener datos (timeout o error)")
             return jsonify({
                 'success': False,
                 'error': 'Timeout al obtener datos de Google Sheets. Intentar de nuevo.',
@@ -533,37 +530,19 @@ def api_market_data():
                 'timestamp': datetime.now().isoformat()
             })
         
-        # Manejar diferentes tipos de respuesta
-        if isinstance(data, dict):
-            # Si es un diccionario, extraer la lista de 'data'
-            market_data = data.get('data', [])
-            print("Datos extraídos de diccionario")
-        elif isinstance(data, list):
-            # Si ya es una lista, usarla directamente
-            market_data = data
-            print("Datos ya son una lista")
-        else:
-            print("Tipo de datos inesperado: %s", type(data))
-            return jsonify({
-                'success': False,
-                'error': 'Tipo de datos inesperado: ' + str(type(data)),
-                'data': [],
-                'timestamp': datetime.now().isoformat()
-            })
-        
-        print("Market data final: %s elementos", len(market_data))
+        logger.info("Market data final: %s elementos", len(snapshot))
         
-        # Retornar la respuesta exitosa
-        return jsonify({
+        # Retornar la respuesta exitosa, indicando la antigüedad de los datos
+        response = {
             'success': True,
-            'data': market_data,
+            'data': snapshot.to_list(),
             'timestamp': datetime.now().isoformat()
-        })
+        }
+        response.update(google_sheets_service.describe_snapshot(snapshot))
+        return jsonify(response)
         
     except Exception as e:
-        print("ERROR en api_market_data: %s", str(e))
-        import traceback
-        traceback.print_exc()
+        logger.exception("ERROR en api_market_data: %s", str(e))
         return jsonify({
             'success': False,
             'error': str(e),
@@ -574,13 +553,14 @@ def api_market_data():
 @app.route('/api/market-data/force-update', methods=['POST'])
 def api_force_update():
     try:
-        # Ejecutar manualmente el job del scheduler
-        from market_scheduler import manual_snapshot
-        result = manual_snapshot()
+        # Encolar el job del scheduler (escribe aunque el sheet no haya cambiado)
+        job, created = manual_snapshot(force=True)
         return jsonify({
             'success': True,
-            'message': 'Actualización forzada completada'
-        })
+            'message': 'Actualización forzada encolada' if created else 'Ya hay una actualización en curso',
+            'job_id': job['id'],
+            'job': job
+        }), 202
     except Exception as e:
         return jsonify({
             'success': False,
@@ -592,25 +572,18 @@ def api_force_update():
 def market_history():
     """Página para ver el histórico de datos de mercado"""
     try:
-        # Obtener resumen de los últimos 7 días
-        summaries = []
-        for i in range(7):
-            target_date = date.today() - timedelta(days=i)
-            # Por ahora, creamos un resumen básico
-            # Más adelante puedes implementar get_daily_summary si quieres
-            summary = {
-                'date': target_date.isoformat(),
-                'count': 0,  # Placeholder
-                'avg_price': 0  # Placeholder
-            }
-            summaries.append(summary)
-        
-        # Obtener fecha del último snapshot (usar los datos más recientes)
-        try:
-            historical_data = get_market_history(limit=1)
-            last_snapshot = historical_data[0]['date'] if historical_data else None
-        except:
-            last_snapshot = None
+        # Resúmenes precalculados de los últimos 7 días (una sola consulta)
+        summaries = get_daily_summaries(7)
+        
+        # Fecha del último snapshot
+        if summaries:
+            last_snapshot = summaries[0]['date']
+        else:
+            try:
+                historical_data = get_market_history(limit=1)
+                last_snapshot = historical_data[0]['date'] if historical_data else None
+            except:
+                last_snapshot = None
         
         return render_template('market_history.html',
                              daily_summaries=summaries,
@@ -629,41 +602,160 @@ def market_history():
 @app.route('/api/market-data/save-snapshot', methods=['POST'])
 @require_auth()
 def save_market_snapshot():
-    """Guarda snapshot manual de datos de mercado"""
+    """Encola un snapshot manual de datos de mercado (el progreso se consulta en /api/market-data/jobs/<id>)"""
     try:
-        success = manual_snapshot()
-        if success:
-            return jsonify({
-                'success': True,
-                'message': 'Snapshot guardado exitosamente'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'message': 'Error al guardar snapshot'
-            }), 500
+        job, created = manual_snapshot()
+        return jsonify({
+            'success': True,
+            'message': 'Snapshot encolado' if created else 'Ya hay un snapshot en curso',
+            'job_id': job['id'],
+            'job': job
+        }), 202
     except Exception as e:
         return jsonify({
             'success': False,
             'message': f'Error: {str(e)}'
         }), 500
 
+@app.route('/api/market-data/jobs/<job_id>')
+@require_auth()
+def market_data_job_status(job_id):
+    """Estado, progreso y resultado de un snapshot encolado"""
+    job = get_job_status(job_id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'error': 'Job no encontrado'
+        }), 404
+    return jsonify({
+        'success': True,
+        'job': job
+    })
+
 @app.route('/api/market-data/history')
 @require_auth()
 def get_market_data_history():
-    """Obtiene historial de datos de mercado"""
+    """Obtiene historial de datos de mercado
+    
+    Query params:
+        symbol, start_date, end_date: filtros
+        limit: filas por página (máximo 1000)
+        cursor: cursor devuelto en next_cursor para pedir la página siguiente
+        resolution: daily, weekly, monthly o auto (por defecto, según el rango pedido)
+        format: json (por defecto, paginado), ndjson o csv (exportación completa en streaming)
+    """
     try:
         symbol = request.args.get('symbol')
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
+        export_format = request.args.get('format', 'json')
+        
+        if export_format in ('ndjson', 'csv'):
+            return export_market_history(symbol, start_date, end_date, export_format)
+        
         limit = int(request.args.get('limit', 100))
+        cursor = request.args.get('cursor')
+        resolution = request.args.get('resolution', 'auto')
+        if resolution == 'auto':
+            resolution = select_history_resolution(start_date, end_date)
         
-        history = get_market_history(symbol, start_date, end_date, limit)
+        history, next_cursor = get_market_history_page(symbol, start_date, end_date, limit, cursor, resolution)
         
         return jsonify({
             'success': True,
+            'data': history,
+            'resolution': resolution,
+            'next_cursor': next_cursor
+        })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 500
+
+def export_market_history(symbol, start_date, end_date, export_format):
+    """Exporta el historial completo en streaming (NDJSON o CSV) sin cargarlo en memoria"""
+    columns = ['date', 'symbol', 'price', 'raw_price', 'timestamp', 'source']
+    
+    def generate():
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            for row in iter_market_history(symbol, start_date, end_date):
+                writer.writerow([row.get(column) for column in columns])
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            for row in iter_market_history(symbol, start_date, end_date):
+                yield json.dumps({column: row.get(column) for column in columns}) + '\n'
+    
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f"market_history_{symbol or 'all'}_{date.today().isoformat()}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/api/market-data/history/<symbol>')
+@require_auth()
+def get_symbol_market_history(symbol):
+    """Obtiene el historial de un símbolo (resolución diaria o intradiaria)"""
+    try:
+        days = int(request.args.get('days', 30))
+        resolution = request.args.get('resolution', 'daily')
+        
+        history = get_symbol_history(symbol.upper(), days, resolution)
+        
+        return jsonify({
+            'success': True,
+            'symbol': symbol.upper(),
+            'resolution': resolution,
             'data': history
         })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 500
+
+@app.route('/api/market-data/analytics')
+@require_auth()
+def market_analytics():
+    """Métricas técnicas (retornos, volatilidad, SMA/EMA, drawdown) para uno o varios símbolos"""
+    try:
+        symbols = [s.strip().upper() for s in request.args.get('symbols', '').split(',') if s.strip()]
+        days = int(request.args.get('days', 365))
+        window = int(request.args.get('window', 20))
+        ema_span = int(request.args.get('ema_span', window))
+        include_series = request.args.get('series', '0') == '1'
+        
+        analytics = analyze_symbols(symbols, days, window, ema_span, include_series)
+        
+        return jsonify({
+            'success': True,
+            'days': days,
+            'window': window,
+            'ema_span': ema_span,
+            'data': analytics,
+            'count': len(analytics)
+        })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -686,6 +778,21 @@ def scheduler_status():
             'message': f'Error: {str(e)}'
         }), 500
 
+@app.route('/api/market-data/cache-stats')
+@require_auth()
+def market_data_cache_stats():
+    """Obtiene las métricas del cache de datos de mercado"""
+    try:
+        return jsonify({
+            'success': True,
+            'data': google_sheets_service.get_cache_stats()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 500
+
 from portfolio_model_improved import portfolio_manager
 
 @app.route('/portfolios')
@@ -703,11 +810,13 @@ def all_portfolios():
             portfolios = portfolio_manager.get_portfolios_by_organism(organism['id'])
             for portfolio in portfolios:
                 portfolio['organism_name'] = organism['name']
-                # Agregar estadísticas básicas
-                stats = portfolio_manager.get_portfolio_stats(portfolio['id'])
-                portfolio['stats'] = stats
                 all_portfolios.append(portfolio)
         
+        # Agregar estadísticas básicas (valuaciones de todas las carteras en un solo paso)
+        values = portfolio_manager.get_portfolio_values([portfolio['id'] for portfolio in all_portfolios])
+        for portfolio in all_portfolios:
+            portfolio['stats'] = portfolio_manager.build_portfolio_stats(values.get(portfolio['id']))
+        
         return render_template('all_portfolios.html', 
                              portfolios=all_portfolios,
                              organisms=organisms)
@@ -731,10 +840,10 @@ def portfolios_page(organism_id):
         
         portfolios = portfolio_manager.get_portfolios_by_organism(organism_id)
         
-        # Agregar estadísticas a cada cartera
+        # Agregar estadísticas a cada cartera (valuaciones en un solo paso)
+        values = portfolio_manager.get_portfolio_values([portfolio['id'] for portfolio in portfolios])
         for portfolio in portfolios:
-            stats = portfolio_manager.get_portfolio_stats(portfolio['id'])
-            portfolio['stats'] = stats
+            portfolio['stats'] = portfolio_manager.build_portfolio_stats(values.get(portfolio['id']))
         
         return render_template('portfolios.html', 
                              organism=organism, 
@@ -747,9 +856,6 @@ def portfolios_page(organism_id):
 @app.route('/portfolio/<int:portfolio_id>')
 @require_auth()
 def portfolio_detail(portfolio_id):
-    import traceback
-    import sys
-    
     try:
         # Obtener datos del portfolio
         portfolio = portfolio_manager.get_portfolio_by_id(portfolio_id)
@@ -763,18 +869,9 @@ def portfolio_detail(portfolio_id):
             flash('No tienes permisos para ver este portfolio', 'error')
             return redirect(url_for('portfolios'))
         
-        print("DEBUG: Antes de calculate_portfolio_value")
-        sys.stdout.flush()
-        
-        # Calcular valor del portfolio
-        portfolio_value = portfolio_manager.calculate_portfolio_value(portfolio_id)
-        
-        print("DEBUG: Después de calculate_portfolio_value")
-        print(f"DEBUG: portfolio_value = {portfolio_value}")
-        sys.stdout.flush()
-        
-        print("DEBUG: Antes de render_template")
-        sys.stdout.flush()
+        # Valor del portfolio (última valuación guardada)
+        portfolio_value = portfolio_manager.get_portfolio_value(portfolio_id)
+        logger.debug("portfolio_value de %s: %s", portfolio_id, portfolio_value)
         
         return render_template('portfolio_detail.html', 
                              portfolio=portfolio,
@@ -782,16 +879,8 @@ def portfolio_detail(portfolio_id):
                              portfolio_value=portfolio_value)
         
     except Exception as e:
-        print("================== ERROR COMPLETO ==================")
-        print(f"Error tipo: {type(e)}")
-        print(f"Error mensaje: {str(e)}")
-        print("Stack trace completo:")
-        traceback.print_exc()
-        print("====================================================")
-        sys.stdout.flush()
-        
-        # También capturar en logging sin f-strings
-        logger.error("Error en portfolio_detail: %s", str(e))
+        # Incluye el stack trace completo en el log
+        logger.exception("Error en portfolio_detail: %s", str(e))
         
         flash('Error al cargar los detalles del portfolio', 'error')
         return redirect(url_for('all_portfolios'))
@@ -823,11 +912,11 @@ def api_get_all_portfolios():
                     portfolio['organism_name'] = organism['name']
                     portfolios.append(portfolio)
         
-        # AGREGAR CÁLCULO DE VALOR ACTUAL PARA CADA CARTERA
+        # AGREGAR VALOR ACTUAL (PRECALCULADO EN EL SNAPSHOT) PARA CADA CARTERA, EN UN SOLO PASO
+        values = portfolio_manager.get_portfolio_values([portfolio['id'] for portfolio in portfolios])
         for portfolio in portfolios:
             try:
-                # Calcular valor actual de la cartera
-                portfolio_value = portfolio_manager.calculate_portfolio_value(portfolio['id'])
+                portfolio_value = values.get(portfolio['id'])
                 if portfolio_value:
                     portfolio['current_value'] = portfolio_value.get('total_value', 0)
                     portfolio['positions_count'] = len(portfolio_value.get('positions_detail', []))
@@ -835,9 +924,8 @@ def api_get_all_portfolios():
                     portfolio['current_value'] = 0
                     portfolio['positions_count'] = 0
                 
-                # También agregar las estadísticas básicas
-                stats = portfolio_manager.get_portfolio_stats(portfolio['id'])
-                portfolio['stats'] = stats
+                # Estadísticas básicas a partir de la misma valuación
+                portfolio['stats'] = portfolio_manager.build_portfolio_stats(portfolio_value)
                 
             except Exception as e:
                 logger.error("Error calculando valor para cartera %s: %s", portfolio['id'], str(e))
@@ -911,11 +999,11 @@ def api_get_portfolios(organism_id):
         
         portfolios = portfolio_manager.get_portfolios_by_organism(organism_id)
         
-        # AGREGAR CÁLCULO DE VALOR ACTUAL PARA CADA CARTERA
+        # AGREGAR VALOR ACTUAL (PRECALCULADO EN EL SNAPSHOT) PARA CADA CARTERA, EN UN SOLO PASO
+        values = portfolio_manager.get_portfolio_values([portfolio['id'] for portfolio in portfolios])
         for portfolio in portfolios:
             try:
-                # Calcular valor actual de la cartera
-                portfolio_value = portfolio_manager.calculate_portfolio_value(portfolio['id'])
+                portfolio_value = values.get(portfolio['id'])
                 if portfolio_value:
                     portfolio['current_value'] = portfolio_value.get('total_value', 0)
                     portfolio['positions_count'] = len(portfolio_value.get('positions_detail', []))
@@ -923,9 +1011,8 @@ def api_get_portfolios(organism_id):
                     portfolio['current_value'] = 0
                     portfolio['positions_count'] = 0
                 
-                # También agregar las estadísticas básicas
-                stats = portfolio_manager.get_portfolio_stats(portfolio['id'])
-                portfolio['stats'] = stats
+                # Estadísticas básicas a partir de la misma valuación
+                portfolio['stats'] = portfolio_manager.build_portfolio_stats(portfolio_value)
                 
             except Exception as e:
                 logger.error("Error calculando valor para cartera %s: %s", portfolio['id'], str(e))
@@ -1087,7 +1174,11 @@ def api_portfolio_value(portfolio_id):
         # Obtener fecha específica si se proporciona
         target_date = request.args.get('date')  # Formato: YYYY-MM-DD
         
-        portfolio_value = portfolio_manager.calculate_portfolio_value(portfolio_id, target_date)
+        # Sin fecha se sirve la valuación precalculada; con fecha se calcula al momento
+        if target_date:
+            portfolio_value = portfolio_manager.calculate_portfolio_value(portfolio_id, target_date)
+        else:
+            portfolio_value = portfolio_manager.get_portfolio_value(portfolio_id)
         
         if portfolio_value is not None:
             return jsonify({
@@ -1107,6 +1198,63 @@ def api_portfolio_value(portfolio_id):
             'error': str(e)
         }), 500
 
+@app.route('/api/portfolio/<int:portfolio_id>/value-series', methods=['GET'])
+@require_auth()
+def api_portfolio_value_series(portfolio_id):
+    """API para obtener la curva de valor de la cartera
+    
+    Query params:
+        start_date: Fecha de inicio (YYYY-MM-DD), por defecto 30 días atrás
+        end_date: Fecha de fin (YYYY-MM-DD), por defecto hoy
+        freq: daily (por defecto), weekly o monthly
+    """
+    try:
+        user_uuid = session.get('user_uuid')
+        
+        # Verificar permisos
+        portfolio = portfolio_manager.get_portfolio_by_id(portfolio_id)
+        if not portfolio:
+            return jsonify({
+                'success': False,
+                'error': 'Cartera no encontrada'
+            }), 404
+        
+        organism = organism_model.get_organism_by_id(portfolio['organism_id'], user_uuid)
+        if not organism:
+            return jsonify({
+                'success': False,
+                'error': 'No tienes acceso a esta cartera'
+            }), 403
+        
+        start_date = request.args.get('start_date') or (date.today() - timedelta(days=30)).isoformat()
+        end_date = request.args.get('end_date')
+        freq = request.args.get('freq', 'daily')
+        
+        series = portfolio_manager.value_series(portfolio_id, start_date, end_date, freq)
+        
+        if series is not None:
+            return jsonify({
+                'success': True,
+                'value_series': series
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'error': 'Error calculando curva de valor de cartera'
+            }), 500
+            
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        logger.error("Error en api_portfolio_value_series: %s", str(e))
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 # ================== RUTAS DE POSICIONES ==================
 
 @app.route('/api/portfolio/<int:portfolio_id>/positions', methods=['GET'])
@@ -0,0 +1,134 @@
+"""
+Benchmark de la analítica técnica vectorizada
+
+Genera un historial sintético (por defecto 1.000 símbolos x 5 años hábiles),
+lo carga en la matriz de precios y calcula todas las métricas de
+market_analytics. Como referencia, calcula las mismas métricas símbolo por
+símbolo en Python puro (como se haría recorriendo las filas de
+get_symbol_history) y verifica que los resultados coincidan.
+
+Uso:
+    python benchmarks/bench_market_analytics.py [símbolos] [días]
+"""
+import math
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from market_analytics import build_price_matrix, compute_analytics, TRADING_DAYS_PER_YEAR
+
+WINDOW = 20
+
+def build_synthetic_rows(symbols, days):
+    """Filas tipo market_data_history con caminatas aleatorias y algunos huecos"""
+    rng = np.random.default_rng(42)
+    start = date(2020, 1, 1)
+    dates = [(start + timedelta(days=i)).isoformat() for i in range(days)]
+    returns = rng.normal(0.0003, 0.02, size=(days, symbols))
+    prices = 100 * np.cumprod(1 + returns, axis=0)
+    missing = rng.random((days, symbols)) < 0.01
+    
+    rows = []
+    for j in range(symbols):
+        symbol = f"SYM{j:04d}"
+        for i, day in enumerate(dates):
+            if not missing[i, j]:
+                rows.append({'symbol': symbol, 'date': day, 'price': float(prices[i, j])})
+    return rows
+
+def reference_metrics(series):
+    """Métricas de un símbolo en Python puro (serie ya ordenada y completa)"""
+    returns = [None] + [series[i] / series[i - 1] - 1 for i in range(1, len(series))]
+    
+    sma = sum(series[-WINDOW:]) / WINDOW
+    
+    alpha = 2.0 / (WINDOW + 1)
+    ema = series[0]
+    for price in series[1:]:
+        ema = ema + alpha * (price - ema)
+    
+    window_returns = returns[-WINDOW:]
+    mean = sum(window_returns) / WINDOW
+    variance = sum((r - mean) ** 2 for r in window_returns) / (WINDOW - 1)
+    volatility = math.sqrt(variance * TRADING_DAYS_PER_YEAR)
+    
+    peak = series[0]
+    max_drawdown = 0.0
+    for price in series:
+        peak = max(peak, price)
+        max_drawdown = min(max_drawdown, price / peak - 1)
+    
+    return {
+        'last_price': series[-1],
+        'min_price': min(series),
+        'max_price': max(series),
+        'sma': sma,
+        'ema': ema,
+        'volatility': volatility,
+        'max_drawdown': max_drawdown
+    }
+
+def reference_series(rows):
+    """Camino de referencia: agrupar filas por símbolo en listas ordenadas (forward fill)"""
+    by_symbol = {}
+    for row in rows:
+        by_symbol.setdefault(row['symbol'], {})[row['date']] = row['price']
+    
+    all_dates = sorted({row['date'] for row in rows})
+    series_by_symbol = {}
+    for symbol, prices_by_date in by_symbol.items():
+        series = []
+        last = None
+        for day in all_dates:
+            last = prices_by_date.get(day, last)
+            if last is not None:
+                series.append(last)
+        series_by_symbol[symbol] = series
+    return series_by_symbol
+
+def timed(func, *args, repeat=3):
+    """Resultado y mejor tiempo de varias repeticiones"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main():
+    symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 5 * TRADING_DAYS_PER_YEAR
+    
+    rows = build_synthetic_rows(symbols, days)
+    print(f"Historial sintético: {symbols} símbolos x {days} días = {len(rows)} filas")
+    
+    (dates, columns, prices), numpy_load = timed(build_price_matrix, rows)
+    results, numpy_compute = timed(compute_analytics, dates, columns, prices, WINDOW, WINDOW)
+    
+    series_by_symbol, python_load = timed(reference_series, rows)
+    reference, python_compute = timed(
+        lambda: {symbol: reference_metrics(series) for symbol, series in series_by_symbol.items()})
+    
+    print(f"{'':<14} {'carga':>10} {'métricas':>10} {'total':>10}")
+    print(f"{'NumPy':<14} {numpy_load * 1000:8.1f}ms {numpy_compute * 1000:8.1f}ms "
+          f"{(numpy_load + numpy_compute) * 1000:8.1f}ms")
+    print(f"{'Python puro':<14} {python_load * 1000:8.1f}ms {python_compute * 1000:8.1f}ms "
+          f"{(python_load + python_compute) * 1000:8.1f}ms")
+    print(f"Aceleración: métricas {python_compute / numpy_compute:.1f}x, "
+          f"total {(python_load + python_compute) / (numpy_load + numpy_compute):.1f}x")
+    
+    for item in results:
+        expected = reference[item['symbol']]
+        for key, value in expected.items():
+            assert math.isclose(item[key], value, rel_tol=1e-5, abs_tol=1e-5), \
+                f"{item['symbol']} {key}: {item[key]} != {value}"
+    print("Resultados verificados contra la referencia")
+
+if __name__ == '__main__':
+    main()
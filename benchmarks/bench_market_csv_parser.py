@@ -0,0 +1,104 @@
+"""
+Benchmark del parseo del CSV de mercado
+
+Compara el camino anterior (csv.DictReader + dict limpio por fila + búsqueda
+de columnas en cada fila) con iter_market_records, que resuelve las columnas
+una sola vez desde la cabecera y no construye diccionarios intermedios.
+
+Uso:
+    python benchmarks/bench_market_csv_parser.py [filas] [repeticiones]
+"""
+import csv
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google_sheets_service import iter_market_records
+
+def build_synthetic_sheet(rows):
+    """Genera un CSV parecido al sheet publicado (con columnas extra y valores inválidos)"""
+    random.seed(42)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(['Symbol', 'Price', 'Change', 'Volume', 'Updated'])
+    for i in range(rows):
+        if i % 97 == 0:
+            price = '#N/A'
+        else:
+            price = f"${random.uniform(1, 50000):,.2f}"
+        writer.writerow([f"SYM{i:05d}", price, f"{random.uniform(-5, 5):.2f}%",
+                         str(random.randint(0, 10**7)), '2024-01-01 10:00:00'])
+    return buffer.getvalue()
+
+def legacy_parse(csv_text):
+    """Replica del camino anterior: get_sheet_data + get_market_data"""
+    reader = csv.DictReader(io.StringIO(csv_text))
+    raw_data = []
+    for row in reader:
+        cleaned_row = {k.strip(): v.strip() for k, v in row.items() if k and v}
+        if cleaned_row:
+            raw_data.append(cleaned_row)
+    
+    market_data = []
+    for row in raw_data:
+        symbol = None
+        price = None
+        for key in row.keys():
+            if key.lower() in ['symbol', 'simbolo', 'ticker']:
+                symbol = row[key]
+                break
+        for key in row.keys():
+            if key.lower() in ['price', 'precio', 'valor', 'cotizacion']:
+                try:
+                    price_str = row[key].replace(',', '').replace('$', '').strip()
+                    price = float(price_str) if price_str else None
+                except (ValueError, AttributeError):
+                    price = row[key]
+                break
+        if symbol and price is not None:
+            market_data.append({'symbol': symbol, 'price': price, 'raw_data': row})
+    return market_data
+
+def streaming_parse(csv_text):
+    """Camino nuevo: líneas en streaming (como iter_lines) -> registros"""
+    lines = iter(csv_text.splitlines())
+    return [{'symbol': symbol, 'price': price} for symbol, price in iter_market_records(lines)]
+
+def measure(label, func, csv_text, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(csv_text)
+        timings.append(time.perf_counter() - start)
+    
+    tracemalloc.start()
+    func(csv_text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    best = min(timings)
+    print(f"{label:<12} {best * 1000:9.1f} ms   {len(result):>7} símbolos   pico {peak / 1024 / 1024:7.1f} MiB")
+    return best, result
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    
+    csv_text = build_synthetic_sheet(rows)
+    print(f"Sheet sintético: {rows} filas, {len(csv_text) / 1024 / 1024:.1f} MiB, mejor de {repeat}")
+    
+    legacy_time, legacy_result = measure('anterior', legacy_parse, csv_text, repeat)
+    streaming_time, streaming_result = measure('streaming', streaming_parse, csv_text, repeat)
+    
+    assert [(r['symbol'], r['price']) for r in legacy_result] == \
+           [(r['symbol'], r['price']) for r in streaming_result], "Los resultados no coinciden"
+    
+    print(f"Aceleración: {legacy_time / streaming_time:.2f}x")
+
+if __name__ == '__main__':
+    main()
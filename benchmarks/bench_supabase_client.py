@@ -0,0 +1,50 @@
+"""
+Micro-benchmark: costo de crear un cliente de Supabase por llamada
+frente a reutilizar el cliente del registro compartido
+
+No realiza consultas: mide solo la preparación del cliente (create_client
+construye los clientes de auth, postgrest, storage y functions y su sesión
+HTTP), que antes se pagaba en cada get_market_history / get_latest_prices /
+get_symbol_history / save_daily_snapshot.
+
+Uso:
+    python benchmarks/bench_supabase_client.py [iteraciones]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Valores de ejemplo si no hay .env: create_client no se conecta al construirse
+os.environ.setdefault('SUPABASE_URL', 'https://example.supabase.co')
+os.environ.setdefault('SUPABASE_KEY', 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark')
+
+from supabase import create_client
+from config import Config
+from supabase_client import get_supabase_client
+
+def bench(label, func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / iterations * 1e6:12.1f} µs/llamada")
+    return elapsed
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    
+    per_call = bench('create_client por llamada',
+                     lambda: create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY).table('market_data_history'),
+                     iterations)
+    
+    get_supabase_client()  # crear el cliente compartido antes de medir
+    registry = bench('registro compartido',
+                     lambda: get_supabase_client().table('market_data_history'),
+                     iterations)
+    
+    print(f"Costo de preparación evitado: {per_call / registry:.0f}x")
+
+if __name__ == '__main__':
+    main()
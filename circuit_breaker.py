@@ -0,0 +1,90 @@
+"""
+Circuit breaker simple para llamadas a servicios externos
+"""
+import time
+import threading
+import logging
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    Corta las llamadas a un servicio externo después de fallos repetidos
+    
+    - closed: las llamadas pasan normalmente
+    - open: las llamadas se rechazan hasta que pase reset_timeout
+    - half_open: se deja pasar una sola llamada de prueba; si funciona se
+      cierra el circuito, si falla se vuelve a abrir
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+    
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_progress = False
+        return self._state
+    
+    def allow_request(self) -> bool:
+        """Indica si se puede llamar al servicio externo"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+    
+    def record_success(self):
+        """Registra una llamada exitosa y cierra el circuito"""
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("✅ Circuito %s cerrado nuevamente", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+    
+    def record_failure(self):
+        """Registra un fallo y abre el circuito si se supera el umbral"""
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning("⚠️ Circuito %s abierto tras %s fallos", self.name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_progress = False
+    
+    def get_status(self) -> Dict:
+        """Estado actual del circuito"""
+        with self._lock:
+            state = self._current_state()
+            retry_in = None
+            if state == self.OPEN:
+                retry_in = round(max(0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+            return {
+                'name': self.name,
+                'state': state,
+                'consecutive_failures': self._failures,
+                'retry_in_seconds': retry_in
+            }
@@ -0,0 +1,36 @@
+"""
+Utilidades para archivos locales
+"""
+import os
+import json
+import tempfile
+from typing import Any
+
+def atomic_write_json(path: str, data: Any):
+    """
+    Escribe JSON de forma atómica: primero en un archivo temporal del mismo
+    directorio y luego lo reemplaza con os.replace, de modo que un lector
+    nunca vea un archivo a medio escribir
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+            json.dump(data, tmp_file, ensure_ascii=False)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_json(path: str, default: Any = None) -> Any:
+    """Lee un archivo JSON; devuelve default si no existe o está corrupto"""
+    try:
+        with open(path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
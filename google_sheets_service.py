@@ -2,17 +2,185 @@
 Servicio para obtener datos de Google Sheets públicos
 """
 import requests
+from requests.adapters import HTTPAdapter
 import csv
-import io
+import os
+import time
+import threading
 import logging
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple, Union
+from config import Config
+from price_snapshot import PriceSnapshot
+from circuit_breaker import CircuitBreaker
+from file_utils import atomic_write_json, read_json
 
 logger = logging.getLogger(__name__)
 
+# Tiempo (segundos) durante el cual los datos de mercado se consideran frescos
+MARKET_DATA_CACHE_TTL = float(os.environ.get('MARKET_DATA_CACHE_TTL', '60'))
+
+# Tamaño del pool de conexiones keep-alive hacia Google Sheets
+SHEETS_HTTP_POOL_SIZE = int(os.environ.get('SHEETS_HTTP_POOL_SIZE', '10'))
+
+# Circuit breaker: fallos consecutivos antes de abrir y segundos hasta reintentar
+SHEETS_FAILURE_THRESHOLD = int(os.environ.get('SHEETS_FAILURE_THRESHOLD', '3'))
+SHEETS_CIRCUIT_RESET_SECONDS = float(os.environ.get('SHEETS_CIRCUIT_RESET_SECONDS', '60'))
+
+# Sheets de mercado: "nombre:sheet_id" separados por coma, en orden de precedencia
+# (si un símbolo aparece en varios sheets gana el primero de la lista)
+DEFAULT_MARKET_SHEET_ID = "2PACX-1vRYSd8G18V945mwYirKuzuTf8hQf3SySFDVL0D5dpWu1MWgCwH1oTwii0O57N2tl7vIZZT6zDGGc1wj"
+MARKET_DATA_SHEETS = os.environ.get('MARKET_DATA_SHEETS', f'mercado:{DEFAULT_MARKET_SHEET_ID}')
+
+# Máximo de sheets descargados en paralelo
+SHEETS_MAX_WORKERS = int(os.environ.get('SHEETS_MAX_WORKERS', '4'))
+
+# Último snapshot válido persistido en disco (last-known-good)
+LAST_KNOWN_GOOD_FILE = os.path.join(Config.DATA_DIR, 'last_market_snapshot.json')
+
+# Nombres de columna aceptados (se comparan en minúsculas)
+SYMBOL_COLUMNS = ('symbol', 'simbolo', 'ticker')
+PRICE_COLUMNS = ('price', 'precio', 'valor', 'cotizacion')
+
+def parse_market_sources(spec: str) -> List[Dict]:
+    """
+    Parsea la configuración de sheets de mercado
+    
+    Args:
+        spec: "bonos:ID1,acciones:ID2,fx:ID3" (el nombre es opcional)
+        
+    Returns:
+        Lista de {'name', 'sheet_id'} en orden de precedencia
+    """
+    sources = []
+    for i, item in enumerate(part.strip() for part in spec.split(',')):
+        if not item:
+            continue
+        name, _, sheet_id = item.rpartition(':')
+        sources.append({
+            'name': name.strip() or f'sheet{i + 1}',
+            'sheet_id': sheet_id.strip()
+        })
+    return sources
+
+def resolve_market_columns(header: List[str]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """
+    Resuelve una sola vez, a partir de la cabecera, qué columnas contienen
+    el símbolo y el precio
+    
+    Args:
+        header: Primera fila del CSV
+        
+    Returns:
+        Tupla (índices de symbol, índices de price) en orden de aparición
+    """
+    normalized = [column.lstrip('\ufeff').strip().lower() for column in header]
+    symbol_indexes = tuple(i for i, column in enumerate(normalized) if column in SYMBOL_COLUMNS)
+    price_indexes = tuple(i for i, column in enumerate(normalized) if column in PRICE_COLUMNS)
+    return symbol_indexes, price_indexes
+
+def parse_price(raw_price: str) -> Union[float, str, None]:
+    """Convierte un precio del sheet a float; si no es numérico devuelve el texto original"""
+    price_str = raw_price.replace(',', '').replace('$', '').strip()
+    if not price_str:
+        return None
+    try:
+        return float(price_str)
+    except ValueError:
+        return raw_price
+
+def iter_market_records(lines: Iterable[str]) -> Iterator[Tuple[str, Union[float, str]]]:
+    """
+    Parsea en streaming un CSV de mercado y genera tuplas (symbol, price)
+    
+    Las columnas se resuelven una única vez desde la cabecera; para cada fila
+    se toma el primer valor no vacío entre las columnas candidatas.
+    
+    Args:
+        lines: Líneas del CSV (por ejemplo response.iter_lines(decode_unicode=True))
+    """
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if not header:
+        return
+    
+    symbol_indexes, price_indexes = resolve_market_columns(header)
+    if not symbol_indexes or not price_indexes:
+        logger.warning("⚠️ No se encontraron columnas de símbolo/precio en la cabecera: %s", header)
+        return
+    
+    for row in reader:
+        row_length = len(row)
+        
+        symbol = None
+        for index in symbol_indexes:
+            if index < row_length:
+                value = row[index].strip()
+                if value:
+                    symbol = value
+                    break
+        if not symbol:
+            continue
+        
+        price = None
+        for index in price_indexes:
+            if index < row_length:
+                value = row[index].strip()
+                if value:
+                    price = parse_price(value)
+                    break
+        
+        if price is not None:
+            yield symbol, price
+
 class GoogleSheetsService:
-    def __init__(self):
+    def __init__(self, cache_ttl: Optional[float] = None, last_known_good_path: str = LAST_KNOWN_GOOD_FILE,
+                 sources: Optional[List[Dict]] = None):
         # URL base para acceder a Google Sheets como CSV
         self.base_url = "https://docs.google.com/spreadsheets/d/e/{sheet_id}/pub?output=csv"
+        
+        # Sheets de mercado en orden de precedencia, descargados en paralelo
+        self.sources = sources if sources is not None else parse_market_sources(MARKET_DATA_SHEETS)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, min(SHEETS_MAX_WORKERS, len(self.sources))),
+                                            thread_name_prefix='sheets')
+        self._source_snapshots = {}
+        self._merged_from = None
+        self._merged_snapshot = None
+        
+        # Sesión HTTP persistente: reutiliza conexiones TLS entre descargas
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=SHEETS_HTTP_POOL_SIZE,
+                              pool_maxsize=SHEETS_HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        # Validadores HTTP (ETag / Last-Modified) y datos ya parseados por URL
+        self._conditional_lock = threading.Lock()
+        self._conditional_cache = {}
+        
+        # Cache en memoria del snapshot de precios (stale-while-revalidate)
+        self.cache_ttl = MARKET_DATA_CACHE_TTL if cache_ttl is None else cache_ttl
+        self._cache_lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._cached_snapshot = None
+        self._cached_at = None
+        self._refreshing = False
+        self._cache_stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'circuit_rejections': 0,
+            'disk_loads': 0
+        }
+        
+        # Protección ante caídas de Google Sheets
+        self.circuit_breaker = CircuitBreaker('google_sheets',
+                                              failure_threshold=SHEETS_FAILURE_THRESHOLD,
+                                              reset_timeout=SHEETS_CIRCUIT_RESET_SECONDS)
+        self.last_known_good_path = last_known_good_path
     
     def get_sheet_data(self, sheet_id: str) -> Optional[List[Dict]]:
         """
@@ -28,20 +196,23 @@ class GoogleSheetsService:
             url = self.base_url.format(sheet_id=sheet_id)
             logger.info("Obteniendo datos de Google Sheet: %s", url)
             
-            # Realizar petición HTTP
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
+            response, cached = self._conditional_get(url, 'rows')
+            if response is None:
+                logger.info("✅ Google Sheet sin cambios (304), reutilizando %s filas", len(cached['data']))
+                return cached['data']
             
-            # Parsear CSV
-            csv_data = response.text
-            reader = csv.DictReader(io.StringIO(csv_data))
+            with response:
+                # Parsear CSV en streaming
+                reader = csv.DictReader(response.iter_lines(decode_unicode=True))
+                
+                data = []
+                for row in reader:
+                    # Limpiar los datos (remover espacios en blanco)
+                    cleaned_row = {k.strip(): v.strip() for k, v in row.items() if k and v}
+                    if cleaned_row:  # Solo agregar filas no vacías
+                        data.append(cleaned_row)
             
-            data = []
-            for row in reader:
-                # Limpiar los datos (remover espacios en blanco)
-                cleaned_row = {k.strip(): v.strip() for k, v in row.items() if k and v}
-                if cleaned_row:  # Solo agregar filas no vacías
-                    data.append(cleaned_row)
+            self._remember_validators(url, 'rows', response, data)
             
             logger.info("✅ Datos obtenidos exitosamente: %s filas", len(data))
             return data
@@ -53,56 +224,314 @@ class GoogleSheetsService:
             logger.error("❌ Error procesando datos de Google Sheets: %s", str(e))
             return None
     
-    def get_market_data(self) -> Optional[List[Dict]]:
+    def _conditional_get(self, url: str, kind: str):
         """
-        Obtiene datos específicos del Google Sheet de mercado
+        Realiza un GET condicional en streaming usando los validadores guardados
         
+        Args:
+            url: URL del CSV publicado
+            kind: Tipo de dato parseado que se guarda para esa URL
+            
         Returns:
-            Lista con datos de symbol y price
+            Tupla (response, cached). response es None si el servidor respondió 304
         """
-        # ID extraído de tu URL
-        sheet_id = "2PACX-1vRYSd8G18V945mwYirKuzuTf8hQf3SySFDVL0D5dpWu1MWgCwH1oTwii0O57N2tl7vIZZT6zDGGc1wj"
+        with self._conditional_lock:
+            cached = self._conditional_cache.get((url, kind))
         
-        raw_data = self.get_sheet_data(sheet_id)
-        if not raw_data:
-            return None
+        # Petición condicional: si el CSV no cambió, Google responde 304 sin cuerpo
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        
+        response = self.session.get(url, headers=headers, timeout=10, stream=True)
+        
+        if response.status_code == 304 and cached:
+            response.close()
+            return None, cached
         
         try:
-            market_data = []
-            for row in raw_data:
-                # Buscar las columnas symbol y price (pueden tener variaciones de nombre)
-                symbol = None
-                price = None
-                
-                # Buscar columna symbol (case insensitive)
-                for key in row.keys():
-                    if key.lower() in ['symbol', 'simbolo', 'ticker']:
-                        symbol = row[key]
-                        break
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            response.close()
+            raise
+        
+        # Google publica el CSV en UTF-8 aunque no siempre lo declara
+        response.encoding = 'utf-8'
+        return response, cached
+    
+    def _remember_validators(self, url: str, kind: str, response, data):
+        """Guarda ETag / Last-Modified junto con los datos ya parseados"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self._conditional_lock:
+                self._conditional_cache[(url, kind)] = {
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'data': data
+                }
+    
+    def get_price_snapshot(self, force_refresh: bool = False) -> Optional[PriceSnapshot]:
+        """
+        Obtiene el snapshot de precios usando un cache en memoria con TTL
+        
+        Si los datos están frescos se devuelven directamente. Si están vencidos
+        se devuelven igualmente (stale) y se lanza una única actualización en
+        segundo plano. Solo se bloquea cuando todavía no hay datos en cache.
+        
+        Args:
+            force_refresh: Ignorar el cache y descargar los datos ahora
+            
+        Returns:
+            PriceSnapshot con symbol y price o None si hay error
+        """
+        if not force_refresh:
+            with self._cache_lock:
+                if self._cached_snapshot is not None:
+                    age = time.monotonic() - self._cached_at
+                    if age < self.cache_ttl:
+                        self._cache_stats['hits'] += 1
+                        return self._cached_snapshot
+                    
+                    self._cache_stats['stale_hits'] += 1
+                    if not self._refreshing:
+                        self._refreshing = True
+                        threading.Thread(target=self._background_refresh, daemon=True).start()
+                    return self._cached_snapshot
                 
-                # Buscar columna price (case insensitive)
-                for key in row.keys():
-                    if key.lower() in ['price', 'precio', 'valor', 'cotizacion']:
-                        try:
-                            # Intentar convertir a float
-                            price_str = row[key].replace(',', '').replace('$', '').strip()
-                            price = float(price_str) if price_str else None
-                        except (ValueError, AttributeError):
-                            price = row[key]
-                        break
+                self._cache_stats['misses'] += 1
+        
+        # Sin datos en cache: solo un hilo descarga, el resto espera su resultado
+        with self._fetch_lock:
+            if not force_refresh:
+                with self._cache_lock:
+                    if self._cached_snapshot is not None:
+                        return self._cached_snapshot
                 
-                if symbol and price is not None:
-                    market_data.append({
-                        'symbol': symbol,
-                        'price': price,
-                        'raw_data': row  # Mantener datos originales por si acaso
-                    })
+                # Arranque en frío: servir el último snapshot guardado mientras se actualiza
+                last_known_good = self._load_last_known_good()
+                if last_known_good is not None:
+                    with self._cache_lock:
+                        self._cached_snapshot = last_known_good
+                        self._cached_at = time.monotonic() - self.cache_ttl
+                        if not self._refreshing:
+                            self._refreshing = True
+                            threading.Thread(target=self._background_refresh, daemon=True).start()
+                    return last_known_good
             
-            logger.info("✅ Datos de mercado procesados: %s símbolos", len(market_data))
-            return market_data
+            return self._refresh_cache()
+    
+    def get_market_data(self, force_refresh: bool = False) -> Optional[List[Dict]]:
+        """
+        Obtiene datos de mercado como lista de diccionarios (vista JSON del snapshot)
+        
+        Args:
+            force_refresh: Ignorar el cache y descargar los datos ahora
             
+        Returns:
+            Lista con datos de symbol y price
+        """
+        snapshot = self.get_price_snapshot(force_refresh)
+        return snapshot.to_list() if snapshot is not None else None
+    
+    def _refresh_cache(self) -> Optional[PriceSnapshot]:
+        """
+        Descarga los datos de mercado y actualiza el cache si tuvo éxito
+        
+        Si el circuito está abierto o la descarga falla, devuelve el último
+        snapshot válido (en memoria o en disco) sin esperar al upstream.
+        """
+        if not self.circuit_breaker.allow_request():
+            with self._cache_lock:
+                self._cache_stats['circuit_rejections'] += 1
+            return self._get_last_known_good()
+        
+        snapshot = self._fetch_price_snapshot()
+        
+        if snapshot is None:
+            self.circuit_breaker.record_failure()
+            with self._cache_lock:
+                self._cache_stats['refresh_errors'] += 1
+            return self._get_last_known_good()
+        
+        self.circuit_breaker.record_success()
+        with self._cache_lock:
+            changed = snapshot is not self._cached_snapshot
+            self._cached_snapshot = snapshot
+            self._cached_at = time.monotonic()
+            self._cache_stats['refreshes'] += 1
+        
+        if changed:
+            self._save_last_known_good(snapshot)
+        
+        return snapshot
+    
+    def _get_last_known_good(self) -> Optional[PriceSnapshot]:
+        """Último snapshot válido: primero el de memoria, si no el persistido en disco"""
+        with self._cache_lock:
+            if self._cached_snapshot is not None:
+                return self._cached_snapshot
+        
+        snapshot = self._load_last_known_good()
+        if snapshot is not None:
+            with self._cache_lock:
+                if self._cached_snapshot is None:
+                    self._cached_snapshot = snapshot
+                    self._cached_at = time.monotonic() - self.cache_ttl
+        return snapshot
+    
+    def _load_last_known_good(self) -> Optional[PriceSnapshot]:
+        """Carga el último snapshot válido guardado en disco"""
+        data = read_json(self.last_known_good_path)
+        if not data:
+            return None
+        
+        try:
+            snapshot = PriceSnapshot.from_dict(data)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("❌ Snapshot en disco inválido (%s): %s", self.last_known_good_path, str(e))
+            return None
+        
+        with self._cache_lock:
+            self._cache_stats['disk_loads'] += 1
+        logger.info("📂 Snapshot last-known-good cargado: %s símbolos del %s", len(snapshot), snapshot.fetched_at)
+        return snapshot if len(snapshot) else None
+    
+    def _save_last_known_good(self, snapshot: PriceSnapshot):
+        """Persiste el snapshot de forma atómica para sobrevivir a reinicios y caídas"""
+        try:
+            atomic_write_json(self.last_known_good_path, snapshot.to_dict())
+        except OSError as e:
+            logger.error("❌ No se pudo guardar el snapshot last-known-good: %s", str(e))
+    
+    def _background_refresh(self):
+        """Actualiza el cache en segundo plano (stale-while-revalidate)"""
+        try:
+            with self._fetch_lock:
+                self._refresh_cache()
+        except Exception as e:
+            logger.error("❌ Error actualizando cache de mercado: %s", str(e))
+        finally:
+            with self._cache_lock:
+                self._refreshing = False
+    
+    def get_cache_stats(self) -> Dict:
+        """Devuelve métricas del cache de datos de mercado"""
+        with self._cache_lock:
+            stats = dict(self._cache_stats)
+            stats['ttl_seconds'] = self.cache_ttl
+            stats['age_seconds'] = (round(time.monotonic() - self._cached_at, 3)
+                                    if self._cached_at is not None else None)
+            stats['refreshing'] = self._refreshing
+            stats['cached_symbols'] = len(self._cached_snapshot) if self._cached_snapshot is not None else 0
+        stats['circuit'] = self.circuit_breaker.get_status()
+        return stats
+    
+    def describe_snapshot(self, snapshot: PriceSnapshot) -> Dict:
+        """Metadatos de frescura de un snapshot para incluir en las respuestas"""
+        age = snapshot.age_seconds()
+        return {
+            'as_of': snapshot.fetched_at.isoformat(),
+            'age_seconds': round(age, 1),
+            'stale': age > self.cache_ttl,
+            'circuit_state': self.circuit_breaker.state
+        }
+    
+    def invalidate_cache(self):
+        """Descarta los datos en cache para forzar una nueva descarga"""
+        with self._cache_lock:
+            self._cached_snapshot = None
+            self._cached_at = None
+    
+    def _fetch_price_snapshot(self) -> Optional[PriceSnapshot]:
+        """
+        Descarga todos los sheets de mercado en paralelo y los une en un snapshot
+        
+        La latencia total es la del sheet más lento. Si un sheet falla se usa
+        su último snapshot conocido; solo se devuelve None si no hay ningún dato.
+        
+        Returns:
+            PriceSnapshot con symbol y price
+        """
+        if len(self.sources) == 1:
+            results = [self._fetch_source_snapshot(self.sources[0])]
+        else:
+            futures = [self._executor.submit(self._fetch_source_snapshot, source) for source in self.sources]
+            results = [future.result() for future in futures]
+        
+        snapshots = []
+        for source, snapshot in zip(self.sources, results):
+            if snapshot is None:
+                snapshot = self._source_snapshots.get(source['name'])
+                if snapshot is not None:
+                    logger.warning("⚠️ Sheet %s no disponible, usando su último snapshot", source['name'])
+            else:
+                self._source_snapshots[source['name']] = snapshot
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        
+        if not any(result is not None for result in results):
+            return None
+        
+        if len(snapshots) == 1:
+            return snapshots[0]
+        
+        # Si ningún sheet cambió (304) se reutiliza el snapshot unido anterior
+        merged_from = tuple(id(snapshot) for snapshot in snapshots)
+        if merged_from == self._merged_from and self._merged_snapshot is not None:
+            self._merged_snapshot.fetched_at = min(snapshot.fetched_at for snapshot in snapshots)
+            return self._merged_snapshot
+        
+        merged = PriceSnapshot.merge(snapshots)
+        self._merged_from = merged_from
+        self._merged_snapshot = merged
+        
+        logger.info("✅ Datos de mercado unidos: %s símbolos de %s sheets", len(merged), len(snapshots))
+        return merged
+    
+    def _fetch_source_snapshot(self, source: Dict) -> Optional[PriceSnapshot]:
+        """
+        Obtiene el snapshot de un sheet de mercado
+        
+        Args:
+            source: {'name', 'sheet_id'}
+            
+        Returns:
+            PriceSnapshot con symbol y price
+        """
+        try:
+            url = self.base_url.format(sheet_id=source['sheet_id'])
+            logger.info("Obteniendo datos de mercado (%s): %s", source['name'], url)
+            
+            response, cached = self._conditional_get(url, 'market')
+            if response is None:
+                # Respuesta 304: el snapshot ya procesado sigue vigente
+                logger.info("✅ Datos de %s sin cambios (304): %s símbolos", source['name'], len(cached['data']))
+                cached['data'].fetched_at = datetime.now()
+                return cached['data']
+            
+            with response:
+                snapshot = PriceSnapshot.from_records(
+                    iter_market_records(response.iter_lines(decode_unicode=True)),
+                    source=source['name']
+                )
+            
+            if not len(snapshot):
+                return None
+            
+            self._remember_validators(url, 'market', response, snapshot)
+            
+            logger.info("✅ Datos de %s procesados: %s símbolos", source['name'], len(snapshot))
+            return snapshot
+            
+        except requests.exceptions.RequestException as e:
+            logger.error("❌ Error al obtener datos de Google Sheets (%s): %s", source['name'], str(e))
+            return None
         except Exception as e:
-            logger.error("❌ Error procesando datos de mercado: %s", str(e))
+            logger.error("❌ Error procesando datos de mercado (%s): %s", source['name'], str(e))
             return None
 
 # Instancia global del servicio
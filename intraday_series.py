@@ -0,0 +1,178 @@
+"""
+Codificación compacta de snapshots intradiarios de precios
+
+Cada día empieza con un keyframe (todos los símbolos) y los snapshots
+siguientes solo guardan las diferencias respecto del anterior: símbolos cuyo
+precio cambió (como delta entero), símbolos nuevos y símbolos eliminados.
+Los precios se guardan como enteros escalados para que las deltas sean
+exactas y no acumulen error al reconstruir la serie.
+
+Formato del payload:
+    keyframe: {'k': 1, 'sym': ['AL30', ...], 'px': [123450000, None, ...]}
+    delta:    {'k': 0, 'base': '2024-01-02T11:30:00', 'd': {'AL30': 1500, 'GD30': None}, 'rm': ['XYZ']}
+
+En un delta, None marca que el símbolo pasó a no tener precio numérico y un
+símbolo ausente en el estado anterior se informa con su valor absoluto en 'n'.
+'base' es el snapshot_at de la fila contra la que se calculó el delta: si
+escriben varios procesos, cada delta se aplica sobre su propia base y no sobre
+la fila que casualmente quedó antes.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+# Precisión de los precios intradiarios (6 decimales)
+PRICE_SCALE = 10 ** 6
+
+# Estados recientes que conserva el decodificador para resolver la base de cada delta
+DECODE_BASE_WINDOW = 16
+
+def instant_key(snapshot_at: Optional[str]) -> Optional[datetime]:
+    """
+    snapshot_at comparable sin importar el formato (el que se insertó o el
+    que devuelve Supabase para TIMESTAMPTZ, con zona)
+    """
+    if not snapshot_at:
+        return None
+    try:
+        return datetime.fromisoformat(str(snapshot_at).replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+def to_ticks(price: Optional[float]) -> Optional[int]:
+    """Precio -> entero escalado"""
+    return None if price is None else int(round(price * PRICE_SCALE))
+
+def from_ticks(ticks: Optional[int]) -> Optional[float]:
+    """Entero escalado -> precio"""
+    return None if ticks is None else ticks / PRICE_SCALE
+
+def encode_keyframe(state: Dict[str, Optional[int]]) -> Dict:
+    """Keyframe con todos los símbolos"""
+    symbols = list(state)
+    return {'k': 1, 'sym': symbols, 'px': [state[symbol] for symbol in symbols]}
+
+def encode_delta(previous: Dict[str, Optional[int]], current: Dict[str, Optional[int]],
+                 base: Optional[str] = None) -> Dict:
+    """Diferencias entre dos estados (solo lo que cambió) respecto de la fila base"""
+    changes = {}
+    added = {}
+    for symbol, ticks in current.items():
+        if symbol not in previous:
+            added[symbol] = ticks
+            continue
+        before = previous[symbol]
+        if ticks == before:
+            continue
+        if ticks is None or before is None:
+            # Pasó a no tener precio o volvió a tenerlo: valor absoluto
+            if ticks is None:
+                changes[symbol] = None
+            else:
+                added[symbol] = ticks
+        else:
+            changes[symbol] = ticks - before
+
+    payload = {'k': 0, 'd': changes}
+    if base:
+        payload['base'] = base
+    if added:
+        payload['n'] = added
+    removed = [symbol for symbol in previous if symbol not in current]
+    if removed:
+        payload['rm'] = removed
+    return payload
+
+def apply_payload(state: Dict[str, Optional[int]], payload: Dict) -> Dict[str, Optional[int]]:
+    """Aplica un keyframe o delta sobre el estado anterior y devuelve el nuevo estado"""
+    if payload.get('k'):
+        return dict(zip(payload['sym'], payload['px']))
+
+    new_state = dict(state)
+    for symbol, delta in payload.get('d', {}).items():
+        if delta is None or new_state.get(symbol) is None:
+            new_state[symbol] = None
+        else:
+            new_state[symbol] = new_state[symbol] + delta
+    new_state.update(payload.get('n', {}))
+    for symbol in payload.get('rm', []):
+        new_state.pop(symbol, None)
+    return new_state
+
+def decode_rows(rows: Iterable[Dict]) -> Iterator[Tuple[Dict, Dict[str, Optional[float]]]]:
+    """
+    Reconstruye los snapshots a partir de filas ordenadas por snapshot_at
+
+    Cada delta se aplica sobre el estado de su fila base. Se descartan las
+    deltas sin base conocida (anteriores al primer keyframe o cuya base ya no
+    está entre los últimos DECODE_BASE_WINDOW estados). Las deltas viejas sin
+    'base' se aplican sobre la fila anterior.
+
+    Yields:
+        Tupla (fila, {symbol: price})
+    """
+    states = OrderedDict()
+    state = None
+    for row in rows:
+        payload = row['payload']
+        if payload.get('k'):
+            state = apply_payload({}, payload)
+        elif 'base' in payload:
+            base_state = states.get(instant_key(payload['base']))
+            if base_state is None:
+                continue
+            state = apply_payload(base_state, payload)
+        elif state is None:
+            continue
+        else:
+            state = apply_payload(state, payload)
+
+        states[instant_key(row.get('snapshot_at'))] = state
+        while len(states) > DECODE_BASE_WINDOW:
+            states.popitem(last=False)
+        yield row, {symbol: from_ticks(ticks) for symbol, ticks in state.items()}
+
+class IntradayEncoder:
+    """
+    Mantiene el último estado escrito por este proceso para codificar el próximo snapshot
+
+    Solo se emite un delta si la última fila guardada del día es justamente la
+    que escribió este proceso; si no (reinicio, cambio de día u otro proceso
+    escribió en el medio) se emite un keyframe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._date = None
+        self._state = None
+        self._snapshot_at = None
+
+    def encode(self, snapshot_date: str, prices: Dict[str, Optional[float]], snapshot_at: Optional[str] = None,
+               last_persisted_at: Optional[str] = None) -> Dict:
+        """
+        Codifica el snapshot actual (keyframe o delta) y actualiza el estado
+
+        Args:
+            snapshot_at: Momento del snapshot que se va a guardar
+            last_persisted_at: snapshot_at de la última fila guardada del día
+        """
+        current = {symbol: to_ticks(price) for symbol, price in prices.items()}
+        with self._lock:
+            base_key = instant_key(last_persisted_at)
+            if self._date != snapshot_date or self._state is None or base_key is None or \
+                    base_key != instant_key(self._snapshot_at):
+                payload = encode_keyframe(current)
+            else:
+                payload = encode_delta(self._state, current, last_persisted_at)
+            self._date = snapshot_date
+            self._state = current
+            self._snapshot_at = snapshot_at
+        return payload
+
+    def reset(self):
+        """Fuerza un keyframe en el próximo snapshot (por ejemplo si falló la escritura)"""
+        with self._lock:
+            self._date = None
+            self._state = None
+            self._snapshot_at = None
@@ -0,0 +1,94 @@
+"""
+Historial acotado de ejecuciones de jobs del scheduler
+
+Guarda las últimas N corridas en un buffer circular en memoria y lo persiste
+en un archivo JSON (escritura atómica) para que sobreviva reinicios y para
+que cualquier worker pueda leer las corridas que hizo el líder.
+"""
+import os
+import threading
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+from file_utils import atomic_write_json, read_json
+
+logger = logging.getLogger(__name__)
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil con interpolación lineal (None si no hay valores)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+class JobRunHistory:
+    """Buffer circular de corridas persistido en disco"""
+    
+    def __init__(self, path: str, max_entries: int = 200):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._runs = deque(maxlen=max_entries)
+        self._mtime = None
+    
+    def _reload_if_changed(self):
+        """Relee el archivo si otro proceso lo actualizó"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        runs = read_json(self.path, default=[])
+        if isinstance(runs, list):
+            self._runs = deque(runs, maxlen=self.max_entries)
+        self._mtime = mtime
+    
+    def record(self, entry: Dict):
+        """Agrega una corrida y persiste el buffer"""
+        with self._lock:
+            self._reload_if_changed()
+            self._runs.append(entry)
+            try:
+                atomic_write_json(self.path, list(self._runs))
+                self._mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                logger.error("Error guardando historial de jobs: %s", str(e))
+    
+    def runs(self, job: Optional[str] = None, limit: Optional[int] = None) -> List[Dict]:
+        """Corridas más recientes primero (opcionalmente de un solo job)"""
+        with self._lock:
+            self._reload_if_changed()
+            runs = [run for run in reversed(self._runs) if job is None or run.get('job') == job]
+        return runs[:limit] if limit else runs
+    
+    def stats(self, job: str) -> Dict:
+        """Cantidad, tasa de éxito y percentiles de duración de un job"""
+        runs = self.runs(job)
+        successes = sum(1 for run in runs if run.get('success'))
+        
+        def values(key):
+            return [run[key] for run in runs if run.get(key) is not None]
+        
+        def rounded(value):
+            return round(value, 3) if value is not None else None
+        
+        durations = values('duration_seconds')
+        stage_names = {stage for run in runs for stage in (run.get('stages') or {})}
+        stage_p95 = {stage: rounded(percentile([run['stages'][stage] for run in runs
+                                                if stage in (run.get('stages') or {})], 95))
+                     for stage in sorted(stage_names)}
+        return {
+            'runs': len(runs),
+            'success_rate': round(successes / len(runs), 3) if runs else None,
+            'p50_seconds': rounded(percentile(durations, 50)),
+            'p95_seconds': rounded(percentile(durations, 95)),
+            'max_seconds': rounded(max(durations)) if durations else None,
+            'fetch_p95_seconds': rounded(percentile(values('fetch_seconds'), 95)),
+            'write_p95_seconds': rounded(percentile(values('write_seconds'), 95)),
+            'stage_p95_seconds': stage_p95,
+            'last_run': runs[0] if runs else None
+        }
@@ -0,0 +1,241 @@
+"""
+Cola local de jobs en segundo plano con deduplicación
+
+Los jobs se ejecutan en un pool de hilos del proceso. Mientras un job con el
+mismo nombre está encolado o en ejecución, un nuevo pedido no crea otro: se
+devuelve el job existente (por ejemplo, un doble click en "Guardar snapshot").
+Con archivo compartido la deduplicación vale entre workers: el proceso que
+corre un job retiene un lock de archivo por nombre hasta terminarlo, y los
+demás devuelven el job activo que leen del archivo.
+
+El estado de los jobs se persiste en un archivo JSON (escritura atómica, bajo
+un lock de archivo porque cada worker lee y reescribe la parte de los demás)
+para que cualquier worker pueda responder el estado de un job aunque lo haya
+ejecutado otro proceso.
+"""
+import os
+import uuid
+import time
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from file_utils import atomic_write_json, read_json
+from leader_lock import FileLeaderLock, file_lock
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+def _copy(job: Dict) -> Dict:
+    """Copia del job para devolver fuera del lock (progress se sigue actualizando)"""
+    return dict(job, progress=dict(job['progress']))
+
+class JobQueue:
+    """Pool de hilos con un job activo como máximo por nombre"""
+    
+    def __init__(self, max_workers: int = 2, path: Optional[str] = None, max_finished: int = 50,
+                 thread_name_prefix: str = 'job'):
+        self.max_workers = max_workers
+        self.path = path
+        self.max_finished = max_finished
+        self.thread_name_prefix = thread_name_prefix
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._futures = {}
+        self._claims = {}
+        self._executor = None
+    
+    def submit(self, name: str, func: Callable, trigger: str = 'manual') -> Tuple[Dict, bool]:
+        """
+        Encola func(report) salvo que ya haya un job activo con el mismo nombre
+        
+        func recibe una función report(**progress) para informar el avance y
+        su valor de retorno queda como resultado del job (success=False en un
+        diccionario marca el job como fallido).
+        
+        Returns:
+            Tupla (job, creado): creado es False si se devolvió el job activo
+        """
+        with self._lock:
+            active_id = self._active.get(name)
+            if active_id:
+                logger.info("Job %s ya activo (%s), se reutiliza", name, active_id)
+                return _copy(self._jobs[active_id]), False
+            
+            # Reclamar el nombre y publicar el job en la misma sección crítica del
+            # archivo: si otro proceso tiene el nombre, su job activo ya está escrito
+            with self._shared_lock():
+                if not self._claim(name):
+                    running = self._shared_active(name)
+                    if running:
+                        logger.info("Job %s ya activo en el proceso %s (%s), se reutiliza",
+                                    name, running.get('pid'), running.get('id'))
+                        return running, False
+                    logger.warning("Job %s tomado por otro proceso sin estado visible, se encola igual", name)
+                
+                job = {
+                    'id': uuid.uuid4().hex,
+                    'name': name,
+                    'pid': os.getpid(),
+                    'trigger': trigger,
+                    'status': QUEUED,
+                    'progress': {},
+                    'created_at': datetime.now().isoformat(),
+                    'started_at': None,
+                    'finished_at': None,
+                    'duration_seconds': None,
+                    'result': None,
+                    'error': None
+                }
+                self._jobs[job['id']] = job
+                self._active[name] = job['id']
+                self._write_shared()
+            
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=self.thread_name_prefix)
+            try:
+                self._futures[job['id']] = self._executor.submit(self._run, job, func)
+            except RuntimeError as e:
+                # El pool se cerró (shutdown en curso)
+                self._finish(job, FAILED, error=str(e))
+                self._persist()
+            
+            return _copy(job), True
+    
+    def _run(self, job: Dict, func: Callable):
+        with self._lock:
+            job['status'] = RUNNING
+            job['started_at'] = datetime.now().isoformat()
+            self._persist()
+        
+        def report(**progress):
+            with self._lock:
+                job['progress'].update(progress)
+                self._persist()
+        
+        started = time.perf_counter()
+        try:
+            result = func(report)
+            failed = isinstance(result, dict) and result.get('success') is False
+            status, error = (FAILED if failed else SUCCEEDED), None
+        except Exception as e:
+            logger.error("❌ Error en job %s (%s): %s", job['name'], job['id'], str(e))
+            result, status, error = None, FAILED, str(e)
+        
+        with self._lock:
+            job['duration_seconds'] = round(time.perf_counter() - started, 3)
+            self._finish(job, status, result, error)
+            self._persist()
+    
+    def _finish(self, job: Dict, status: str, result=None, error: Optional[str] = None):
+        """Marca el job como terminado y poda los terminados más viejos (con el lock tomado)"""
+        job['status'] = status
+        job['result'] = result
+        job['error'] = error
+        job['finished_at'] = datetime.now().isoformat()
+        self._futures.pop(job['id'], None)
+        if self._active.get(job['name']) == job['id']:
+            del self._active[job['name']]
+        
+        finished = [job_id for job_id, item in self._jobs.items() if item['status'] not in ACTIVE_STATUSES]
+        for job_id in finished[:-self.max_finished or None]:
+            del self._jobs[job_id]
+    
+    def _shared_lock(self):
+        """Lock de archivo sobre el estado compartido (nada si la cola no persiste)"""
+        return file_lock(self.path + '.lock') if self.path else nullcontext()
+    
+    def _claim(self, name: str) -> bool:
+        """Toma el lock del nombre entre procesos; False si otro proceso lo tiene"""
+        if not self.path:
+            return True
+        lock = self._claims.get(name) or FileLeaderLock(f"{self.path}.{name}.lock", log_level=logging.DEBUG)
+        if not lock.try_acquire():
+            return False
+        self._claims[name] = lock
+        return True
+    
+    def _shared_active(self, name: str) -> Optional[Dict]:
+        """Job activo con ese nombre según el archivo compartido (con el lock de archivo tomado)"""
+        for job in reversed(read_json(self.path, default=[]) or []):
+            if job.get('name') == name and job.get('status') in ACTIVE_STATUSES:
+                return job
+        return None
+    
+    def _persist(self):
+        """Guarda el estado de los jobs de este proceso junto a los de los demás (con el lock tomado)"""
+        if not self.path:
+            return
+        try:
+            with self._shared_lock():
+                self._write_shared()
+        except OSError as e:
+            logger.error("Error guardando estado de jobs: %s", str(e))
+    
+    def _write_shared(self):
+        """Reescribe el archivo compartido y suelta los nombres ya terminados (con ambos locks tomados)"""
+        if not self.path:
+            return
+        pid = os.getpid()
+        try:
+            others = [job for job in read_json(self.path, default=[]) or [] if job.get('pid') != pid]
+            # Los activos de otros procesos no se podan: son los que deduplican sus nombres
+            keep_from = len(others) - self.max_finished
+            others = [job for i, job in enumerate(others) if i >= keep_from or job.get('status') in ACTIVE_STATUSES]
+            atomic_write_json(self.path, others + list(self._jobs.values()))
+        except (OSError, TypeError, ValueError) as e:
+            logger.error("Error guardando estado de jobs: %s", str(e))
+        
+        # El nombre se libera recién cuando el archivo ya muestra el job terminado
+        for name in [name for name in self._claims if name not in self._active]:
+            self._claims.pop(name).release()
+    
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Estado de un job (si no es de este proceso se busca en el archivo compartido)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return _copy(job)
+        
+        if self.path:
+            for job in read_json(self.path, default=[]) or []:
+                if job.get('id') == job_id:
+                    return job
+        return None
+    
+    def active(self, name: str) -> Optional[Dict]:
+        """Job activo con ese nombre en este proceso, o None"""
+        with self._lock:
+            job_id = self._active.get(name)
+            return _copy(self._jobs[job_id]) if job_id else None
+    
+    def jobs(self, limit: Optional[int] = None) -> List[Dict]:
+        """Jobs de este proceso, más recientes primero"""
+        with self._lock:
+            jobs = [_copy(job) for job in reversed(self._jobs.values())]
+        return jobs[:limit] if limit else jobs
+    
+    def shutdown(self):
+        """Cierra el pool sin esperar a los jobs en curso (los encolados se cancelan)"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if not executor:
+            return
+        executor.shutdown(wait=False, cancel_futures=True)
+        
+        with self._lock:
+            for job_id, future in list(self._futures.items()):
+                if future.cancelled():
+                    self._finish(self._jobs[job_id], FAILED, error='Cancelado al detener la cola')
+            self._persist()
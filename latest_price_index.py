@@ -0,0 +1,136 @@
+"""
+Índice en memoria del último precio conocido de cada símbolo
+"""
+import time
+import threading
+import logging
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class LatestPriceIndex:
+    """
+    symbol -> {'symbol', 'price', 'date', 'timestamp', 'source'}
+    
+    Se carga de forma perezosa en la primera consulta con loader(None) y se
+    mantiene al día con update() en cada snapshot. Como otros procesos
+    (workers de gunicorn) también pueden escribir snapshots, cada ttl segundos
+    se refresca de forma incremental con loader(fecha más nueva vista), sin
+    volver a leer todo el historial. Mientras un hilo refresca, los demás
+    siguen respondiendo con las entradas actuales.
+    
+    symbol_loader, si se indica, busca el último precio de un símbolo que no
+    está en el índice (por ejemplo, sin cotización dentro de la carga inicial).
+    """
+    
+    def __init__(self, loader: Callable[[Optional[str]], Iterable[Dict]], ttl: float = 300,
+                 symbol_loader: Optional[Callable[[str], Optional[Dict]]] = None):
+        self._loader = loader
+        self._symbol_loader = symbol_loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+        self._missing = set()
+        self._loaded_at = None
+        self._full_load = True
+    
+    def _is_fresh(self) -> bool:
+        loaded_at = self._loaded_at
+        return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+    
+    def _ensure_loaded(self):
+        if self._is_fresh():
+            return
+        
+        # Solo la primera carga espera; un refresco en curso no bloquea a los demás hilos
+        if not self._load_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._is_fresh():
+                return
+            full_load = self._full_load or self._loaded_at is None
+            try:
+                entries = {}
+                self._merge(entries, self._loader(None if full_load else self._high_water()))
+                with self._lock:
+                    if full_load:
+                        self._entries = entries
+                        self._missing = set()
+                    else:
+                        self._merge(self._entries, entries.values())
+                        self._missing.difference_update(entries)
+                self._full_load = False
+                logger.info("Índice de últimos precios %s: %s símbolos",
+                            'cargado' if full_load else 'actualizado', len(entries))
+            except Exception as e:
+                # Se conserva lo que hubiera y se reintenta en la próxima ventana
+                logger.error("Error cargando índice de últimos precios: %s", str(e))
+            self._loaded_at = time.monotonic()
+        finally:
+            self._load_lock.release()
+    
+    def _high_water(self) -> Optional[str]:
+        """Fecha más nueva del índice (el refresco incremental relee desde ahí)"""
+        with self._lock:
+            return max((entry['date'] for entry in self._entries.values() if entry['date']), default=None)
+    
+    @staticmethod
+    def _merge(entries: Dict[str, Dict], records: Iterable[Dict]):
+        for record in records:
+            if record.get('price') is None or not record.get('symbol'):
+                continue
+            symbol = record['symbol'].upper()
+            current = entries.get(symbol)
+            record_date = record.get('date') or ''
+            if current is None or (record_date, record.get('timestamp') or '') >= \
+                    (current['date'] or '', current.get('timestamp') or ''):
+                entries[symbol] = {
+                    'symbol': symbol,
+                    'price': float(record['price']),
+                    'date': record.get('date'),
+                    'timestamp': record.get('timestamp'),
+                    'source': record.get('source')
+                }
+    
+    def update(self, records: Iterable[Dict]):
+        """Aplica filas recién escritas (las más antiguas que el índice se ignoran)"""
+        with self._lock:
+            self._merge(self._entries, records)
+    
+    def get(self, symbol: str) -> Optional[Dict]:
+        """Entrada del símbolo o None"""
+        self._ensure_loaded()
+        symbol = symbol.upper()
+        entry = self._entries.get(symbol)
+        if entry is not None or self._symbol_loader is None or symbol in self._missing:
+            return entry
+        
+        try:
+            record = self._symbol_loader(symbol)
+        except Exception as e:
+            logger.error("Error buscando último precio de %s: %s", symbol, str(e))
+            return None
+        with self._lock:
+            if record:
+                self._merge(self._entries, [record])
+            else:
+                self._missing.add(symbol)
+            return self._entries.get(symbol)
+    
+    def get_price(self, symbol: str) -> Optional[float]:
+        """Último precio del símbolo o None"""
+        entry = self.get(symbol)
+        return entry['price'] if entry else None
+    
+    def all(self) -> List[Dict]:
+        """Todas las entradas, ordenadas por símbolo"""
+        self._ensure_loaded()
+        entries = self._entries
+        return [entries[symbol] for symbol in sorted(entries)]
+    
+    def invalidate(self):
+        """Fuerza una recarga completa en la próxima consulta"""
+        with self._lock:
+            self._full_load = True
+            self._loaded_at = None
@@ -0,0 +1,112 @@
+"""
+Elección de líder entre procesos mediante un lock de archivo
+
+Con gunicorn cada worker importa app.py y arranca su propio scheduler. Solo el
+proceso que obtiene el lock exclusivo del archivo ejecuta los jobs; el resto
+queda pasivo y reintenta periódicamente. El sistema operativo libera el lock
+cuando el proceso líder termina (aunque muera sin limpiar), así que otro
+worker lo toma en el siguiente reintento.
+"""
+import os
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+class FileLeaderLock:
+    """Lock exclusivo no bloqueante sobre un archivo compartido por los workers"""
+    
+    def __init__(self, path: str, log_level: int = logging.INFO):
+        self.path = path
+        self.log_level = log_level
+        self._file = None
+        self._lock = threading.Lock()
+    
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+    
+    def try_acquire(self) -> bool:
+        """Intenta tomar el liderazgo sin bloquear; True si este proceso es el líder"""
+        with self._lock:
+            if self._file is not None:
+                return True
+            
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            lock_file = open(self.path, 'a+')
+            try:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            except OSError:
+                lock_file.close()
+                return False
+            
+            # Datos del líder para diagnóstico (el lock es lo que cuenta, no el contenido)
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(f"{os.getpid()} {socket.gethostname()} {datetime.now().isoformat()}\n")
+            lock_file.flush()
+            self._file = lock_file
+            logger.log(self.log_level, "👑 Proceso %s es el líder (%s)", os.getpid(), self.path)
+            return True
+    
+    def release(self):
+        """Libera el liderazgo (también ocurre automáticamente si el proceso muere)"""
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                if fcntl:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                else:
+                    self._file.seek(0)
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            except OSError as e:
+                logger.warning("Error liberando lock de líder: %s", str(e))
+            self._file.close()
+            self._file = None
+            logger.log(self.log_level, "Proceso %s dejó de ser líder (%s)", os.getpid(), self.path)
+    
+    def describe_leader(self) -> Optional[Dict]:
+        """pid, host y desde cuándo del líder actual según el archivo (puede estar desactualizado)"""
+        try:
+            with open(self.path, 'r') as lock_file:
+                pid, host, since = lock_file.readline().split()
+            return {'pid': int(pid), 'host': host, 'since': since}
+        except (OSError, ValueError):
+            return None
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Lock exclusivo bloqueante sobre un archivo, para secciones críticas cortas
+    entre procesos (por ejemplo leer-modificar-escribir un JSON compartido)
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a+') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,357 @@
+"""
+Analítica técnica vectorizada sobre el historial de precios
+
+Las series se cargan en una matriz NumPy (fechas x símbolos) y cada métrica
+se calcula de una sola vez para todos los símbolos, sin bucles por fila:
+
+- Retornos diarios
+- Volatilidad móvil (desvío de los retornos, anualizada)
+- Medias móviles simple y exponencial
+- Drawdown y mínimo/máximo del período
+- Curva de valor de una cartera (valor, cambio y aporte de cada posición)
+
+Los días en que un símbolo no tiene precio se completan con el último precio
+conocido (forward fill); antes del primer precio la serie queda en NaN.
+"""
+import os
+import logging
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Días hábiles por año para anualizar la volatilidad
+TRADING_DAYS_PER_YEAR = 252
+
+# Ventanas por defecto
+DEFAULT_WINDOW = 20
+DEFAULT_EMA_SPAN = 20
+
+# Máximo de símbolos por consulta a la API
+MAX_ANALYTICS_SYMBOLS = int(os.environ.get('MAX_ANALYTICS_SYMBOLS', '1000'))
+
+# Frecuencias de la curva de valor de carteras (se toma el último día de cada período)
+VALUE_SERIES_FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+def build_price_matrix(rows: Iterable[Dict], symbols: Optional[Iterable[str]] = None) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Arma la matriz de precios a partir de filas de market_data_history
+    
+    Args:
+        rows: Filas con 'symbol', 'date' y 'price' (en cualquier orden)
+        symbols: Símbolos a incluir (por defecto todos los que aparecen)
+    
+    Returns:
+        Tupla (fechas ordenadas, símbolos, matriz float64 de fechas x símbolos)
+    """
+    wanted = {symbol.upper() for symbol in symbols} if symbols else None
+    date_positions = {}
+    symbol_positions = {}
+    date_index = []
+    symbol_index = []
+    values = []
+    for row in rows:
+        price = row.get('price')
+        if price is None:
+            continue
+        symbol = row['symbol'].upper()
+        if wanted is not None and symbol not in wanted:
+            continue
+        date_index.append(date_positions.setdefault(row['date'], len(date_positions)))
+        symbol_index.append(symbol_positions.setdefault(symbol, len(symbol_positions)))
+        values.append(float(price))
+    if wanted is not None:
+        for symbol in wanted:
+            symbol_positions.setdefault(symbol, len(symbol_positions))
+    
+    # Las posiciones se asignan por orden de aparición; se reordenan de una vez
+    dates, date_rank = _sorted_positions(date_positions)
+    columns, symbol_rank = _sorted_positions(symbol_positions)
+    
+    matrix = np.full((len(dates), len(columns)), np.nan)
+    if values:
+        matrix[date_rank[date_index], symbol_rank[symbol_index]] = values
+    
+    return dates, columns, forward_fill(matrix)
+
+def _sorted_positions(positions: Dict[str, int]) -> Tuple[List[str], np.ndarray]:
+    """Claves ordenadas y array que lleva cada posición original a la ordenada"""
+    keys = sorted(positions)
+    rank = np.empty(len(keys), dtype=np.intp)
+    rank[[positions[key] for key in keys]] = np.arange(len(keys))
+    return keys, rank
+
+def forward_fill(prices: np.ndarray) -> np.ndarray:
+    """Completa los huecos de cada columna con el último valor conocido"""
+    if prices.size == 0:
+        return prices
+    valid = ~np.isnan(prices)
+    index = np.where(valid, np.arange(prices.shape[0])[:, None], 0)
+    np.maximum.accumulate(index, axis=0, out=index)
+    return prices[index, np.arange(prices.shape[1])]
+
+def daily_returns(prices: np.ndarray) -> np.ndarray:
+    """Retorno simple día a día (la primera fila queda en NaN)"""
+    returns = np.full(prices.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = prices[1:] / prices[:-1] - 1
+    returns[~np.isfinite(returns)] = np.nan
+    return returns
+
+def _window_sum(values: np.ndarray, window: int) -> np.ndarray:
+    """Suma de cada ventana móvil por columna (sumas acumuladas, O(n))"""
+    cumulative = np.cumsum(values, axis=0)
+    cumulative[window:] = cumulative[window:] - cumulative[:-window].copy()
+    return cumulative
+
+def simple_moving_average(prices: np.ndarray, window: int = DEFAULT_WINDOW) -> np.ndarray:
+    """Media móvil simple (NaN hasta completar la ventana)"""
+    valid = ~np.isnan(prices)
+    sums = _window_sum(np.where(valid, prices, 0.0), window)
+    counts = _window_sum(valid.astype(np.float64), window)
+    return np.where(counts == window, sums / window, np.nan)
+
+def exponential_moving_average(prices: np.ndarray, span: int = DEFAULT_EMA_SPAN) -> np.ndarray:
+    """
+    Media móvil exponencial con alpha = 2 / (span + 1)
+    
+    Recorre las fechas una vez, vectorizado sobre todos los símbolos. Arranca
+    en el primer precio de cada símbolo.
+    """
+    alpha = 2.0 / (span + 1)
+    ema = np.full(prices.shape, np.nan)
+    if prices.size == 0:
+        return ema
+    
+    current = prices[0].copy()
+    ema[0] = current
+    for i in range(1, prices.shape[0]):
+        row = prices[i]
+        current = np.where(np.isnan(current), row,
+                           np.where(np.isnan(row), current, current + alpha * (row - current)))
+        ema[i] = current
+    return ema
+
+def rolling_volatility(returns: np.ndarray, window: int = DEFAULT_WINDOW,
+                       periods_per_year: int = TRADING_DAYS_PER_YEAR) -> np.ndarray:
+    """Desvío estándar muestral de los retornos en la ventana, anualizado"""
+    valid = ~np.isnan(returns)
+    filled = np.where(valid, returns, 0.0)
+    sums = _window_sum(filled, window)
+    squares = _window_sum(filled * filled, window)
+    counts = _window_sum(valid.astype(np.float64), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (squares - sums * sums / counts) / (counts - 1)
+    variance = np.where(counts == window, np.maximum(variance, 0.0), np.nan)
+    return np.sqrt(variance * periods_per_year)
+
+def drawdown(prices: np.ndarray) -> np.ndarray:
+    """Caída respecto del máximo acumulado (0 en máximos, negativo en caídas)"""
+    running_max = np.fmax.accumulate(prices, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return prices / running_max - 1
+
+def _first_valid(values: np.ndarray) -> np.ndarray:
+    """Primer valor no NaN de cada columna"""
+    return _last_valid(values[::-1])
+
+def _last_valid(values: np.ndarray) -> np.ndarray:
+    """Último valor no NaN de cada columna"""
+    if values.shape[0] == 0:
+        return np.full(values.shape[1], np.nan)
+    valid = ~np.isnan(values)
+    index = values.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+    last = values[index, np.arange(values.shape[1])]
+    return np.where(valid.any(axis=0), last, np.nan)
+
+def _to_json(value) -> Optional[float]:
+    """float de NumPy -> float de Python (NaN -> None)"""
+    value = float(value)
+    return None if np.isnan(value) else round(value, 6)
+
+def compute_analytics(dates: List[str], symbols: List[str], prices: np.ndarray,
+                      window: int = DEFAULT_WINDOW, ema_span: int = DEFAULT_EMA_SPAN,
+                      include_series: bool = False) -> List[Dict]:
+    """
+    Calcula todas las métricas para la matriz de precios
+    
+    Returns:
+        Lista con un diccionario por símbolo (y la serie completa si include_series)
+    """
+    returns = daily_returns(prices)
+    volatility = rolling_volatility(returns, window)
+    sma = simple_moving_average(prices, window)
+    ema = exponential_moving_average(prices, ema_span)
+    drawdowns = drawdown(prices)
+    
+    # Las columnas sin ningún precio quedan en NaN
+    with np.errstate(all='ignore'):
+        minimum = np.nanmin(prices, axis=0, initial=np.inf, where=~np.isnan(prices))
+        maximum = np.nanmax(prices, axis=0, initial=-np.inf, where=~np.isnan(prices))
+        max_drawdown = np.nanmin(drawdowns, axis=0, initial=np.inf, where=~np.isnan(drawdowns))
+        first_price = _first_valid(prices)
+        last_price = _last_valid(prices)
+        total_return = last_price / first_price - 1
+    minimum[np.isinf(minimum)] = np.nan
+    maximum[np.isinf(maximum)] = np.nan
+    max_drawdown[np.isinf(max_drawdown)] = np.nan
+    
+    last_volatility = _last_valid(volatility)
+    last_sma = _last_valid(sma)
+    last_ema = _last_valid(ema)
+    last_drawdown = _last_valid(drawdowns)
+    points = (~np.isnan(prices)).sum(axis=0)
+    
+    results = []
+    for j, symbol in enumerate(symbols):
+        item = {
+            'symbol': symbol,
+            'points': int(points[j]),
+            'last_price': _to_json(last_price[j]),
+            'min_price': _to_json(minimum[j]),
+            'max_price': _to_json(maximum[j]),
+            'total_return': _to_json(total_return[j]),
+            'volatility': _to_json(last_volatility[j]),
+            'sma': _to_json(last_sma[j]),
+            'ema': _to_json(last_ema[j]),
+            'drawdown': _to_json(last_drawdown[j]),
+            'max_drawdown': _to_json(max_drawdown[j])
+        }
+        if include_series:
+            item['series'] = [
+                {
+                    'date': day,
+                    'price': _to_json(prices[i, j]),
+                    'return': _to_json(returns[i, j]),
+                    'volatility': _to_json(volatility[i, j]),
+                    'sma': _to_json(sma[i, j]),
+                    'ema': _to_json(ema[i, j]),
+                    'drawdown': _to_json(drawdowns[i, j])
+                }
+                for i, day in enumerate(dates)
+                if not np.isnan(prices[i, j])
+            ]
+        results.append(item)
+    
+    return results
+
+def period_end_indices(dates: List[str], freq: str = 'daily') -> np.ndarray:
+    """Índice del último día de cada semana (ISO) o mes; todos los días si freq es daily"""
+    if freq == 'daily' or not dates:
+        return np.arange(len(dates))
+    if freq == 'weekly':
+        keys = [date.fromisoformat(day).isocalendar()[:2] for day in dates]
+    else:
+        keys = [day[:7] for day in dates]
+    return np.array([i for i in range(len(keys)) if i == len(keys) - 1 or keys[i] != keys[i + 1]], dtype=np.intp)
+
+def portfolio_value_series(dates: List[str], symbols: List[str], prices: np.ndarray,
+                           quantities: np.ndarray, freq: str = 'daily') -> Dict:
+    """
+    Curva de valor de una cartera con cantidades fijas
+    
+    El aporte de cada posición en un punto es cantidad x variación de su
+    precio respecto del punto anterior; si una posición recién empieza a
+    tener precio su aporte es 0 (el salto de valor queda solo en change).
+    
+    Args:
+        dates, symbols, prices: Matriz de precios (build_price_matrix, con forward fill)
+        quantities: Cantidad de cada símbolo, en el mismo orden que symbols
+        freq: daily, weekly o monthly
+    
+    Returns:
+        Diccionario con la serie (fecha, valor, cambio, cambio %, aportes) y el detalle por posición
+    """
+    points = period_end_indices(dates, freq)
+    prices = prices[points]
+    dates = [dates[i] for i in points]
+    
+    position_values = prices * quantities
+    priced = ~np.isnan(position_values)
+    values = np.where(priced, position_values, 0.0).sum(axis=1)
+    
+    change = np.full(len(dates), np.nan)
+    change_pct = np.full(len(dates), np.nan)
+    contributions = np.full(position_values.shape, np.nan)
+    if len(dates) > 1:
+        change[1:] = np.diff(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change_pct[1:] = np.where(values[:-1] > 0, change[1:] / values[:-1] * 100, np.nan)
+        moves = np.diff(position_values, axis=0)
+        contributions[1:] = np.where(np.isnan(moves), 0.0, moves)
+    
+    with np.errstate(all='ignore'):
+        total_contribution = np.nansum(contributions, axis=0)
+        start_price = _first_valid(prices)
+        end_price = _last_valid(prices)
+    total_change = values[-1] - values[0] if len(dates) else np.nan
+    
+    return {
+        'points': len(dates),
+        'start_value': _to_json(values[0]) if len(dates) else None,
+        'end_value': _to_json(values[-1]) if len(dates) else None,
+        'change': _to_json(total_change),
+        'change_pct': _to_json(total_change / values[0] * 100) if len(dates) and values[0] > 0 else None,
+        'series': [
+            {
+                'date': day,
+                'value': _to_json(values[i]),
+                'change': _to_json(change[i]),
+                'change_pct': _to_json(change_pct[i]),
+                'contributions': {symbol: _to_json(contributions[i, j]) for j, symbol in enumerate(symbols)}
+            }
+            for i, day in enumerate(dates)
+        ],
+        'positions': [
+            {
+                'symbol': symbol,
+                'quantity': float(quantities[j]),
+                'start_price': _to_json(start_price[j]),
+                'end_price': _to_json(end_price[j]),
+                'end_value': _to_json(position_values[-1, j]) if len(dates) else None,
+                'contribution': _to_json(total_contribution[j]),
+                'contribution_pct': _to_json(total_contribution[j] / total_change * 100)
+                                    if len(dates) and total_change else None
+            }
+            for j, symbol in enumerate(symbols)
+        ]
+    }
+
+def load_price_matrix(symbols: List[str], days: int) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Carga el historial de los últimos N días en una matriz
+    
+    Solo se leen las filas de los símbolos pedidos (réplica local o consultas
+    in_() por bloques de símbolos en Supabase).
+    """
+    from market_history_model import iter_symbol_prices
+    
+    start_date = (date.today() - timedelta(days=days)).isoformat()
+    return build_price_matrix(iter_symbol_prices(symbols, start_date), symbols)
+
+def analyze_symbols(symbols: List[str], days: int = 365, window: int = DEFAULT_WINDOW,
+                    ema_span: int = DEFAULT_EMA_SPAN, include_series: bool = False) -> List[Dict]:
+    """
+    Métricas técnicas para uno o varios símbolos
+    
+    Args:
+        symbols: Símbolos a analizar
+        days: Días de historia hacia atrás
+        window: Ventana para SMA y volatilidad
+        ema_span: Período de la media exponencial
+        include_series: Incluir la serie diaria completa de cada símbolo
+    """
+    if not symbols:
+        raise ValueError("Debe indicar al menos un símbolo")
+    if len(symbols) > MAX_ANALYTICS_SYMBOLS:
+        raise ValueError(f"Máximo {MAX_ANALYTICS_SYMBOLS} símbolos por consulta")
+    if window < 2:
+        raise ValueError("La ventana debe ser de al menos 2 días")
+    if ema_span < 1:
+        raise ValueError("El período de la EMA debe ser positivo")
+    
+    dates, columns, prices = load_price_matrix([symbol.upper() for symbol in symbols], days)
+    logger.info("📈 Analítica de %s símbolos sobre %s fechas", len(columns), len(dates))
+    return compute_analytics(dates, columns, prices, window, ema_span, include_series)
@@ -0,0 +1,283 @@
+"""
+Importación masiva de precios históricos a market_data_history
+
+Lee un CSV (symbol, date, price y opcionalmente timestamp) en streaming,
+valida cada fila con las mismas reglas que save_daily_snapshot y escribe con
+upserts masivos por lotes. Después de cada lote se guarda un checkpoint con
+la cantidad de filas procesadas, de modo que una importación interrumpida se
+retoma donde quedó.
+
+Uso como comando:
+    python market_history_backfill.py archivo.csv [--batch-size 2000] [--checkpoint ruta] [--restart] [--dry-run]
+"""
+import os
+import csv
+import time
+import logging
+import argparse
+from datetime import date, datetime
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+from config import Config
+from file_utils import atomic_write_json, read_json
+from google_sheets_service import SYMBOL_COLUMNS, PRICE_COLUMNS, parse_price
+from market_history_model import build_history_record, upsert_history_records, MAX_REPORTED_ERRORS
+from supabase_client import get_supabase_client
+
+logger = logging.getLogger(__name__)
+
+# Filas por lote (un upsert y un checkpoint por lote)
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', '2000'))
+
+# Directorio de checkpoints
+BACKFILL_CHECKPOINT_DIR = os.environ.get('BACKFILL_CHECKPOINT_DIR', os.path.join(Config.DATA_DIR, 'backfill'))
+
+DATE_COLUMNS = ('date', 'fecha')
+TIMESTAMP_COLUMNS = ('timestamp',)
+
+# Formatos de fecha aceptados en el CSV
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y')
+
+BACKFILL_SOURCE = 'csv_backfill'
+
+class BackfillError(Exception):
+    """Error que detiene la importación (el checkpoint queda en el último lote confirmado)"""
+
+def parse_date(raw_date: str) -> Optional[str]:
+    """Fecha del CSV -> YYYY-MM-DD, o None si no es válida"""
+    raw_date = raw_date.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(raw_date, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def resolve_backfill_columns(header: List[str]) -> Dict[str, Optional[int]]:
+    """Índices de las columnas symbol, date, price y timestamp (la última es opcional)"""
+    normalized = [column.lstrip('\ufeff').strip().lower() for column in header]
+    
+    def find(candidates):
+        return next((i for i, column in enumerate(normalized) if column in candidates), None)
+    
+    columns = {
+        'symbol': find(SYMBOL_COLUMNS),
+        'date': find(DATE_COLUMNS),
+        'price': find(PRICE_COLUMNS),
+        'timestamp': find(TIMESTAMP_COLUMNS)
+    }
+    missing = [name for name in ('symbol', 'date', 'price') if columns[name] is None]
+    if missing:
+        raise BackfillError(f"Faltan columnas en el CSV: {', '.join(missing)}")
+    return columns
+
+def validate_row(row: List[str], columns: Dict[str, Optional[int]],
+                 source: str = BACKFILL_SOURCE) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Convierte una fila del CSV en un registro de market_data_history
+    
+    Returns:
+        Tupla (registro, None) si es válida o (None, motivo) si se descarta
+    """
+    try:
+        symbol = row[columns['symbol']].strip()
+        raw_date = row[columns['date']]
+        raw_price = row[columns['price']]
+    except IndexError:
+        return None, 'Fila incompleta'
+    
+    if not symbol:
+        return None, 'Símbolo vacío'
+    
+    snapshot_date = parse_date(raw_date)
+    if not snapshot_date:
+        return None, f'Fecha inválida: {raw_date}'
+    if snapshot_date > date.today().isoformat():
+        return None, f'Fecha futura: {snapshot_date}'
+    
+    timestamp_index = columns['timestamp']
+    if timestamp_index is not None and timestamp_index < len(row) and row[timestamp_index].strip():
+        timestamp = row[timestamp_index].strip()
+    else:
+        timestamp = f'{snapshot_date} 00:00:00'
+    
+    # Mismo camino que el sheet: limpieza de $ y separadores, luego normalize_price
+    record = build_history_record(symbol, parse_price(raw_price), snapshot_date, timestamp, source)
+    if record['price'] is None:
+        return None, f'Precio inválido: {raw_price}'
+    return record, None
+
+def iter_batches(reader: Iterator[List[str]], batch_size: int) -> Iterator[List[List[str]]]:
+    """Agrupa las filas del CSV en lotes sin cargar el archivo completo"""
+    while True:
+        batch = list(islice(reader, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def default_checkpoint_path(csv_path: str) -> str:
+    """Checkpoint por archivo dentro de BACKFILL_CHECKPOINT_DIR"""
+    name = os.path.basename(csv_path)
+    return os.path.join(BACKFILL_CHECKPOINT_DIR, f'{name}.checkpoint.json')
+
+def file_fingerprint(csv_path: str) -> Dict:
+    """Identifica el archivo para no retomar un checkpoint de otro contenido"""
+    stat = os.stat(csv_path)
+    return {'path': os.path.abspath(csv_path), 'size': stat.st_size}
+
+class BackfillImporter:
+    """Importa un CSV histórico en lotes con checkpoint"""
+    
+    def __init__(self, csv_path: str, batch_size: Optional[int] = None, checkpoint_path: Optional[str] = None,
+                 source: str = BACKFILL_SOURCE, dry_run: bool = False, supabase=None):
+        self.csv_path = csv_path
+        self.batch_size = batch_size or BACKFILL_BATCH_SIZE
+        self.checkpoint_path = checkpoint_path or default_checkpoint_path(csv_path)
+        self.source = source
+        self.dry_run = dry_run
+        self._supabase = supabase
+    
+    def load_checkpoint(self) -> Dict:
+        """Checkpoint vigente del archivo, o uno vacío"""
+        checkpoint = read_json(self.checkpoint_path)
+        if not checkpoint:
+            return {'rows_processed': 0, 'rows_written': 0, 'rows_rejected': 0}
+        if checkpoint.get('file') != file_fingerprint(self.csv_path):
+            raise BackfillError(f"El checkpoint {self.checkpoint_path} corresponde a otro archivo; "
+                                "use --restart para empezar de nuevo")
+        return checkpoint
+    
+    def save_checkpoint(self, progress: Dict):
+        atomic_write_json(self.checkpoint_path, {
+            'file': file_fingerprint(self.csv_path),
+            'rows_processed': progress['rows_processed'],
+            'rows_written': progress['rows_written'],
+            'rows_rejected': progress['rows_rejected'],
+            'completed': progress.get('completed', False),
+            'updated_at': datetime.now().isoformat()
+        })
+    
+    def reset_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+    
+    def run(self) -> Dict:
+        """
+        Ejecuta (o retoma) la importación
+        
+        Returns:
+            Resumen con filas procesadas, escritas, descartadas, errores y filas/seg
+        """
+        checkpoint = {'rows_processed': 0, 'rows_written': 0, 'rows_rejected': 0} if self.dry_run \
+            else self.load_checkpoint()
+        if checkpoint.get('completed'):
+            logger.info("✅ %s ya fue importado por completo (checkpoint %s)", self.csv_path, self.checkpoint_path)
+            return dict(checkpoint, rows_per_second=0, duration_seconds=0, errors=[])
+        
+        resume_from = checkpoint['rows_processed']
+        progress = {
+            'rows_processed': resume_from,
+            'rows_written': checkpoint['rows_written'],
+            'rows_rejected': checkpoint['rows_rejected'],
+            'batches': 0,
+            'errors': []
+        }
+        supabase = None if self.dry_run else (self._supabase or get_supabase_client())
+        started = time.perf_counter()
+        session_rows = 0
+        
+        with open(self.csv_path, 'r', encoding='utf-8', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader, None)
+            if header is None:
+                raise BackfillError(f"{self.csv_path} está vacío")
+            columns = resolve_backfill_columns(header)
+            
+            if resume_from:
+                logger.info("⏩ Retomando %s desde la fila %s", self.csv_path, resume_from)
+                for _ in islice(reader, resume_from):
+                    pass
+            
+            for batch in iter_batches(reader, self.batch_size):
+                # Un registro por (symbol, date) dentro del lote: gana la última fila
+                records = {}
+                for offset, row in enumerate(batch):
+                    if not any(cell.strip() for cell in row):
+                        continue
+                    record, reason = validate_row(row, columns, self.source)
+                    if record is None:
+                        progress['rows_rejected'] += 1
+                        self._report_error(progress, {'line': progress['rows_processed'] + offset + 2,
+                                                      'error': reason})
+                        continue
+                    records[(record['symbol'], record['date'])] = record
+                
+                if records and not self.dry_run:
+                    result = upsert_history_records(supabase, list(records.values()), chunk_size=self.batch_size)
+                    if result['rows_written'] == 0:
+                        # Nada confirmado (Supabase caído): no avanzar el checkpoint
+                        raise BackfillError(f"Falló la escritura del lote que empieza en la fila "
+                                            f"{progress['rows_processed'] + 2}: {result['errors'][:1]}")
+                    progress['rows_written'] += result['rows_written']
+                    for error in result['errors']:
+                        self._report_error(progress, error)
+                elif self.dry_run:
+                    progress['rows_written'] += len(records)
+                
+                progress['rows_processed'] += len(batch)
+                progress['batches'] += 1
+                session_rows += len(batch)
+                if not self.dry_run:
+                    self.save_checkpoint(progress)
+                
+                elapsed = time.perf_counter() - started
+                logger.info("📦 Lote %s: %s filas procesadas, %s escritas, %s descartadas (%.0f filas/s)",
+                            progress['batches'], progress['rows_processed'], progress['rows_written'],
+                            progress['rows_rejected'], session_rows / elapsed if elapsed else 0)
+        
+        progress['completed'] = True
+        if not self.dry_run:
+            self.save_checkpoint(progress)
+        
+        duration = time.perf_counter() - started
+        progress['duration_seconds'] = round(duration, 3)
+        progress['rows_per_second'] = round(session_rows / duration, 1) if duration else 0
+        logger.info("🎉 Importación completa: %s filas escritas, %s descartadas en %.1fs (%.0f filas/s)",
+                    progress['rows_written'], progress['rows_rejected'], duration, progress['rows_per_second'])
+        return progress
+    
+    @staticmethod
+    def _report_error(progress: Dict, error: Dict):
+        if len(progress['errors']) < MAX_REPORTED_ERRORS:
+            progress['errors'].append(error)
+        else:
+            progress['errors_truncated'] = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Importación masiva de precios históricos a market_data_history')
+    parser.add_argument('csv_path', help='CSV con columnas symbol, date, price (y opcionalmente timestamp)')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE, help='Filas por lote')
+    parser.add_argument('--checkpoint', help='Archivo de checkpoint (por defecto en DATA_DIR/backfill)')
+    parser.add_argument('--source', default=BACKFILL_SOURCE, help='Valor de la columna source')
+    parser.add_argument('--restart', action='store_true', help='Ignorar el checkpoint y empezar de cero')
+    parser.add_argument('--dry-run', action='store_true', help='Solo validar, sin escribir')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO)
+    importer = BackfillImporter(args.csv_path, args.batch_size, args.checkpoint, args.source, args.dry_run)
+    if args.restart:
+        importer.reset_checkpoint()
+    
+    try:
+        result = importer.run()
+    except BackfillError as e:
+        logger.error("❌ %s", str(e))
+        raise SystemExit(1)
+    
+    print(f"Filas procesadas: {result['rows_processed']}, escritas: {result['rows_written']}, "
+          f"descartadas: {result['rows_rejected']}, {result['rows_per_second']} filas/s")
+    for error in result['errors']:
+        print(f"  {error}")
+
+if __name__ == '__main__':
+    main()
@@ -1,113 +1,398 @@
-from supabase import create_client, Client
-from google_sheets_service import google_sheets_service
-from datetime import datetime, date
+from supabase_client import get_supabase_client
+from market_history_store import market_history_mirror
+from intraday_series import IntradayEncoder, decode_rows
+from latest_price_index import LatestPriceIndex
+from config import Config
+from datetime import datetime, date, timedelta
 import os
+import time
+import json
+import statistics
+import base64
 import logging
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_supabase_client() -> Client:
-    """Obtiene el cliente de Supabase"""
-    url = os.environ.get("SUPABASE_URL")
-    key = os.environ.get("SUPABASE_KEY")
+# Cantidad de filas por upsert masivo
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get('SNAPSHOT_CHUNK_SIZE', '500'))
+
+# Valores del sheet que no representan un precio
+INVALID_PRICES = ('#N/A', 'N/A', 'Cargando...')
+
+# Máximo de errores individuales incluidos en el resumen
+MAX_REPORTED_ERRORS = 50
+
+# Modo intradiario: además de la fila diaria (que queda como cierre del día)
+# se guarda cada snapshot en market_intraday_history codificado como delta.
+# Tabla en Supabase:
+#   CREATE TABLE market_intraday_history (
+#       snapshot_at TIMESTAMPTZ PRIMARY KEY,
+#       date DATE NOT NULL,
+#       is_keyframe BOOLEAN NOT NULL,
+#       symbols_count INTEGER,
+#       payload JSONB NOT NULL
+#   );
+#   CREATE INDEX ON market_intraday_history (date, snapshot_at);
+MARKET_INTRADAY_ENABLED = os.environ.get('MARKET_INTRADAY_ENABLED', '0') == '1'
+
+# Resoluciones soportadas por get_symbol_history
+RESOLUTIONS = ('daily', 'intraday')
+
+# Estado del último snapshot intradiario del día (para codificar deltas)
+intraday_encoder = IntradayEncoder()
+
+# Último snapshot escrito (fecha + hash del contenido), compartido entre workers:
+# si el sheet no cambió desde la última escritura del día se omite el upsert
+LAST_SNAPSHOT_STATE_FILE = os.environ.get('LAST_SNAPSHOT_STATE_FILE',
+                                          os.path.join(Config.DATA_DIR, 'last_snapshot_write.json'))
+
+# Compactación del historial: se mantiene la resolución diaria para los
+# últimos HISTORY_FULL_RESOLUTION_DAYS días y el resto se conserva como filas
+# OHLC semanales (hasta HISTORY_WEEKLY_RETENTION_DAYS) y mensuales (siempre).
+# Tabla en Supabase:
+#   CREATE TABLE market_data_history_ohlc (
+#       symbol TEXT NOT NULL,
+#       resolution TEXT NOT NULL,          -- 'weekly' | 'monthly'
+#       date DATE NOT NULL,                -- inicio del período
+#       end_date DATE NOT NULL,            -- último día con datos del período
+#       open NUMERIC, high NUMERIC, low NUMERIC, close NUMERIC,
+#       points INTEGER,
+#       updated_at TIMESTAMPTZ,
+#       PRIMARY KEY (symbol, resolution, date)
+#   );
+#   CREATE INDEX ON market_data_history_ohlc (resolution, date, symbol);
+HISTORY_COMPACTION_ENABLED = os.environ.get('HISTORY_COMPACTION_ENABLED', '0') == '1'
+HISTORY_FULL_RESOLUTION_DAYS = max(62, int(os.environ.get('HISTORY_FULL_RESOLUTION_DAYS', '365')))
+HISTORY_WEEKLY_RETENTION_DAYS = int(os.environ.get('HISTORY_WEEKLY_RETENTION_DAYS', str(3 * 365)))
+
+# Rango máximo (en días) que se sirve en cada resolución antes de pasar a la siguiente
+HISTORY_DAILY_MAX_SPAN_DAYS = int(os.environ.get('HISTORY_DAILY_MAX_SPAN_DAYS', '180'))
+HISTORY_WEEKLY_MAX_SPAN_DAYS = int(os.environ.get('HISTORY_WEEKLY_MAX_SPAN_DAYS', str(2 * 365)))
+
+HISTORY_RESOLUTIONS = ('daily', 'weekly', 'monthly')
+OHLC_RESOLUTIONS = ('weekly', 'monthly')
+
+# Índice de últimos precios: segundos entre refrescos incrementales y días
+# hacia atrás de la carga inicial si no hay réplica local ni RPC disponible
+# (los símbolos sin cotización en esa ventana se buscan de a uno al pedirlos)
+LATEST_PRICE_INDEX_TTL = float(os.environ.get('LATEST_PRICE_INDEX_TTL', '300'))
+LATEST_PRICE_LOOKBACK_DAYS = int(os.environ.get('LATEST_PRICE_LOOKBACK_DAYS', '30'))
+
+def _load_latest_prices(since=None):
+    """
+    Filas para el índice de últimos precios
     
-    if not url or not key:
-        raise ValueError("SUPABASE_URL y SUPABASE_ANON_KEY deben estar configurados")
+    Args:
+        since: Fecha más nueva ya indexada (refresco incremental) o None (carga inicial)
+    """
+    if market_history_mirror.is_synced():
+        if since:
+            return market_history_mirror.query_history(start_date=since, limit=None)
+        return market_history_mirror.latest_prices()
     
-    return create_client(url, key)
+    supabase = get_supabase_client()
+    if since is None:
+        try:
+            result = supabase.rpc('get_latest_market_prices').execute()
+            if result.data:
+                return result.data
+        except Exception as e:
+            logger.warning("RPC get_latest_market_prices no disponible: %s", str(e))
+        since = (date.today() - timedelta(days=LATEST_PRICE_LOOKBACK_DAYS)).isoformat()
+    
+    # Ventana acotada (o solo lo nuevo desde la última carga) con cursor (date, symbol)
+    return iter_market_history(start_date=since)
+
+def _load_latest_price(symbol):
+    """Última fila con precio de un símbolo que no quedó en el índice, o None"""
+    if market_history_mirror.is_synced():
+        rows = market_history_mirror.query_history(symbol, limit=None)
+    else:
+        rows = get_supabase_client().table('market_data_history').select('symbol,date,price,timestamp,source') \
+            .eq('symbol', symbol).not_.is_('price', 'null').order('date', desc=True).limit(1).execute().data or []
+    return next((row for row in rows if row.get('price') is not None), None)
+
+# symbol -> último precio, mantenido por los snapshots
+latest_price_index = LatestPriceIndex(_load_latest_prices, ttl=LATEST_PRICE_INDEX_TTL,
+                                      symbol_loader=_load_latest_price)
+
+# Precio "a una fecha" (último en o antes de la fecha) para varios símbolos en
+# una sola llamada. Con la RPC es una consulta; sin ella se leen las filas de
+# los últimos AS_OF_LOOKBACK_DAYS días de todos los símbolos juntos (y, para
+# los que no aparecen, las anteriores hasta encontrar su última fila).
+#   CREATE FUNCTION get_market_prices_as_of(p_symbols TEXT[], p_date DATE)
+#   RETURNS TABLE (symbol TEXT, date DATE, price NUMERIC) AS $$
+#       SELECT DISTINCT ON (symbol) symbol, date, price
+#       FROM market_data_history
+#       WHERE symbol = ANY(p_symbols) AND date <= p_date AND price IS NOT NULL
+#       ORDER BY symbol, date DESC
+#   $$ LANGUAGE sql STABLE;
+AS_OF_LOOKBACK_DAYS = int(os.environ.get('AS_OF_LOOKBACK_DAYS', '30'))
+AS_OF_SYMBOLS_PER_QUERY = 100
+AS_OF_PAGE_SIZE = 1000
 
-def save_daily_snapshot():
+# Si la RPC no existe en la base se deja de llamar por este tiempo (segundos)
+AS_OF_RPC_RETRY_SECONDS = float(os.environ.get('AS_OF_RPC_RETRY_SECONDS', '3600'))
+_as_of_rpc_retry_at = 0.0
+
+def _is_missing_function_error(error):
+    """True si PostgREST indica que la función RPC no existe (PGRST202 / 404)"""
+    code = str(getattr(error, 'code', '') or '')
+    message = str(error)
+    return code in ('PGRST202', '404') or 'PGRST202' in message or \
+        'could not find the function' in message.lower()
+
+def normalize_price(price):
+    """Convierte un precio del sheet a float o None si no es válido"""
+    if price is None or price in INVALID_PRICES:
+        return None
     try:
-        print("🔄 Iniciando save_daily_snapshot")
-        
-        # Obtener datos de Google Sheets
-        market_data_response = google_sheets_service.get_market_data()
-        
-        # Manejar que puede ser una lista directamente
-        if isinstance(market_data_response, list):
-            market_data = market_data_response
-            print(f"✅ Datos son una lista directa: {len(market_data)} elementos")
-        elif isinstance(market_data_response, dict) and 'data' in market_data_response:
-            market_data = market_data_response['data']
-            print(f"✅ Datos extraídos de diccionario: {len(market_data)} elementos")
-        else:
-            print(f"❌ Tipo de datos inesperado: {type(market_data_response)}")
-            return False
-            
-        if not market_data:
-            print("❌ No hay datos de mercado para guardar")
-            return False
-            
-        print(f"💾 Guardando snapshot de {len(market_data)} símbolos...")
-        
-        # OBTENER CLIENTE DE SUPABASE
-        supabase = get_supabase_client()
+        return float(price)
+    except (ValueError, TypeError):
+        return None
+
+def build_history_record(symbol, price, snapshot_date, timestamp, source='google_sheets'):
+    """Arma la fila de market_data_history aplicando las reglas de validación de precios"""
+    return {
+        'symbol': symbol.upper(),
+        'price': normalize_price(price),
+        'raw_price': str(price),
+        'date': snapshot_date,
+        'timestamp': timestamp,
+        'source': source
+    }
+
+def upsert_history_records(supabase, records, chunk_size=None, on_conflict='symbol,date'):
+    """
+    Escribe filas en market_data_history con upserts masivos por bloques
+    
+    Si un bloque falla se reintenta fila por fila para aislar los registros
+    problemáticos sin perder el resto del bloque. Las filas confirmadas por
+    Supabase se copian también a la réplica local y al índice de últimos precios.
+    
+    Returns:
+        Diccionario con rows_written, chunks, failed_chunks y errors
+    """
+    chunk_size = chunk_size or SNAPSHOT_CHUNK_SIZE
+    result = {'rows_written': 0, 'chunks': 0, 'failed_chunks': 0, 'errors': []}
+    
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        result['chunks'] += 1
         
-        saved_count = 0
-        updated_count = 0
-        errors = 0
+        try:
+            response = supabase.table('market_data_history').upsert(chunk, on_conflict=on_conflict).execute()
+            if response.data:
+                result['rows_written'] += len(chunk)
+                market_history_mirror.upsert_records(chunk)
+                latest_price_index.update(chunk)
+                continue
+            chunk_error = 'No se obtuvo respuesta'
+        except Exception as e:
+            chunk_error = str(e)
         
-        # Fecha actual para el snapshot
-        today = date.today().isoformat()
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        result['failed_chunks'] += 1
+        logger.warning("Bloque %s falló (%s), reintentando %s filas de a una",
+                       result['chunks'], chunk_error, len(chunk))
         
-        for item in market_data:
+        written = []
+        for record in chunk:
             try:
-                symbol = item.get('symbol', '').upper()
-                price = item.get('price')
-                
-                print(f"Procesando: {symbol} - ${price}")
-                
-                # Manejar precios inválidos
-                if price in ['#N/A', 'N/A', 'Cargando...'] or price is None:
-                    price_numeric = None
-                else:
-                    try:
-                        price_numeric = float(price)
-                    except (ValueError, TypeError):
-                        price_numeric = None
-                        print(f"  ⚠️ Precio inválido para {symbol}: {price}")
-                
-                # Preparar datos para insertar/actualizar
-                record_data = {
-                    'symbol': symbol,
-                    'price': price_numeric,
-                    'raw_price': str(price),
-                    'date': today,
-                    'timestamp': timestamp,
-                    'source': 'google_sheets'
-                }
-                
-                # USAR UPSERT - Actualizar si existe, insertar si no existe
-                result = supabase.table('market_data_history').upsert(
-                    record_data,
-                    on_conflict='symbol,date'  # Campos únicos
-                ).execute()
-                
-                if result.data:
-                    print(f"  ✅ Upsert exitoso: {symbol}")
-                    saved_count += 1
-                else:
-                    print(f"  ❌ Error en upsert {symbol}: No se obtuvo respuesta")
-                    errors += 1
-                    
-            except Exception as item_error:
-                print(f"  ❌ Error procesando {item.get('symbol', 'Unknown')}: {str(item_error)}")
-                errors += 1
-                continue
+                response = supabase.table('market_data_history').upsert(record, on_conflict=on_conflict).execute()
+                if response.data:
+                    result['rows_written'] += 1
+                    written.append(record)
+                    continue
+                row_error = 'No se obtuvo respuesta'
+            except Exception as e:
+                row_error = str(e)
+            
+            if len(result['errors']) < MAX_REPORTED_ERRORS:
+                result['errors'].append({'symbol': record.get('symbol'), 'error': row_error})
+            else:
+                result['errors_truncated'] = True
         
-        print(f"🎉 Snapshot completado: {saved_count} registros procesados, {errors} errores")
-        return saved_count > 0
+        market_history_mirror.upsert_records(written)
+        latest_price_index.update(written)
+    
+    return result
+
+def save_intraday_snapshot(supabase, records, snapshot_date, snapshot_at):
+    """
+    Guarda un snapshot intradiario en market_intraday_history
+    
+    El primer snapshot del día es un keyframe con todos los precios; los
+    siguientes solo contienen los símbolos que cambiaron respecto de la
+    última fila guardada. Si esa fila la escribió otro proceso (snapshot
+    manual junto al programado) se guarda un keyframe.
+    
+    Returns:
+        Diccionario con keyframe (bool) y changed_symbols
+    """
+    prices = {record['symbol']: record['price'] for record in records}
+    
+    last_persisted_at = None
+    try:
+        result = supabase.table('market_intraday_history').select('snapshot_at').eq('date', snapshot_date) \
+            .order('snapshot_at', desc=True).limit(1).execute()
+        last_persisted_at = result.data[0]['snapshot_at'] if result.data else None
+    except Exception as e:
+        # Sin la última fila no hay base segura: keyframe
+        logger.warning("No se pudo leer el último snapshot intradiario: %s", str(e))
+    
+    payload = intraday_encoder.encode(snapshot_date, prices, snapshot_at, last_persisted_at)
+    
+    row = {
+        'date': snapshot_date,
+        'snapshot_at': snapshot_at,
+        'is_keyframe': bool(payload['k']),
+        'symbols_count': len(prices),
+        'payload': payload
+    }
+    
+    try:
+        supabase.table('market_intraday_history').insert(row).execute()
+    except Exception:
+        # Sin la fila anterior no se puede aplicar el próximo delta
+        intraday_encoder.reset()
+        raise
+    
+    changed = len(prices) if payload['k'] else len(payload['d']) + len(payload.get('n', {})) + len(payload.get('rm', []))
+    return {'keyframe': bool(payload['k']), 'changed_symbols': changed}
+
+# Resumen diario precalculado al final de cada snapshot. Tabla en Supabase:
+#   CREATE TABLE market_daily_summary (
+#       date DATE PRIMARY KEY,
+#       symbol_count INTEGER, priced_count INTEGER,
+#       mean_price NUMERIC, median_price NUMERIC,
+#       advancers INTEGER, decliners INTEGER, unchanged INTEGER,
+#       computed_at TIMESTAMPTZ
+#   );
+
+def compute_daily_summary(snapshot_date, records, previous_prices):
+    """
+    Calcula el resumen del día a partir de las filas del snapshot
+    
+    Args:
+        snapshot_date: Fecha del snapshot (YYYY-MM-DD)
+        records: Filas de market_data_history del día
+        previous_prices: {symbol: price} del día anterior con datos
+    
+    Returns:
+        Diccionario listo para market_daily_summary
+    """
+    prices = []
+    advancers = decliners = unchanged = 0
+    
+    for record in records:
+        price = record['price']
+        if price is None:
+            continue
+        prices.append(price)
         
+        previous = previous_prices.get(record['symbol'])
+        if previous is None:
+            continue
+        if price > previous:
+            advancers += 1
+        elif price < previous:
+            decliners += 1
+        else:
+            unchanged += 1
+    
+    return {
+        'date': snapshot_date,
+        'symbol_count': len(records),
+        'priced_count': len(prices),
+        'mean_price': round(statistics.fmean(prices), 6) if prices else None,
+        'median_price': round(statistics.median(prices), 6) if prices else None,
+        'advancers': advancers,
+        'decliners': decliners,
+        'unchanged': unchanged,
+        'computed_at': datetime.now().isoformat()
+    }
+
+def _get_previous_close_prices(supabase, snapshot_date):
+    """{symbol: price} del último día con datos anterior a snapshot_date"""
+    if market_history_mirror.is_synced():
+        return market_history_mirror.previous_close(snapshot_date)
+    
+    result = supabase.table('market_data_history').select('date').lt('date', snapshot_date) \
+        .order('date', desc=True).limit(1).execute()
+    if not result.data:
+        return {}
+    previous_date = result.data[0]['date']
+    
+    return {
+        row['symbol']: float(row['price'])
+        for row in iter_market_history(start_date=previous_date, end_date=previous_date)
+        if row.get('price') is not None
+    }
+
+def save_daily_summary(supabase, records, snapshot_date):
+    """Calcula y guarda (upsert por fecha) el resumen diario del snapshot"""
+    previous_prices = _get_previous_close_prices(supabase, snapshot_date)
+    summary = compute_daily_summary(snapshot_date, records, previous_prices)
+    supabase.table('market_daily_summary').upsert(summary, on_conflict='date').execute()
+    return summary
+
+def get_daily_summaries(days=7):
+    """Obtiene los resúmenes de los últimos N días con una sola consulta (índice por fecha)"""
+    try:
+        supabase = get_supabase_client()
+        start_date = (date.today() - timedelta(days=days - 1)).isoformat()
+        result = supabase.table('market_daily_summary').select('*').gte('date', start_date) \
+            .order('date', desc=True).execute()
+        return result.data or []
     except Exception as e:
-        print(f"❌ ERROR al guardar snapshot diario: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+        logger.error("Error al obtener resúmenes diarios: %s", str(e))
+        return []
+
+def save_daily_snapshot(chunk_size=None, force=False):
+    """
+    Guarda el snapshot de precios del día en market_data_history
+    
+    Ejecuta las etapas fetch/normalize/persist de SnapshotPipeline, sin la
+    revaluación de carteras (para eso usar run_snapshot_pipeline).
+    
+    Args:
+        chunk_size: Filas por upsert masivo (por defecto SNAPSHOT_CHUNK_SIZE)
+        force: Escribir aunque el contenido sea igual al último snapshot escrito hoy
+    
+    Returns:
+        Resumen con success, rows_fetched, rows_written, chunks, errors y duración
+        (skipped=True si el contenido no cambió)
+    """
+    # Import diferido: snapshot_pipeline importa este módulo
+    from snapshot_pipeline import SnapshotPipeline
+    return SnapshotPipeline(chunk_size, force, revalue=False).run()
+
+def select_history_resolution(start_date=None, end_date=None, today=None):
+    """
+    Elige la resolución para el rango pedido
+    
+    Sin compactación o sin fecha de inicio siempre es diaria. Con compactación,
+    los rangos cortos y recientes se sirven con filas diarias y los más largos
+    (o anteriores a la ventana diaria) con filas semanales o mensuales, para
+    que la cantidad de filas devueltas se mantenga acotada.
+    """
+    if not HISTORY_COMPACTION_ENABLED or not start_date:
+        return 'daily'
+    
+    today = today or date.today()
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date) if end_date else today
+    span = (end - start).days
+    
+    if start >= today - timedelta(days=HISTORY_FULL_RESOLUTION_DAYS) and span <= HISTORY_DAILY_MAX_SPAN_DAYS:
+        return 'daily'
+    if start >= today - timedelta(days=HISTORY_WEEKLY_RETENTION_DAYS) and span <= HISTORY_WEEKLY_MAX_SPAN_DAYS:
+        return 'weekly'
+    return 'monthly'
 
-def get_market_history(symbol=None, start_date=None, end_date=None, limit=100):
+def get_market_history(symbol=None, start_date=None, end_date=None, limit=100, resolution='auto'):
     """Obtiene el historial de datos de mercado
     
     Args:
@@ -115,11 +400,21 @@ def get_market_history(symbol=None, start_date=None, end_date=None, limit=100):
         start_date: Fecha de inicio (YYYY-MM-DD)
         end_date: Fecha de fin (YYYY-MM-DD)
         limit: Límite de registros
+        resolution: 'daily', 'weekly', 'monthly' o 'auto' (según el rango pedido)
     
     Returns:
         Lista de registros del historial
     """
     try:
+        if resolution == 'auto':
+            resolution = select_history_resolution(start_date, end_date)
+        if resolution != 'daily':
+            return _query_ohlc_history(resolution, symbol, start_date, end_date, limit)
+        
+        # Servir desde la réplica local si está sincronizada
+        if market_history_mirror.is_synced():
+            return market_history_mirror.query_history(symbol, start_date, end_date, limit)
+        
         supabase = get_supabase_client()
         
         query = supabase.table('market_data_history').select('*')
@@ -142,42 +437,549 @@ def get_market_history(symbol=None, start_date=None, end_date=None, limit=100):
         logger.error(f"Error al obtener historial: {str(e)}")
         return []
 
-def get_latest_prices():
-    """Obtiene los precios más recientes de cada símbolo"""
+def _query_ohlc_history(resolution, symbol=None, start_date=None, end_date=None, limit=100, after=None):
+    """Filas semanales o mensuales con el mismo orden y forma que las diarias (price = cierre)"""
+    if resolution not in OHLC_RESOLUTIONS:
+        raise ValueError(f"Resolución inválida: {resolution}. Opciones: {', '.join(HISTORY_RESOLUTIONS)}")
+    
+    supabase = get_supabase_client()
+    query = supabase.table('market_data_history_ohlc').select('*').eq('resolution', resolution)
+    
+    if symbol:
+        query = query.eq('symbol', symbol)
+    if start_date:
+        query = query.gte('date', start_date)
+    if end_date:
+        query = query.lte('date', end_date)
+    if after:
+        cursor_date, cursor_symbol = after
+        query = query.or_(f"date.lt.{_postgrest_quote(cursor_date)},"
+                          f"and(date.eq.{_postgrest_quote(cursor_date)},symbol.gt.{_postgrest_quote(cursor_symbol)})")
+    
+    rows = query.order('date', desc=True).order('symbol').limit(limit).execute().data or []
+    for row in rows:
+        row['price'] = row.get('close')
+    return rows
+
+# Tamaño máximo de página del historial y de cada consulta interna al exportar
+MAX_HISTORY_PAGE_SIZE = 1000
+
+def encode_history_cursor(row):
+    """Cursor opaco con la clave (date, symbol) de la última fila entregada"""
+    raw = json.dumps([row['date'], row['symbol']], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_history_cursor(cursor):
+    """Decodifica un cursor de encode_history_cursor; ValueError si es inválido"""
     try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_date, cursor_symbol = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return str(cursor_date), str(cursor_symbol)
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+def _postgrest_quote(value):
+    """Escapa un valor para usarlo dentro de un filtro or=(...) de PostgREST"""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def get_market_history_page(symbol=None, start_date=None, end_date=None, limit=100, cursor=None,
+                            resolution='daily'):
+    """Obtiene una página del historial con paginación keyset sobre (date, symbol)
+    
+    Args:
+        symbol: Filtrar por símbolo específico
+        start_date: Fecha de inicio (YYYY-MM-DD)
+        end_date: Fecha de fin (YYYY-MM-DD)
+        limit: Filas por página (máximo MAX_HISTORY_PAGE_SIZE)
+        cursor: Cursor opaco devuelto por la página anterior
+        resolution: 'daily', 'weekly', 'monthly' o 'auto' (según el rango pedido)
+    
+    Returns:
+        Tupla (registros, next_cursor). next_cursor es None en la última página
+    """
+    limit = max(1, min(int(limit), MAX_HISTORY_PAGE_SIZE))
+    after = decode_history_cursor(cursor) if cursor else None
+    
+    if resolution == 'auto':
+        resolution = select_history_resolution(start_date, end_date)
+    
+    if resolution != 'daily':
+        rows = _query_ohlc_history(resolution, symbol, start_date, end_date, limit, after)
+    elif market_history_mirror.is_synced():
+        rows = market_history_mirror.query_history(symbol, start_date, end_date, limit, after=after)
+    else:
         supabase = get_supabase_client()
         
-        # Subconsulta para obtener la fecha más reciente por símbolo
-        result = supabase.rpc('get_latest_market_prices').execute()
+        query = supabase.table('market_data_history').select('*')
         
-        if not result.data:
-            # Fallback: obtener registros más recientes manualmente
-            result = supabase.table('market_data_history').select('*').order('date', desc=True).limit(50).execute()
-            
-            # Agrupar por símbolo y tomar el más reciente
-            latest_by_symbol = {}
-            for record in result.data:
-                symbol = record['symbol']
-                if symbol not in latest_by_symbol or record['date'] > latest_by_symbol[symbol]['date']:
-                    latest_by_symbol[symbol] = record
-            
-            return list(latest_by_symbol.values())
+        if symbol:
+            query = query.eq('symbol', symbol)
+        if start_date:
+            query = query.gte('date', start_date)
+        if end_date:
+            query = query.lte('date', end_date)
+        if after:
+            cursor_date, cursor_symbol = after
+            query = query.or_(f"date.lt.{_postgrest_quote(cursor_date)},"
+                              f"and(date.eq.{_postgrest_quote(cursor_date)},symbol.gt.{_postgrest_quote(cursor_symbol)})")
         
-        return result.data
+        rows = query.order('date', desc=True).order('symbol').limit(limit).execute().data or []
+    
+    next_cursor = encode_history_cursor(rows[-1]) if len(rows) == limit else None
+    return rows, next_cursor
+
+def iter_market_history(symbol=None, start_date=None, end_date=None, page_size=MAX_HISTORY_PAGE_SIZE):
+    """Recorre todo el historial página por página (memoria constante)"""
+    cursor = None
+    while True:
+        rows, cursor = get_market_history_page(symbol, start_date, end_date, page_size, cursor)
+        yield from rows
+        if not cursor:
+            break
+
+def ohlc_period_start(day, resolution):
+    """Inicio del período semanal (lunes) o mensual (día 1) que contiene a day"""
+    if resolution == 'weekly':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+def aggregate_ohlc(rows, resolutions=OHLC_RESOLUTIONS, min_period_start=None):
+    """
+    Agrupa filas diarias en filas OHLC por (symbol, resolución, período)
+    
+    Args:
+        rows: Filas diarias en cualquier orden
+        resolutions: Resoluciones a generar
+        min_period_start: {resolución: fecha} - se descartan los períodos que
+                          empiezan antes (quedarían incompletos)
+    
+    Returns:
+        Lista de filas para market_data_history_ohlc
+    """
+    min_period_start = min_period_start or {}
+    periods = {}
+    
+    for row in rows:
+        price = row.get('price')
+        if price is None:
+            continue
+        price = float(price)
+        day = date.fromisoformat(row['date'])
+        
+        for resolution in resolutions:
+            start = ohlc_period_start(day, resolution)
+            if resolution in min_period_start and start < min_period_start[resolution]:
+                continue
+            key = (row['symbol'], resolution, start)
+            period = periods.get(key)
+            if period is None:
+                periods[key] = {'open_date': day, 'open': price, 'close_date': day, 'close': price,
+                                'high': price, 'low': price, 'points': 1}
+                continue
+            if day < period['open_date']:
+                period['open_date'], period['open'] = day, price
+            if day > period['close_date']:
+                period['close_date'], period['close'] = day, price
+            period['high'] = max(period['high'], price)
+            period['low'] = min(period['low'], price)
+            period['points'] += 1
+    
+    updated_at = datetime.now().isoformat()
+    return [
+        {
+            'symbol': symbol,
+            'resolution': resolution,
+            'date': start.isoformat(),
+            'end_date': period['close_date'].isoformat(),
+            'open': period['open'],
+            'high': period['high'],
+            'low': period['low'],
+            'close': period['close'],
+            'points': period['points'],
+            'updated_at': updated_at
+        }
+        for (symbol, resolution, start), period in periods.items()
+    ]
+
+def merge_ohlc_period(existing, period):
+    """
+    Combina un período recién agregado con la fila OHLC ya guardada
+    
+    Si el período se armó con al menos tantos puntos como la fila guardada,
+    sus filas diarias están completas y lo reemplaza. Si tiene menos (filas
+    diarias escritas tarde en un período ya podado) se suman a la fila
+    guardada: máximo, mínimo y, si son posteriores, cierre. La apertura se
+    conserva.
+    """
+    if not existing or (existing.get('points') or 0) <= period['points']:
+        return period
+    
+    merged = dict(period)
+    merged['open'] = float(existing['open'])
+    merged['high'] = max(float(existing['high']), period['high'])
+    merged['low'] = min(float(existing['low']), period['low'])
+    merged['points'] = existing['points']
+    if existing['end_date'] >= period['end_date']:
+        merged['end_date'] = existing['end_date']
+        merged['close'] = float(existing['close'])
+    return merged
+
+def _upsert_ohlc_periods(supabase, periods, chunk_size):
+    """Guarda períodos OHLC combinándolos con las filas existentes; devuelve cuántos se escribieron"""
+    existing = {}
+    by_resolution = {}
+    for period in periods:
+        by_resolution.setdefault(period['resolution'], []).append(period)
+    
+    for resolution, items in by_resolution.items():
+        symbols = sorted({period['symbol'] for period in items})
+        first = min(period['date'] for period in items)
+        last = max(period['date'] for period in items)
+        for start in range(0, len(symbols), AS_OF_SYMBOLS_PER_QUERY):
+            chunk = symbols[start:start + AS_OF_SYMBOLS_PER_QUERY]
+            offset = 0
+            while True:
+                rows = supabase.table('market_data_history_ohlc') \
+                    .select('symbol,resolution,date,end_date,open,high,low,close,points') \
+                    .eq('resolution', resolution).in_('symbol', chunk).gte('date', first).lte('date', last) \
+                    .order('date').order('symbol').range(offset, offset + AS_OF_PAGE_SIZE - 1).execute().data or []
+                for row in rows:
+                    existing[(row['symbol'], row['resolution'], row['date'])] = row
+                if len(rows) < AS_OF_PAGE_SIZE:
+                    break
+                offset += AS_OF_PAGE_SIZE
+    
+    merged = [merge_ohlc_period(existing.get((period['symbol'], period['resolution'], period['date'])), period)
+              for period in periods]
+    for start in range(0, len(merged), chunk_size):
+        supabase.table('market_data_history_ohlc').upsert(merged[start:start + chunk_size],
+                                                          on_conflict='symbol,resolution,date').execute()
+    return len(merged)
+
+def history_cutoffs(today=None):
+    """
+    (corte diario, corte semanal) de la compactación: antes del primero solo
+    quedan filas OHLC y antes del segundo solo las mensuales
+    """
+    today = today or date.today()
+    return ((today - timedelta(days=HISTORY_FULL_RESOLUTION_DAYS)).isoformat(),
+            (today - timedelta(days=HISTORY_WEEKLY_RETENTION_DAYS)).isoformat())
+
+def compact_market_history(since=None, today=None, chunk_size=None):
+    """
+    Recalcula las filas OHLC semanales/mensuales y poda el historial antiguo
+    
+    Cada corrida recalcula desde el inicio del último mes ya compactado (o desde
+    since, por ejemplo después de un backfill cuyos días todavía no se podaron).
+    Antes de podar también agrega todas las filas diarias que se van a borrar
+    (backfills o escrituras tardías de fechas viejas), combinándolas con las
+    filas OHLC existentes. Después borra las filas diarias anteriores a la
+    ventana de resolución completa y las semanales anteriores a su retención.
+    Las mensuales se conservan siempre.
+    
+    Returns:
+        Resumen con success, rows_read, periods_written, filas podadas y duración
+    """
+    started = time.perf_counter()
+    today = today or date.today()
+    chunk_size = chunk_size or SNAPSHOT_CHUNK_SIZE
+    summary = {
+        'success': False,
+        'since': None,
+        'expiring_from': None,
+        'rows_read': 0,
+        'periods_written': 0,
+        'daily_rows_deleted': 0,
+        'weekly_rows_deleted': 0,
+        'errors': [],
+        'duration_seconds': 0
+    }
+    
+    try:
+        supabase = get_supabase_client()
+        
+        if since is None:
+            result = supabase.table('market_data_history_ohlc').select('date').eq('resolution', 'monthly') \
+                .order('date', desc=True).limit(1).execute()
+            since = result.data[0]['date'] if result.data else None
+        
+        # Se lee desde el lunes anterior al inicio del mes para que la primera semana quede completa
+        min_period_start = {}
+        read_from = None
+        if since:
+            month_start = ohlc_period_start(date.fromisoformat(since), 'monthly')
+            week_start = ohlc_period_start(month_start, 'weekly')
+            min_period_start = {'monthly': month_start, 'weekly': week_start}
+            read_from = week_start.isoformat()
+        summary['since'] = read_from
+        logger.info("🗜️ Compactando historial desde %s", read_from or 'el inicio')
+        
+        # Filas diarias que se van a podar y que la lectura anterior no cubre: se agregan
+        # desde el inicio de su mes hasta completar la semana y el mes del último día podado
+        daily_cutoff, weekly_cutoff = history_cutoffs(today)
+        slices = []
+        if read_from:
+            result = supabase.table('market_data_history').select('date').lt('date', min(daily_cutoff, read_from)) \
+                .order('date').limit(1).execute()
+            if result.data:
+                oldest_month = ohlc_period_start(date.fromisoformat(result.data[0]['date']), 'monthly')
+                last_pruned = date.fromisoformat(daily_cutoff) - timedelta(days=1)
+                month_end = (ohlc_period_start(last_pruned, 'monthly') + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+                week_end = last_pruned + timedelta(days=6 - last_pruned.weekday())
+                expiring_from = ohlc_period_start(oldest_month, 'weekly').isoformat()
+                slices.append((expiring_from, max(month_end, week_end).isoformat(), {}))
+                summary['expiring_from'] = expiring_from
+                logger.info("🗜️ Agregando filas diarias a podar desde %s", expiring_from)
+        slices.append((read_from, None, min_period_start))
+        
+        def counted_rows(start_date, end_date):
+            for row in iter_market_history(start_date=start_date, end_date=end_date):
+                summary['rows_read'] += 1
+                yield row
+        
+        for start_date, end_date, slice_min_period_start in slices:
+            periods = aggregate_ohlc(counted_rows(start_date, end_date), min_period_start=slice_min_period_start)
+            summary['periods_written'] += _upsert_ohlc_periods(supabase, periods, chunk_size)
         
+        # Poda: solo después de que los agregados quedaron escritos (todas las filas
+        # anteriores a daily_cutoff entraron en alguna de las lecturas de arriba)
+        result = supabase.table('market_data_history').delete(count='exact', returning='minimal') \
+            .lt('date', daily_cutoff).execute()
+        summary['daily_rows_deleted'] = result.count or 0
+        market_history_mirror.delete_before(daily_cutoff)
+        
+        result = supabase.table('market_data_history_ohlc').delete(count='exact', returning='minimal') \
+            .eq('resolution', 'weekly').lt('date', weekly_cutoff).execute()
+        summary['weekly_rows_deleted'] = result.count or 0
+        
+        summary['success'] = True
+        logger.info("🎉 Compactación completada: %s filas leídas, %s períodos, %s diarias y %s semanales podadas",
+                    summary['rows_read'], summary['periods_written'],
+                    summary['daily_rows_deleted'], summary['weekly_rows_deleted'])
+        return summary
+        
+    except Exception as e:
+        logger.error("❌ ERROR en la compactación del historial: %s", str(e))
+        summary['errors'].append({'error': str(e)})
+        return summary
+    finally:
+        summary['duration_seconds'] = round(time.perf_counter() - started, 3)
+
+def get_latest_prices():
+    """Obtiene los precios más recientes de cada símbolo (desde el índice en memoria)"""
+    try:
+        return latest_price_index.all()
     except Exception as e:
         logger.error(f"Error al obtener precios más recientes: {str(e)}")
         return []
 
-def get_symbol_history(symbol, days=30):
-    """Obtiene el historial de un símbolo específico para los últimos N días"""
+def _first_price_per_symbol(build_query, symbols, price_column='price'):
+    """
+    Primer precio de cada símbolo en las filas de build_query(chunk), que se
+    recorren por bloques de símbolos en orden date desc y se dejan de leer
+    cuando ya se encontraron todos los del bloque
+    """
+    prices = {}
+    for start in range(0, len(symbols), AS_OF_SYMBOLS_PER_QUERY):
+        chunk = symbols[start:start + AS_OF_SYMBOLS_PER_QUERY]
+        pending = set(chunk)
+        offset = 0
+        while pending:
+            rows = build_query(chunk).order('date', desc=True).order('symbol') \
+                .range(offset, offset + AS_OF_PAGE_SIZE - 1).execute().data or []
+            for row in rows:
+                if row['symbol'] in pending and row.get(price_column) is not None:
+                    prices[row['symbol']] = float(row[price_column])
+                    pending.discard(row['symbol'])
+            if len(rows) < AS_OF_PAGE_SIZE:
+                break
+            offset += AS_OF_PAGE_SIZE
+    return prices
+
+def _ohlc_prices_as_of(symbols, target_date, supabase):
+    """
+    Cierre del período OHLC que cubre target_date (o del último anterior) para
+    símbolos cuyas filas diarias ya se podaron: semanal si el período todavía
+    se conserva, si no mensual
+    """
+    prices = {}
+    weekly_cutoff = history_cutoffs()[1]
+    
+    for resolution in OHLC_RESOLUTIONS:
+        pending = [symbol for symbol in symbols if symbol not in prices]
+        if not pending:
+            break
+        if resolution == 'weekly' and target_date < weekly_cutoff:
+            continue
+        prices.update(_first_price_per_symbol(
+            lambda chunk: supabase.table('market_data_history_ohlc').select('symbol,date,close')
+                .eq('resolution', resolution).in_('symbol', chunk).lte('date', target_date),
+            pending, price_column='close'))
+    
+    return prices
+
+def get_prices_as_of(symbols, target_date, supabase=None):
+    """
+    Último precio de cada símbolo en o antes de target_date
+    
+    Una sola consulta para todos los símbolos (réplica local, RPC
+    get_market_prices_as_of o, sin RPC, una ventana de fechas con in_). Con la
+    compactación activa, los símbolos sin fila diaria (podada) toman el cierre
+    del período semanal o mensual que cubre la fecha.
+    
+    Returns:
+        {symbol: precio o None si no hay precio en o antes de la fecha}
+    """
+    global _as_of_rpc_retry_at
+    symbols = list(dict.fromkeys(symbols))
+    if not symbols:
+        return {}
+    
+    if market_history_mirror.is_synced():
+        prices = market_history_mirror.prices_as_of(symbols, target_date)
+    else:
+        supabase = supabase or get_supabase_client()
+        prices = None
+        
+        if time.monotonic() >= _as_of_rpc_retry_at:
+            try:
+                result = supabase.rpc('get_market_prices_as_of', {'p_symbols': symbols, 'p_date': target_date}).execute()
+                prices = dict.fromkeys(symbols)
+                for row in result.data or []:
+                    prices[row['symbol']] = float(row['price'])
+            except Exception as e:
+                # Un error transitorio solo afecta a esta llamada; si la función no existe se deja de probar un rato
+                if _is_missing_function_error(e):
+                    _as_of_rpc_retry_at = time.monotonic() + AS_OF_RPC_RETRY_SECONDS
+                    logger.warning("RPC get_market_prices_as_of no disponible: %s", str(e))
+                else:
+                    logger.error("Error en RPC get_market_prices_as_of, se usa la ventana de fechas: %s", str(e))
+        
+        if prices is None:
+            # Sin RPC: filas de la ventana ordenadas por fecha desc, gana la primera de cada símbolo
+            start_date = (date.fromisoformat(target_date) - timedelta(days=AS_OF_LOOKBACK_DAYS)).isoformat()
+            prices = dict.fromkeys(symbols)
+            prices.update(_first_price_per_symbol(
+                lambda chunk: supabase.table('market_data_history').select('symbol,date,price')
+                    .in_('symbol', chunk).gte('date', start_date).lte('date', target_date),
+                symbols))
+            
+            # Los que no cotizaron en la ventana: su última fila anterior, sin límite inferior
+            older = [symbol for symbol in symbols if prices[symbol] is None]
+            if older:
+                prices.update(_first_price_per_symbol(
+                    lambda chunk: supabase.table('market_data_history').select('symbol,date,price')
+                        .in_('symbol', chunk).lt('date', start_date),
+                    older))
+    
+    missing = [symbol for symbol in symbols if prices.get(symbol) is None]
+    if missing and HISTORY_COMPACTION_ENABLED:
+        try:
+            prices.update(_ohlc_prices_as_of(missing, target_date, supabase or get_supabase_client()))
+        except Exception as e:
+            logger.error("Error leyendo cierres OHLC a %s: %s", target_date, str(e))
+    
+    return prices
+
+def _iter_ohlc_closes(symbols, start_date, end_date, supabase):
+    """
+    Cierres OHLC de la parte del rango [start_date, end_date) sin filas
+    diarias, como filas (symbol, date, price) fechadas en el último día de
+    cada período: semanales hasta su retención y mensuales antes
+    """
+    daily_cutoff, weekly_cutoff = history_cutoffs()
+    end_date = min(end_date, daily_cutoff)
+    segments = (
+        ('monthly', start_date, min(end_date, weekly_cutoff)),
+        ('weekly', max(start_date, weekly_cutoff), end_date)
+    )
+    
+    for resolution, segment_start, segment_end in segments:
+        if segment_start >= segment_end:
+            continue
+        # date (inicio del período) acota la consulta al índice; end_date define a qué tramo pertenece
+        period_from = (date.fromisoformat(segment_start) - timedelta(days=31)).isoformat()
+        for start in range(0, len(symbols), AS_OF_SYMBOLS_PER_QUERY):
+            chunk = symbols[start:start + AS_OF_SYMBOLS_PER_QUERY]
+            offset = 0
+            while True:
+                rows = supabase.table('market_data_history_ohlc').select('symbol,date,end_date,close') \
+                    .eq('resolution', resolution).in_('symbol', chunk) \
+                    .gte('date', period_from).lt('date', segment_end) \
+                    .gte('end_date', segment_start).lt('end_date', segment_end) \
+                    .order('date').order('symbol').range(offset, offset + AS_OF_PAGE_SIZE - 1).execute().data or []
+                for row in rows:
+                    if row.get('close') is not None:
+                        yield {'symbol': row['symbol'], 'date': row['end_date'], 'price': row['close']}
+                if len(rows) < AS_OF_PAGE_SIZE:
+                    break
+                offset += AS_OF_PAGE_SIZE
+
+def iter_symbol_prices(symbols, start_date, end_date=None, supabase=None):
+    """
+    Filas (symbol, date, price) de varios símbolos en el rango, con consultas in_() paginadas
+    
+    Con la compactación activa, la parte del rango anterior al corte diario
+    se completa con los cierres semanales o mensuales.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    if not symbols:
+        return
+    
+    daily_cutoff = history_cutoffs()[0]
+    if HISTORY_COMPACTION_ENABLED and start_date < daily_cutoff:
+        supabase = supabase or get_supabase_client()
+        range_end = (date.fromisoformat(end_date) + timedelta(days=1)).isoformat() if end_date else daily_cutoff
+        yield from _iter_ohlc_closes(symbols, start_date, range_end, supabase)
+        start_date = daily_cutoff
+        if end_date and end_date < start_date:
+            return
+    
+    if market_history_mirror.is_synced():
+        yield from market_history_mirror.iter_prices(start_date, end_date, symbols)
+        return
+    
+    supabase = supabase or get_supabase_client()
+    for start in range(0, len(symbols), AS_OF_SYMBOLS_PER_QUERY):
+        chunk = symbols[start:start + AS_OF_SYMBOLS_PER_QUERY]
+        offset = 0
+        while True:
+            query = supabase.table('market_data_history').select('symbol,date,price') \
+                .in_('symbol', chunk).gte('date', start_date)
+            if end_date:
+                query = query.lte('date', end_date)
+            rows = query.order('date').order('symbol').range(offset, offset + AS_OF_PAGE_SIZE - 1).execute().data or []
+            yield from rows
+            if len(rows) < AS_OF_PAGE_SIZE:
+                break
+            offset += AS_OF_PAGE_SIZE
+
+def get_symbol_history(symbol, days=30, resolution='daily'):
+    """Obtiene el historial de un símbolo específico para los últimos N días
+    
+    Args:
+        symbol: Símbolo a consultar
+        days: Cantidad de días hacia atrás
+        resolution: 'daily' (cierre de cada día) o 'intraday' (cada snapshot)
+    
+    Returns:
+        Lista de registros ordenados del más reciente al más antiguo
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Resolución inválida: {resolution}. Opciones: {', '.join(RESOLUTIONS)}")
+    
     try:
         supabase = get_supabase_client()
         
         # Calcular fecha de inicio
-        from datetime import timedelta
         start_date = (date.today() - timedelta(days=days)).isoformat()
         
+        if resolution == 'intraday':
+            return get_intraday_history(symbol, start_date, supabase)
+        
+        if market_history_mirror.is_synced():
+            return market_history_mirror.query_history(symbol, start_date=start_date, limit=None)
+        
         result = supabase.table('market_data_history').select('*').eq('symbol', symbol).gte('date', start_date).order('date', desc=True).execute()
         
         return result.data
@@ -185,3 +987,33 @@ def get_symbol_history(symbol, days=30):
     except Exception as e:
         logger.error(f"Error al obtener historial de {symbol}: {str(e)}")
         return []
+
+def get_intraday_history(symbol, start_date, supabase=None, page_size=1000):
+    """Reconstruye la serie intradiaria de un símbolo desde start_date"""
+    supabase = supabase or get_supabase_client()
+    symbol = symbol.upper()
+    
+    rows = []
+    offset = 0
+    while True:
+        result = supabase.table('market_intraday_history').select('date,snapshot_at,payload') \
+            .gte('date', start_date).order('snapshot_at').range(offset, offset + page_size - 1).execute()
+        page = result.data or []
+        rows.extend(page)
+        offset += len(page)
+        if len(page) < page_size:
+            break
+    
+    series = []
+    for row, prices in decode_rows(rows):
+        if symbol in prices:
+            series.append({
+                'symbol': symbol,
+                'price': prices[symbol],
+                'date': row['date'],
+                'timestamp': row['snapshot_at'],
+                'source': 'intraday'
+            })
+    
+    series.reverse()
+    return series
@@ -0,0 +1,368 @@
+"""
+Réplica local (SQLite) de la tabla market_data_history
+
+La tabla remota se escribe pocas veces al día, pero se lee en cada página de
+historial y en cada valuación de cartera. Esta réplica sirve esas lecturas
+desde un archivo SQLite local indexado por (symbol, date) y (date, symbol).
+
+Uso como comando:
+    python market_history_store.py reconcile [--since YYYY-MM-DD]
+"""
+import os
+import sqlite3
+import threading
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import Config
+from leader_lock import FileLeaderLock
+
+logger = logging.getLogger(__name__)
+
+# Archivo de la réplica y si se usa para las lecturas
+MARKET_HISTORY_MIRROR_PATH = os.environ.get('MARKET_HISTORY_MIRROR_PATH',
+                                            os.path.join(Config.DATA_DIR, 'market_history.sqlite3'))
+MARKET_HISTORY_MIRROR_ENABLED = os.environ.get('MARKET_HISTORY_MIRROR_ENABLED', '1') == '1'
+
+# Segundos que la réplica se considera al día desde la última sincronización.
+# Pasado ese tiempo las lecturas vuelven a Supabase hasta que se resincroniza
+# (escrituras hechas por otros hosts o a mano no llegan por upsert_records)
+MIRROR_SYNC_TTL_SECONDS = int(os.environ.get('MIRROR_SYNC_TTL_SECONDS', str(6 * 3600)))
+
+# Días hacia atrás desde la última sincronización que relee la sincronización incremental
+MIRROR_RECONCILE_LOOKBACK_DAYS = int(os.environ.get('MIRROR_RECONCILE_LOOKBACK_DAYS', '7'))
+
+# Filas por página al sincronizar desde Supabase (límite por defecto de PostgREST)
+RECONCILE_PAGE_SIZE = 1000
+
+COLUMNS = ('symbol', 'date', 'price', 'raw_price', 'timestamp', 'source')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS market_data_history (
+    symbol TEXT NOT NULL,
+    date TEXT NOT NULL,
+    price REAL,
+    raw_price TEXT,
+    timestamp TEXT,
+    source TEXT,
+    PRIMARY KEY (symbol, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_market_data_history_date_symbol ON market_data_history (date, symbol);
+CREATE TABLE IF NOT EXISTS mirror_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class MarketHistoryMirror:
+    """Réplica de lectura de market_data_history en SQLite"""
+    
+    def __init__(self, path: str = MARKET_HISTORY_MIRROR_PATH, enabled: bool = MARKET_HISTORY_MIRROR_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._sync_lock = threading.Lock()
+        self._sync_thread = None
+        # Una sola sincronización a la vez entre hilos y entre procesos (workers de gunicorn)
+        self._reconcile_lock = threading.Lock()
+        self._reconcile_file_lock = FileLeaderLock(path + '.sync.lock', log_level=logging.DEBUG)
+    
+    def _connection(self) -> sqlite3.Connection:
+        """Conexión SQLite propia de cada hilo"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._ensure_schema(conn)
+        return conn
+    
+    def _ensure_schema(self, conn: sqlite3.Connection):
+        with self._schema_lock:
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._schema_ready = True
+    
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._connection().execute('SELECT value FROM mirror_meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else None
+    
+    def _set_meta(self, conn: sqlite3.Connection, key: str, value: str):
+        conn.execute('INSERT OR REPLACE INTO mirror_meta (key, value) VALUES (?, ?)', (key, value))
+    
+    def is_synced(self) -> bool:
+        """
+        Indica si la réplica puede servir lecturas
+        
+        Solo mientras la última sincronización tenga menos de
+        MIRROR_SYNC_TTL_SECONDS. Si nunca se sincronizó o la sincronización
+        venció se lanza una en segundo plano (completa o incremental) y,
+        mientras tanto, las lecturas siguen yendo a Supabase.
+        """
+        if not self.enabled:
+            return False
+        try:
+            last_reconciled_at = self._get_meta('last_reconciled_at')
+        except sqlite3.Error as e:
+            logger.error("Error leyendo réplica local de historial: %s", str(e))
+            return False
+        
+        if self._is_fresh(last_reconciled_at):
+            return True
+        
+        self.reconcile_in_background(self._incremental_since(last_reconciled_at))
+        return False
+    
+    @staticmethod
+    def _is_fresh(last_reconciled_at: Optional[str]) -> bool:
+        return bool(last_reconciled_at) and \
+            (datetime.now() - datetime.fromisoformat(last_reconciled_at)).total_seconds() < MIRROR_SYNC_TTL_SECONDS
+    
+    @staticmethod
+    def _incremental_since(last_reconciled_at: Optional[str]) -> Optional[str]:
+        """Fecha desde la que resincronizar (None = completa si nunca se sincronizó)"""
+        if not last_reconciled_at:
+            return None
+        last_day = datetime.fromisoformat(last_reconciled_at).date()
+        return (last_day - timedelta(days=MIRROR_RECONCILE_LOOKBACK_DAYS)).isoformat()
+    
+    def reconcile_in_background(self, since: Optional[str] = None):
+        """Lanza una sincronización en un hilo (una sola a la vez)"""
+        with self._sync_lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                return
+            self._sync_thread = threading.Thread(target=self._safe_reconcile, args=(since,), daemon=True)
+            self._sync_thread.start()
+    
+    def _safe_reconcile(self, since: Optional[str] = None):
+        try:
+            # Si otro worker ya la sincronizó mientras tanto no se repite
+            self.reconcile(since=since, only_if_stale=True)
+        except Exception as e:
+            logger.error("Error sincronizando réplica local de historial: %s", str(e))
+    
+    def reconcile_incremental(self, supabase=None) -> Dict:
+        """
+        Resincroniza los últimos MIRROR_RECONCILE_LOOKBACK_DAYS días desde la
+        última sincronización (completa si nunca se sincronizó)
+        """
+        if not self.enabled:
+            return {'rows_copied': 0, 'since': None, 'duration_seconds': 0}
+        return self.reconcile(since=self._incremental_since(self._get_meta('last_reconciled_at')),
+                              supabase=supabase)
+    
+    def upsert_records(self, records: Iterable[Dict]):
+        """Inserta o actualiza filas (mismo criterio que on_conflict='symbol,date')"""
+        if not self.enabled:
+            return
+        rows = [tuple(record.get(column) for column in COLUMNS) for record in records]
+        if not rows:
+            return
+        try:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO market_data_history (symbol, date, price, raw_price, timestamp, source) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+        except sqlite3.Error as e:
+            logger.error("Error actualizando réplica local de historial: %s", str(e))
+    
+    def reconcile(self, since: Optional[str] = None, supabase=None, only_if_stale: bool = False) -> Dict:
+        """
+        Resincroniza la réplica desde Supabase
+        
+        Toma un lock de archivo junto a la réplica: si otro hilo o proceso ya
+        está sincronizando, esta llamada no hace nada (skipped=True).
+        
+        Args:
+            since: Solo resincronizar desde esta fecha (YYYY-MM-DD). Si es None
+                   se reemplaza la réplica completa
+            supabase: Cliente a usar (por defecto el compartido)
+            only_if_stale: Omitir si la última sincronización sigue vigente
+        
+        Returns:
+            Diccionario con filas copiadas y duración
+        """
+        skipped = {'rows_copied': 0, 'since': since, 'duration_seconds': 0, 'skipped': True}
+        if not self._reconcile_lock.acquire(blocking=False):
+            return skipped
+        try:
+            if not self._reconcile_file_lock.try_acquire():
+                logger.info("Otro proceso está sincronizando la réplica de historial, se omite")
+                return skipped
+            try:
+                if only_if_stale and self._is_fresh(self._get_meta('last_reconciled_at')):
+                    return skipped
+                return self._reconcile(since, supabase)
+            finally:
+                self._reconcile_file_lock.release()
+        finally:
+            self._reconcile_lock.release()
+    
+    def _reconcile(self, since: Optional[str], supabase) -> Dict:
+        if supabase is None:
+            from supabase_client import get_supabase_client
+            supabase = get_supabase_client()
+        
+        started = datetime.now()
+        conn = self._connection()
+        copied = 0
+        offset = 0
+        
+        with conn:
+            if since:
+                conn.execute('DELETE FROM market_data_history WHERE date >= ?', (since,))
+            else:
+                conn.execute('DELETE FROM market_data_history')
+            
+            while True:
+                query = supabase.table('market_data_history').select(','.join(COLUMNS))
+                if since:
+                    query = query.gte('date', since)
+                result = query.order('date').order('symbol').range(offset, offset + RECONCILE_PAGE_SIZE - 1).execute()
+                rows = result.data or []
+                
+                conn.executemany(
+                    'INSERT OR REPLACE INTO market_data_history (symbol, date, price, raw_price, timestamp, source) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [tuple(row.get(column) for column in COLUMNS) for row in rows]
+                )
+                copied += len(rows)
+                offset += len(rows)
+                
+                if len(rows) < RECONCILE_PAGE_SIZE:
+                    break
+            
+            self._set_meta(conn, 'last_reconciled_at', datetime.now().isoformat())
+        
+        duration = (datetime.now() - started).total_seconds()
+        logger.info("✅ Réplica de historial sincronizada: %s filas en %.1fs", copied, duration)
+        return {'rows_copied': copied, 'since': since, 'duration_seconds': round(duration, 3)}
+    
+    def delete_before(self, cutoff_date: str):
+        """Borra las filas anteriores a cutoff_date (retención del historial diario)"""
+        if not self.enabled:
+            return
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM market_data_history WHERE date < ?', (cutoff_date,))
+        except sqlite3.Error as e:
+            logger.error("Error podando réplica local de historial: %s", str(e))
+    
+    def query_history(self, symbol: Optional[str] = None, start_date: Optional[str] = None,
+                      end_date: Optional[str] = None, limit: Optional[int] = 100,
+                      after: Optional[Tuple[str, str]] = None) -> List[Dict]:
+        """
+        Equivalente local de get_market_history (orden: date desc, symbol asc)
+        
+        Args:
+            after: (date, symbol) de la última fila de la página anterior (keyset)
+        """
+        conditions = []
+        params = []
+        if after:
+            conditions.append('(date < ? OR (date = ? AND symbol > ?))')
+            params.extend([after[0], after[0], after[1]])
+        if symbol:
+            conditions.append('symbol = ?')
+            params.append(symbol)
+        if start_date:
+            conditions.append('date >= ?')
+            params.append(start_date)
+        if end_date:
+            conditions.append('date <= ?')
+            params.append(end_date)
+        
+        sql = 'SELECT symbol, date, price, raw_price, timestamp, source FROM market_data_history'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY date DESC, symbol'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        
+        return [dict(row) for row in self._connection().execute(sql, params)]
+    
+    def iter_prices(self, start_date: str, end_date: Optional[str] = None,
+                    symbols: Optional[List[str]] = None) -> Iterable[Dict]:
+        """Filas (symbol, date, price) con precio en el rango, para armar series"""
+        conditions = ['date >= ?', 'price IS NOT NULL']
+        params = [start_date]
+        if end_date:
+            conditions.append('date <= ?')
+            params.append(end_date)
+        if symbols and len(symbols) == 1:
+            conditions.append('symbol = ?')
+            params.append(symbols[0])
+        elif symbols and len(symbols) <= 500:
+            conditions.append(f"symbol IN ({','.join('?' * len(symbols))})")
+            params.extend(symbols)
+        
+        sql = 'SELECT symbol, date, price FROM market_data_history WHERE ' + ' AND '.join(conditions)
+        for row in self._connection().execute(sql, params):
+            yield dict(row)
+    
+    def latest_prices(self) -> List[Dict]:
+        """Última fila con precio de cada símbolo"""
+        sql = (
+            'SELECT m.symbol, m.date, m.price, m.timestamp, m.source FROM market_data_history m '
+            'JOIN (SELECT symbol, MAX(date) AS date FROM market_data_history '
+            '      WHERE price IS NOT NULL GROUP BY symbol) latest '
+            'ON m.symbol = latest.symbol AND m.date = latest.date'
+        )
+        return [dict(row) for row in self._connection().execute(sql)]
+    
+    def previous_close(self, before_date: str) -> Dict[str, float]:
+        """Precios del último día con datos anterior a before_date"""
+        sql = (
+            'SELECT symbol, price FROM market_data_history '
+            'WHERE date = (SELECT MAX(date) FROM market_data_history WHERE date < ?) AND price IS NOT NULL'
+        )
+        return {row['symbol']: row['price'] for row in self._connection().execute(sql, (before_date,))}
+    
+    def prices_as_of(self, symbols: Iterable[str], target_date: str) -> Dict[str, Optional[float]]:
+        """Último precio de cada símbolo en o antes de target_date (None si no hay)"""
+        conn = self._connection()
+        symbols = list(dict.fromkeys(symbols))
+        prices = dict.fromkeys(symbols)
+        # Una consulta por bloque de símbolos (límite de parámetros de SQLite)
+        for start in range(0, len(symbols), 500):
+            chunk = symbols[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            sql = (
+                'SELECT m.symbol, m.price FROM market_data_history m '
+                'JOIN (SELECT symbol, MAX(date) AS date FROM market_data_history '
+                f'      WHERE symbol IN ({placeholders}) AND date <= ? AND price IS NOT NULL '
+                '      GROUP BY symbol) as_of '
+                'ON m.symbol = as_of.symbol AND m.date = as_of.date'
+            )
+            for row in conn.execute(sql, chunk + [target_date]):
+                prices[row['symbol']] = float(row['price'])
+        return prices
+
+# Instancia global de la réplica
+market_history_mirror = MarketHistoryMirror()
+
+def main():
+    parser = argparse.ArgumentParser(description='Réplica local de market_data_history')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    reconcile_parser = subparsers.add_parser('reconcile', help='Resincronizar la réplica desde Supabase')
+    reconcile_parser.add_argument('--since', help='Resincronizar solo desde esta fecha (YYYY-MM-DD)')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'reconcile':
+        result = market_history_mirror.reconcile(since=args.since)
+        print(f"Filas copiadas: {result['rows_copied']} en {result['duration_seconds']}s")
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,184 @@
 import schedule
-import time
 import threading
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 import logging
-from market_history_model import save_daily_snapshot
+from market_history_model import compact_market_history, HISTORY_COMPACTION_ENABLED
+from market_history_store import market_history_mirror
+from snapshot_pipeline import run_snapshot_pipeline
+from leader_lock import FileLeaderLock
+from job_history import JobRunHistory
+from job_queue import JobQueue, ACTIVE_STATUSES
+from trading_calendar import TradingCalendar
+from config import Config
+import os
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Hora de la compactación diaria del historial (fuera del horario de snapshots)
+HISTORY_COMPACTION_TIME = os.environ.get('HISTORY_COMPACTION_TIME', '02:00')
+
+# Minutos entre sincronizaciones incrementales de la réplica local del historial
+MIRROR_RECONCILE_INTERVAL_MINUTES = int(os.environ.get('MIRROR_RECONCILE_INTERVAL_MINUTES', '60'))
+
+# Lock compartido por los workers: solo el que lo obtiene ejecuta los jobs
+SCHEDULER_LOCK_FILE = os.environ.get('SCHEDULER_LOCK_FILE', os.path.join(Config.DATA_DIR, 'market_scheduler.lock'))
+
+# Segundos entre reintentos de los procesos pasivos para tomar el liderazgo
+SCHEDULER_LEADER_RETRY_SECONDS = float(os.environ.get('SCHEDULER_LEADER_RETRY_SECONDS', '30'))
+
+# Espera máxima antes de recalcular la próxima ejecución (cambios de hora del sistema)
+SCHEDULER_MAX_SLEEP_SECONDS = 300
+
+# Historial de corridas (buffer circular persistido)
+SCHEDULER_HISTORY_FILE = os.environ.get('SCHEDULER_HISTORY_FILE', os.path.join(Config.DATA_DIR, 'scheduler_runs.json'))
+SCHEDULER_HISTORY_SIZE = int(os.environ.get('SCHEDULER_HISTORY_SIZE', '200'))
+
+# Hilos para ejecutar los jobs (un snapshot lento no demora a los demás)
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', '2'))
+
+# Estado de los jobs en cola/ejecución, compartido entre workers para consultar el progreso
+SCHEDULER_JOBS_FILE = os.environ.get('SCHEDULER_JOBS_FILE', os.path.join(Config.DATA_DIR, 'scheduler_jobs.json'))
+
+class CalendarJob(schedule.Job):
+    """Job cuya próxima ejecución la define el calendario de mercado"""
+    
+    def __init__(self, calendar, scheduler):
+        super().__init__(interval=1, scheduler=scheduler)
+        self.calendar = calendar
+    
+    def _schedule_next_run(self):
+        next_snapshot = self.calendar.next_snapshot_time()
+        if next_snapshot is None:
+            # Sin ruedas configuradas: volver a consultar el calendario mañana
+            self.next_run = datetime.now() + timedelta(days=1)
+            return
+        # schedule trabaja con la hora local del servidor sin zona horaria
+        self.next_run = next_snapshot.astimezone().replace(tzinfo=None)
+    
+    def __repr__(self):
+        return f"CalendarJob(next_run={self.next_run})"
+
 class MarketDataScheduler:
     """Programador para tareas automáticas de datos de mercado"""
     
-    def __init__(self):
+    def __init__(self, lock_path=SCHEDULER_LOCK_FILE, history_path=SCHEDULER_HISTORY_FILE, calendar=None,
+                 jobs_path=SCHEDULER_JOBS_FILE):
         self.running = False
+        self.calendar = calendar or TradingCalendar()
         self.thread = None
+        self.leader_lock = FileLeaderLock(lock_path)
+        self.history = JobRunHistory(history_path, SCHEDULER_HISTORY_SIZE)
+        self.scheduler = schedule.Scheduler()
+        self._wakeup = threading.Event()
+        self.jobs = JobQueue(SCHEDULER_WORKERS, jobs_path, thread_name_prefix='market-job')
         self._setup_schedule()
     
     def _setup_schedule(self):
         """Configura las tareas programadas"""
-        # Programar el snapshot diario 5 veces al día
-        schedule.every().day.at("09:00").do(self._run_snapshot)
-        schedule.every().day.at("12:00").do(self._run_snapshot)
-        schedule.every().day.at("15:00").do(self._run_snapshot)
-        schedule.every().day.at("18:00").do(self._run_snapshot)
-        schedule.every().day.at("21:00").do(self._run_snapshot)
+        # Snapshots según el calendario: durante la rueda y al cierre, solo días hábiles
+        CalendarJob(self.calendar, self.scheduler).do(self._submit, 'snapshot', self._run_snapshot)
+        
+        calendar = self.calendar.describe()
+        logger.info("Scheduler configurado: snapshots cada %s min de %s (%s) más cierre; próximo %s",
+                    calendar['interval_minutes'], calendar['hours'], calendar['timezone'], calendar['next_snapshot'])
+        
+        if HISTORY_COMPACTION_ENABLED:
+            self.scheduler.every().day.at(HISTORY_COMPACTION_TIME).do(self._submit, 'compaction', self._run_compaction)
+            logger.info("Compactación del historial programada a las %s", HISTORY_COMPACTION_TIME)
+        
+        if market_history_mirror.enabled:
+            self.scheduler.every(MIRROR_RECONCILE_INTERVAL_MINUTES).minutes.do(
+                self._submit, 'mirror_reconcile', self._run_mirror_reconcile)
+            logger.info("Sincronización de la réplica local cada %s min", MIRROR_RECONCILE_INTERVAL_MINUTES)
+    
+    def _submit(self, name, func, trigger='scheduled'):
+        """
+        Envía el job a la cola sin bloquear
+        
+        Si el mismo job sigue encolado o corriendo en cualquier worker (por
+        ejemplo un snapshot lento, o un snapshot manual pedido dos veces) no
+        se encola otro: se devuelve el job activo.
+        
+        Returns:
+            Tupla (job, creado) de JobQueue.submit
+        """
+        job, created = self.jobs.submit(name, lambda report: self._run_and_record(name, trigger, func, report),
+                                        trigger)
+        if not created:
+            logger.warning("Job %s todavía en ejecución (%s), se omite esta corrida", name, job['id'])
+        return job, created
+    
+    def _run_and_record(self, name, trigger, func, report=None):
+        """Ejecuta el job y guarda la corrida en el historial"""
+        started_at = datetime.now()
+        started = time.perf_counter()
+        summary = func(report) or {}
+        errors = summary.get('errors', [])
         
-        logger.info("Scheduler configurado: snapshots a las 09:00, 12:00, 15:00, 18:00 y 21:00")
+        self.history.record({
+            'job': name,
+            'trigger': trigger,
+            'started_at': started_at.isoformat(),
+            'duration_seconds': round(time.perf_counter() - started, 3),
+            'success': bool(summary.get('success')),
+            'rows_fetched': summary.get('rows_fetched', summary.get('rows_read')),
+            'rows_written': summary.get('rows_written', summary.get('periods_written')),
+            'fetch_seconds': summary.get('fetch_seconds'),
+            'write_seconds': summary.get('write_seconds'),
+            'stages': summary.get('stages'),
+            'errors_count': len(errors),
+            'errors': errors[:3]
+        })
+        return summary
     
-    def _run_snapshot(self):
+    def _run_snapshot(self, report=None):
         """Ejecuta el snapshot diario"""
         try:
             logger.info(f"Iniciando snapshot automático - {datetime.now()}")
-            success = save_daily_snapshot()
+            summary = run_snapshot_pipeline(progress=report)
             
-            if success:
-                logger.info("Snapshot automático completado exitosamente")
+            if summary['success']:
+                logger.info("Snapshot automático completado exitosamente: %s filas en %ss (etapas: %s)",
+                            summary['rows_written'], summary['duration_seconds'], summary['stages'])
             else:
-                logger.warning("Snapshot automático falló")
+                logger.warning("Snapshot automático falló: %s", summary['errors'][:3])
+            return summary
                 
         except Exception as e:
             logger.error(f"Error en snapshot automático: {str(e)}")
+            return {'success': False, 'errors': [{'error': str(e)}]}
+    
+    def _run_compaction(self, report=None):
+        """Ejecuta la compactación del historial (OHLC semanal/mensual y poda)"""
+        try:
+            logger.info("Iniciando compactación del historial - %s", datetime.now())
+            summary = compact_market_history()
+            
+            if summary['success']:
+                logger.info("Compactación completada: %s períodos, %s filas diarias podadas en %ss",
+                            summary['periods_written'], summary['daily_rows_deleted'], summary['duration_seconds'])
+            else:
+                logger.warning("Compactación falló: %s", summary['errors'][:3])
+            return summary
+                
+        except Exception as e:
+            logger.error("Error en compactación del historial: %s", str(e))
+            return {'success': False, 'errors': [{'error': str(e)}]}
+    
+    def _run_mirror_reconcile(self, report=None):
+        """Sincroniza la réplica local con los últimos días de Supabase"""
+        try:
+            summary = market_history_mirror.reconcile_incremental()
+            logger.info("Réplica local sincronizada desde %s: %s filas en %ss",
+                        summary['since'], summary['rows_copied'], summary['duration_seconds'])
+            return dict(summary, success=True, rows_written=summary['rows_copied'])
+                
+        except Exception as e:
+            logger.error("Error sincronizando réplica local: %s", str(e))
+            return {'success': False, 'errors': [{'error': str(e)}]}
     
     def start(self):
         """Inicia el scheduler en un hilo separado"""
@@ -49,46 +187,94 @@ class MarketDataScheduler:
             return
         
         self.running = True
+        self._wakeup.clear()
         self.thread = threading.Thread(target=self._run_scheduler, daemon=True)
         self.thread.start()
         logger.info("Market Data Scheduler iniciado en hilo separado")
     
     def stop(self):
-        """Detiene el scheduler"""
+        """Detiene el scheduler (no espera a los jobs en curso)"""
         self.running = False
-        if self.thread:
-            self.thread.join(timeout=5)
+        self._wakeup.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.jobs.shutdown()
+        self.leader_lock.release()
         logger.info("Market Data Scheduler detenido")
     
+    def _ensure_leader(self):
+        """
+        True si este proceso es el líder; si no lo era, intenta serlo
+        
+        Al asumir el liderazgo los jobs vencidos mientras el proceso estaba
+        pasivo se ejecutan una vez en el próximo run_pending (el líder anterior
+        pudo caerse antes de correrlos). Si ya los había hecho, el snapshot se
+        omite por el hash de contenido y la sincronización/compactación son
+        idempotentes.
+        """
+        if self.leader_lock.is_leader:
+            return True
+        if not self.leader_lock.try_acquire():
+            return False
+        
+        now = datetime.now()
+        overdue = [job for job in self.scheduler.get_jobs() if job.next_run and job.next_run <= now]
+        if overdue:
+            logger.info("Liderazgo asumido: %s jobs vencidos se ejecutan ahora", len(overdue))
+        return True
+    
+    def _seconds_until_next_job(self):
+        """Segundos hasta el próximo job (0 si ya venció)"""
+        idle = self.scheduler.idle_seconds
+        if idle is None:
+            return SCHEDULER_MAX_SLEEP_SECONDS
+        return max(0.0, min(idle, SCHEDULER_MAX_SLEEP_SECONDS))
+    
     def _run_scheduler(self):
-        """Bucle principal del scheduler"""
+        """Bucle principal: duerme hasta el próximo job y se despierta al detenerse"""
         logger.info("Bucle del scheduler iniciado")
         
         while self.running:
             try:
-                schedule.run_pending()
-                time.sleep(60)  # Verificar cada minuto
+                # Los procesos pasivos solo reintentan tomar el lock (failover)
+                if not self._ensure_leader():
+                    self._wakeup.wait(SCHEDULER_LEADER_RETRY_SECONDS)
+                    continue
+                
+                self.scheduler.run_pending()
+                self._wakeup.wait(self._seconds_until_next_job())
             except Exception as e:
                 logger.error(f"Error en bucle del scheduler: {str(e)}")
-                time.sleep(60)
+                self._wakeup.wait(SCHEDULER_LEADER_RETRY_SECONDS)
         
         logger.info("Bucle del scheduler terminado")
     
-    def run_manual_snapshot(self):
-        """Ejecuta un snapshot manual (para botón en interfaz)"""
+    def run_manual_snapshot(self, force=False):
+        """
+        Encola un snapshot manual (para botón en interfaz) y vuelve enseguida
+        
+        Returns:
+            Tupla (job, creado): si ya hay un snapshot en curso se devuelve ese job
+        """
+        logger.info("Encolando snapshot manual")
+        return self._submit('snapshot', lambda report: self._manual_snapshot(force, report), 'manual')
+    
+    def _manual_snapshot(self, force=False, report=None):
         try:
-            logger.info("Iniciando snapshot manual")
-            success = save_daily_snapshot()
-            return success
+            return run_snapshot_pipeline(force=force, progress=report)
         except Exception as e:
             logger.error(f"Error en snapshot manual: {str(e)}")
-            return False
+            return {'success': False, 'errors': [{'error': str(e)}]}
+    
+    def get_job(self, job_id):
+        """Estado y progreso de un job encolado"""
+        return self.jobs.get(job_id)
     
     def get_next_run_time(self):
         """Obtiene la hora de la próxima ejecución programada"""
         try:
-            next_run = schedule.next_run()
-            return next_run.strftime("%H:%M:%S") if next_run else "No programado"
+            next_run = self.scheduler.next_run
+            return next_run.strftime("%Y-%m-%d %H:%M:%S") if next_run else "No programado"
         except:
             return "Error"
     
@@ -96,9 +282,20 @@ class MarketDataScheduler:
         """Obtiene el estado del scheduler"""
         return {
             'running': self.running,
+            'leader': self.leader_lock.is_leader,
+            'leader_process': self.leader_lock.describe_leader(),
+            'pid': os.getpid(),
             'next_run': self.get_next_run_time(),
-            'jobs_count': len(schedule.jobs),
-            'current_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            'jobs_count': len(self.scheduler.jobs),
+            'current_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'calendar': self.calendar.describe(),
+            'metrics': {
+                'snapshot': self.history.stats('snapshot'),
+                'compaction': self.history.stats('compaction'),
+                'mirror_reconcile': self.history.stats('mirror_reconcile')
+            },
+            'recent_runs': self.history.runs(limit=10),
+            'active_jobs': [job for job in self.jobs.jobs() if job['status'] in ACTIVE_STATUSES]
         }
 
 # Instancia global del scheduler
@@ -112,9 +309,13 @@ def stop_scheduler():
     """Función de conveniencia para detener el scheduler"""
     market_scheduler.stop()
 
-def manual_snapshot():
-    """Función de conveniencia para snapshot manual"""
-    return market_scheduler.run_manual_snapshot()
+def manual_snapshot(force=False):
+    """Función de conveniencia para encolar un snapshot manual; devuelve (job, creado)"""
+    return market_scheduler.run_manual_snapshot(force)
+
+def get_job_status(job_id):
+    """Función de conveniencia para consultar un job encolado"""
+    return market_scheduler.get_job(job_id)
 
 def get_scheduler_status():
     """Función de conveniencia para obtener el estado"""
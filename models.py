@@ -1,11 +1,12 @@
-from supabase import create_client, Client
+from supabase import Client
 from config import Config
+from supabase_client import get_supabase_client
 from datetime import datetime, timedelta
 import logging
 
 class Database:
     def __init__(self):
-        self.supabase: Client = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+        self.supabase: Client = get_supabase_client('auth')
         self.access_token = None
     
     def set_auth_token(self, access_token):
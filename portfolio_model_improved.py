@@ -1,21 +1,40 @@
-from supabase import create_client, Client
-from datetime import datetime, date
+from supabase_client import get_supabase_client
+from market_history_model import (latest_price_index, get_prices_as_of, iter_symbol_prices, history_cutoffs,
+                                  HISTORY_COMPACTION_ENABLED)
+from market_analytics import build_price_matrix, portfolio_value_series, VALUE_SERIES_FREQUENCIES
+from datetime import datetime, date, timedelta
 import os
 import logging
+import numpy as np
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_supabase_client() -> Client:
-    """Obtiene el cliente de Supabase"""
-    url = os.environ.get("SUPABASE_URL")
-    key = os.environ.get("SUPABASE_KEY")
-    
-    if not url or not key:
-        raise ValueError("SUPABASE_URL y SUPABASE_ANON_KEY deben estar configurados")
-    
-    return create_client(url, key)
+# Valuaciones precalculadas: el snapshot revalúa todas las carteras después de
+# guardar los precios y las páginas leen la última fila de cada cartera.
+# Tabla en Supabase:
+#   CREATE TABLE portfolio_valuations (
+#       portfolio_id BIGINT NOT NULL REFERENCES portfolios(id) ON DELETE CASCADE,
+#       date DATE NOT NULL,
+#       total_value NUMERIC NOT NULL,
+#       positions_detail JSONB NOT NULL,
+#       symbols_not_found JSONB NOT NULL,
+#       calculation_date DATE NOT NULL,
+#       computed_at TIMESTAMPTZ NOT NULL,
+#       PRIMARY KEY (portfolio_id, date)
+#   );
+PORTFOLIO_VALUATION_CHUNK_SIZE = int(os.environ.get('PORTFOLIO_VALUATION_CHUNK_SIZE', '200'))
+
+# Antigüedad máxima (días) de una valuación guardada antes de recalcularla al leerla
+PORTFOLIO_VALUATION_MAX_AGE_DAYS = int(os.environ.get('PORTFOLIO_VALUATION_MAX_AGE_DAYS', '7'))
+
+# Rango máximo (días) de la curva de valor de una cartera
+MAX_VALUE_SERIES_DAYS = int(os.environ.get('MAX_VALUE_SERIES_DAYS', str(10 * 365)))
+
+# Carteras por consulta in_() y filas por página en las lecturas por lote
+PORTFOLIO_IDS_PER_QUERY = 100
+POSITIONS_PAGE_SIZE = 1000
 
 class PortfolioManager:
     """Gestiona carteras de inversión por organismo"""
@@ -82,6 +101,7 @@ class PortfolioManager:
             
             if result.data:
                 logger.info("Posición agregada/actualizada: %s en cartera %s", symbol, portfolio_id)
+                self.store_valuation(portfolio_id)
                 return result.data[0]
             else:
                 logger.error("Error al agregar posición")
@@ -105,6 +125,7 @@ class PortfolioManager:
             
             if result.data:
                 logger.info("Posición actualizada: %s en cartera %s", symbol, portfolio_id)
+                self.store_valuation(portfolio_id)
                 return result.data[0]
             else:
                 logger.warning("No se encontró posición %s en cartera %s", symbol, portfolio_id)
@@ -130,6 +151,7 @@ class PortfolioManager:
             
             if result.data:
                 logger.info("Posición eliminada: %s de cartera %s", symbol, portfolio_id)
+                self.store_valuation(portfolio_id)
                 return True
             else:
                 logger.warning("No se encontró posición %s en cartera %s", symbol, portfolio_id)
@@ -150,139 +172,225 @@ class PortfolioManager:
         Returns:
             Diccionario con el valor total y detalle de posiciones
         """
+        return self.value_portfolios([portfolio_id], target_date).get(portfolio_id)
+    
+    def value_portfolios(self, portfolio_ids, target_date=None):
+        """
+        Valúa varias carteras a la vez: una consulta de posiciones para todas,
+        una de precios para la unión de sus símbolos y el cálculo en memoria
+        
+        Args:
+            portfolio_ids: IDs de las carteras
+            target_date: Fecha específica (YYYY-MM-DD), si es None usa la fecha actual
+        
+        Returns:
+            {portfolio_id: valuación como calculate_portfolio_value}; las carteras
+            que no se pudieron valuar no se incluyen ({} si falla la carga de datos)
+        """
         try:
-            positions = self.get_portfolio_positions(portfolio_id)
-            
-            if not positions:
-                return {
-                    'total_value': 0,
-                    'calculation_date': target_date or date.today().isoformat(),
-                    'positions_detail': [],
-                    'symbols_not_found': []
-                }
-            
             # Usar fecha actual si no se especifica
-            if not target_date:
-                target_date = date.today().isoformat()
-            
-            # Obtener precios históricos para esa fecha
-            prices = self._get_historical_prices([pos['symbol'] for pos in positions], target_date)
+            target_date = target_date or date.today().isoformat()
             
-            positions_detail = []
-            total_value = 0
-            symbols_not_found = []
-            
-            for position in positions:
-                symbol = position['symbol']
-                quantity = float(position['quantity'])
-                current_price = prices.get(symbol)
-                
-                if current_price is None:
-                    # Intentar con el precio más reciente disponible
-                    current_price = self._get_latest_price_for_symbol(symbol)
-                    if current_price is None:
-                        current_price = 0
-                        symbols_not_found.append(symbol)
-                
-                position_value = quantity * current_price
-                
-                positions_detail.append({
-                    'symbol': symbol,
-                    'quantity': quantity,
-                    'current_price': current_price,
-                    'position_value': position_value,
-                    'notes': position.get('notes', ''),
-                    'updated_at': position.get('updated_at', '')
-                })
-                
-                total_value += position_value
+            positions_by_portfolio = self._get_positions_by_portfolio(portfolio_ids)
+            symbols = list(dict.fromkeys(pos['symbol'] for positions in positions_by_portfolio.values()
+                                         for pos in positions))
             
-            # Calcular porcentajes de peso
-            for detail in positions_detail:
-                detail['weight_percentage'] = (detail['position_value'] / total_value * 100) if total_value > 0 else 0
+            # Obtener precios históricos para esa fecha
+            prices = self._get_historical_prices(symbols, target_date) if symbols else {}
+            
+            # Valuación de hoy: los símbolos sin precio usan el más reciente disponible (en un solo paso).
+            # Para fechas pasadas no: un precio posterior a la fecha falsearía la valuación histórica
+            missing = [symbol for symbol in symbols if prices.get(symbol) is None]
+            if missing and target_date >= date.today().isoformat():
+                prices.update(self._get_latest_prices_for_symbols(missing))
+            
+            # Una posición con datos inválidos solo deja afuera a su cartera, no al bloque
+            valuations = {}
+            for portfolio_id in portfolio_ids:
+                try:
+                    valuations[portfolio_id] = self._build_valuation(positions_by_portfolio.get(portfolio_id, []),
+                                                                     prices, target_date)
+                except Exception as e:
+                    logger.error("Error valuando cartera %s: %s", portfolio_id, str(e))
+            return valuations
             
-            return {
-                'total_value': total_value,
-                'calculation_date': target_date,
-                'positions_detail': positions_detail,
-                'symbols_not_found': symbols_not_found
-            }
+        except Exception as e:
+            logger.error("Error valuando carteras %s: %s", list(portfolio_ids)[:10], str(e))
+            return {}
+    
+    def value_series(self, portfolio_id, start_date, end_date=None, freq='daily'):
+        """
+        Curva de valor de la cartera entre dos fechas con las posiciones actuales
+        
+        Carga las posiciones y la matriz de precios una sola vez (precio a
+        start_date como punto de partida más las filas del rango) y calcula
+        valor, cambio y aporte de cada posición de forma vectorizada. Con la
+        compactación activa, el tramo anterior al corte diario se arma con los
+        cierres semanales o mensuales (daily_from indica desde cuándo hay
+        resolución diaria).
+        
+        Args:
+            portfolio_id: ID de la cartera
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD), por defecto hoy
+            freq: daily, weekly o monthly (último día con datos de cada período)
+        
+        Returns:
+            Diccionario de portfolio_value_series más el rango pedido y
+            daily_from, o None si hay error
+        
+        Raises:
+            ValueError: Si las fechas o la frecuencia no son válidas
+        """
+        if freq not in VALUE_SERIES_FREQUENCIES:
+            raise ValueError(f"Frecuencia inválida: {freq} (use {', '.join(VALUE_SERIES_FREQUENCIES)})")
+        end_date = end_date or date.today().isoformat()
+        start_day, end_day = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        if start_day > end_day:
+            raise ValueError("La fecha de inicio debe ser anterior a la de fin")
+        if (end_day - start_day).days > MAX_VALUE_SERIES_DAYS:
+            raise ValueError(f"Rango máximo de {MAX_VALUE_SERIES_DAYS} días")
+        
+        try:
+            positions = self.get_portfolio_positions(portfolio_id)
+            quantities = {pos['symbol'].upper(): float(pos['quantity']) for pos in positions}
+            symbols = list(quantities)
+            
+            # Punto de partida: último precio de cada símbolo en o antes de start_date
+            start_prices = get_prices_as_of(symbols, start_date, self.supabase) if symbols else {}
+            rows = [{'symbol': symbol, 'date': start_date, 'price': price}
+                    for symbol, price in start_prices.items() if price is not None]
+            rows.extend(iter_symbol_prices(symbols, (start_day + timedelta(days=1)).isoformat(), end_date,
+                                           self.supabase))
+            
+            dates, columns, prices = build_price_matrix(rows, symbols)
+            series = portfolio_value_series(dates, columns, prices,
+                                            np.array([quantities[symbol] for symbol in columns]), freq)
+            daily_from = max(start_date, history_cutoffs()[0]) if HISTORY_COMPACTION_ENABLED else start_date
+            series.update({
+                'portfolio_id': portfolio_id,
+                'start_date': start_date,
+                'end_date': end_date,
+                'freq': freq,
+                'daily_from': daily_from if daily_from <= end_date else None
+            })
+            return series
             
         except Exception as e:
-            logger.error("Error calculando valor de cartera %s: %s", portfolio_id, str(e))
+            logger.error("Error calculando curva de valor de cartera %s: %s", portfolio_id, str(e))
             return None
     
+    def _get_positions_by_portfolio(self, portfolio_ids):
+        """{portfolio_id: posiciones ordenadas por símbolo} con una consulta por bloque de carteras"""
+        portfolio_ids = list(dict.fromkeys(portfolio_ids))
+        positions_by_portfolio = {}
+        
+        for start in range(0, len(portfolio_ids), PORTFOLIO_IDS_PER_QUERY):
+            chunk = portfolio_ids[start:start + PORTFOLIO_IDS_PER_QUERY]
+            offset = 0
+            while True:
+                result = self.supabase.table('portfolio_positions').select('*').in_('portfolio_id', chunk) \
+                    .order('portfolio_id').order('symbol').range(offset, offset + POSITIONS_PAGE_SIZE - 1).execute()
+                rows = result.data or []
+                for position in rows:
+                    positions_by_portfolio.setdefault(position['portfolio_id'], []).append(position)
+                if len(rows) < POSITIONS_PAGE_SIZE:
+                    break
+                offset += POSITIONS_PAGE_SIZE
+        
+        return positions_by_portfolio
+    
+    @staticmethod
+    def _build_valuation(positions, prices, target_date):
+        """Valor total y detalle de posiciones a partir de precios ya obtenidos"""
+        positions_detail = []
+        total_value = 0
+        symbols_not_found = []
+        
+        for position in positions:
+            symbol = position['symbol']
+            quantity = float(position['quantity'])
+            current_price = prices.get(symbol)
+            
+            if current_price is None:
+                current_price = 0
+                symbols_not_found.append(symbol)
+            
+            position_value = quantity * current_price
+            
+            positions_detail.append({
+                'symbol': symbol,
+                'quantity': quantity,
+                'current_price': current_price,
+                'position_value': position_value,
+                'notes': position.get('notes', ''),
+                'updated_at': position.get('updated_at', '')
+            })
+            
+            total_value += position_value
+        
+        # Calcular porcentajes de peso
+        for detail in positions_detail:
+            detail['weight_percentage'] = (detail['position_value'] / total_value * 100) if total_value > 0 else 0
+        
+        return {
+            'total_value': total_value,
+            'calculation_date': target_date,
+            'positions_detail': positions_detail,
+            'symbols_not_found': symbols_not_found
+        }
+    
     def _get_historical_prices(self, symbols, target_date):
-        """Obtiene precios históricos para una fecha específica"""
+        """Obtiene precios históricos para una fecha específica (último precio en o antes de la fecha)"""
         try:
-            prices = {}
-            
-            for symbol in symbols:
-                result = self.supabase.table('market_data_history').select('price').eq('symbol', symbol).eq('date', target_date).execute()
-                
-                if result.data:
-                    prices[symbol] = float(result.data[0]['price'])
-                else:
-                    # Buscar el precio más cercano anterior a la fecha objetivo
-                    result = self.supabase.table('market_data_history').select('price').eq('symbol', symbol).lte('date', target_date).order('date', desc=True).limit(1).execute()
-                    
-                    if result.data:
-                        prices[symbol] = float(result.data[0]['price'])
-                    else:
-                        prices[symbol] = None
-            
-            return prices
+            # Una sola consulta para todos los símbolos (réplica local, RPC o ventana de fechas)
+            return get_prices_as_of(symbols, target_date, self.supabase)
             
         except Exception as e:
             logger.error("Error obteniendo precios históricos: %s", str(e))
             return {}
     
-    def _get_latest_price_for_symbol(self, symbol):
-        """Obtiene el precio más reciente disponible para un símbolo"""
+    def _get_latest_prices_for_symbols(self, symbols):
+        """
+        Precio más reciente de varios símbolos: índice en memoria y, para los
+        que falten, una sola lectura de Google Sheets
+        
+        Los símbolos sin precio válido no se incluyen (quedan como no encontrados).
+        """
         try:
-            result = self.supabase.table('market_data_history').select('price').eq('symbol', symbol).order('date', desc=True).limit(1).execute()
+            prices = {}
+            for symbol in symbols:
+                price = latest_price_index.get_price(symbol)
+                if price is not None:
+                    prices[symbol] = price
             
-            if result.data:
-                return float(result.data[0]['price'])
-            else:
-                # Fallback: intentar obtener desde Google Sheets
-                current_prices = self._get_current_prices_from_sheets([symbol])
-                return current_prices.get(symbol, 0)
+            # Fallback: intentar obtener desde Google Sheets
+            missing = [symbol for symbol in symbols if symbol not in prices]
+            if missing:
+                prices.update(self._get_current_prices_from_sheets(missing))
+            
+            return prices
                 
         except Exception as e:
-            logger.error("Error obteniendo precio más reciente para %s: %s", symbol, str(e))
-            return 0
+            logger.error("Error obteniendo precios más recientes: %s", str(e))
+            return {}
     
     def _get_current_prices_from_sheets(self, symbols):
         """Obtiene precios actuales desde Google Sheets (fallback)"""
         try:
             from google_sheets_service import google_sheets_service
             
-            market_data = google_sheets_service.get_market_data()
-            
-            if not market_data:
-                return {}
+            snapshot = google_sheets_service.get_price_snapshot()
             
-            # Si market_data es un diccionario con 'data'
-            if isinstance(market_data, dict) and 'data' in market_data:
-                data_list = market_data['data']
-            elif isinstance(market_data, list):
-                data_list = market_data
-            else:
+            if not snapshot:
                 return {}
             
+            # Búsqueda O(1) por símbolo; los precios no numéricos (#N/A, Cargando...) se omiten
             current_prices = {}
-            for item in data_list:
-                symbol = item.get('symbol', '').upper()
-                price = item.get('price')
-                
-                if symbol in symbols and price not in ['#N/A', 'N/A', 'Cargando...', None]:
-                    try:
-                        # Limpiar el precio (quitar $ y comas)
-                        price_str = str(price).replace('$', '').replace(',', '').strip()
-                        current_prices[symbol] = float(price_str)
-                    except (ValueError, TypeError):
-                        current_prices[symbol] = 0
+            for symbol in symbols:
+                price = snapshot.get_price(symbol) if symbol in snapshot else None
+                if price is not None:
+                    current_prices[symbol] = price
             
             return current_prices
             
@@ -290,23 +398,151 @@ class PortfolioManager:
             logger.error("Error obteniendo precios desde Google Sheets: %s", str(e))
             return {}
     
+    @staticmethod
+    def _valuation_row(portfolio_id, portfolio_value):
+        """Fila de portfolio_valuations a partir del resultado de calculate_portfolio_value"""
+        return {
+            'portfolio_id': portfolio_id,
+            'date': date.today().isoformat(),
+            'total_value': portfolio_value['total_value'],
+            'positions_detail': portfolio_value['positions_detail'],
+            'symbols_not_found': portfolio_value['symbols_not_found'],
+            'calculation_date': portfolio_value['calculation_date'],
+            'computed_at': datetime.now().isoformat()
+        }
+    
+    def _upsert_valuations(self, rows):
+        """Upsert por bloques en portfolio_valuations; devuelve las filas guardadas"""
+        stored = 0
+        for start in range(0, len(rows), PORTFOLIO_VALUATION_CHUNK_SIZE):
+            chunk = rows[start:start + PORTFOLIO_VALUATION_CHUNK_SIZE]
+            self.supabase.table('portfolio_valuations').upsert(
+                chunk,
+                on_conflict='portfolio_id,date'
+            ).execute()
+            stored += len(chunk)
+        return stored
+    
+    def store_valuation(self, portfolio_id):
+        """Recalcula y guarda la valuación de una cartera (después de cambiar sus posiciones)"""
+        portfolio_value = self.calculate_portfolio_value(portfolio_id)
+        if portfolio_value is None:
+            return None
+        
+        try:
+            self._upsert_valuations([self._valuation_row(portfolio_id, portfolio_value)])
+        except Exception as e:
+            logger.error("Error guardando valuación de cartera %s: %s", portfolio_id, str(e))
+        return portfolio_value
+    
+    def revalue_all_portfolios(self):
+        """
+        Valúa todas las carteras con los últimos precios y guarda el resultado
+        
+        Returns:
+            Resumen con carteras valuadas, filas guardadas y errores
+        """
+        summary = {'portfolios': 0, 'stored': 0, 'errors': []}
+        
+        result = self.supabase.table('portfolios').select('id').execute()
+        portfolio_ids = [row['id'] for row in result.data or []]
+        summary['portfolios'] = len(portfolio_ids)
+        
+        for start in range(0, len(portfolio_ids), PORTFOLIO_VALUATION_CHUNK_SIZE):
+            chunk = portfolio_ids[start:start + PORTFOLIO_VALUATION_CHUNK_SIZE]
+            values = self.value_portfolios(chunk)
+            rows = [self._valuation_row(portfolio_id, values[portfolio_id])
+                    for portfolio_id in chunk if portfolio_id in values]
+            summary['errors'].extend({'portfolio_id': portfolio_id, 'error': 'Error calculando valor'}
+                                     for portfolio_id in chunk if portfolio_id not in values)
+            summary['stored'] += self._upsert_valuations(rows)
+        
+        logger.info("💼 Carteras revaluadas: %s/%s guardadas, %s errores",
+                    summary['stored'], summary['portfolios'], len(summary['errors']))
+        return summary
+    
+    def get_portfolio_values(self, portfolio_ids):
+        """
+        Valor actual de varias carteras desde sus últimas valuaciones guardadas
+        
+        Una consulta paginada por bloque de carteras; las que no tienen una valuación
+        reciente se valúan juntas con value_portfolios y se guardan.
+        
+        Returns:
+            {portfolio_id: valuación como calculate_portfolio_value (más computed_at)}
+        """
+        portfolio_ids = list(dict.fromkeys(portfolio_ids))
+        values = {}
+        since = (date.today() - timedelta(days=PORTFOLIO_VALUATION_MAX_AGE_DAYS)).isoformat()
+        
+        try:
+            for start in range(0, len(portfolio_ids), PORTFOLIO_IDS_PER_QUERY):
+                chunk = portfolio_ids[start:start + PORTFOLIO_IDS_PER_QUERY]
+                pending = set(chunk)
+                offset = 0
+                # Páginas con filas más recientes primero (tope de filas de PostgREST): gana la
+                # primera de cada cartera y se deja de leer cuando ya están todas
+                while pending:
+                    result = self.supabase.table('portfolio_valuations').select(
+                        'portfolio_id,total_value,positions_detail,symbols_not_found,calculation_date,computed_at'
+                    ).in_('portfolio_id', chunk).gte('date', since).order('date', desc=True).order('portfolio_id') \
+                        .range(offset, offset + POSITIONS_PAGE_SIZE - 1).execute()
+                    rows = result.data or []
+                    for row in rows:
+                        portfolio_id = row.pop('portfolio_id')
+                        if portfolio_id in pending:
+                            row['total_value'] = float(row['total_value'])
+                            values[portfolio_id] = row
+                            pending.discard(portfolio_id)
+                    if len(rows) < POSITIONS_PAGE_SIZE:
+                        break
+                    offset += POSITIONS_PAGE_SIZE
+        except Exception as e:
+            logger.error("Error leyendo valuaciones de carteras: %s", str(e))
+        
+        missing = [portfolio_id for portfolio_id in portfolio_ids if portfolio_id not in values]
+        if missing:
+            computed = self.value_portfolios(missing)
+            try:
+                self._upsert_valuations([self._valuation_row(portfolio_id, value)
+                                         for portfolio_id, value in computed.items()])
+            except Exception as e:
+                logger.error("Error guardando valuaciones de carteras: %s", str(e))
+            values.update(computed)
+        
+        return values
+    
+    def get_portfolio_value(self, portfolio_id):
+        """
+        Valor actual de la cartera desde la última valuación guardada
+        
+        Si la cartera no tiene una valuación reciente se calcula y se guarda.
+        
+        Returns:
+            Diccionario como calculate_portfolio_value (más computed_at), o None si hay error
+        """
+        return self.get_portfolio_values([portfolio_id]).get(portfolio_id)
+    
+    @staticmethod
+    def build_portfolio_stats(portfolio_value):
+        """Estadísticas resumidas a partir de una valuación"""
+        if not portfolio_value:
+            return None
+        
+        positions = portfolio_value['positions_detail']
+        
+        return {
+            'total_positions': len(positions),
+            'total_value': portfolio_value['total_value'],
+            'calculation_date': portfolio_value['calculation_date'],
+            'symbols_count': len([p for p in positions if p['current_price'] > 0]),
+            'symbols_not_found': len(portfolio_value['symbols_not_found'])
+        }
+    
     def get_portfolio_stats(self, portfolio_id):
         """Obtiene estadísticas resumidas de la cartera"""
         try:
-            portfolio_value = self.calculate_portfolio_value(portfolio_id)
-            
-            if not portfolio_value:
-                return None
-            
-            positions = portfolio_value['positions_detail']
-            
-            return {
-                'total_positions': len(positions),
-                'total_value': portfolio_value['total_value'],
-                'calculation_date': portfolio_value['calculation_date'],
-                'symbols_count': len([p for p in positions if p['current_price'] > 0]),
-                'symbols_not_found': len(portfolio_value['symbols_not_found'])
-            }
+            return self.build_portfolio_stats(self.get_portfolio_value(portfolio_id))
             
         except Exception as e:
             logger.error("Error obteniendo estadísticas de cartera %s: %s", portfolio_id, str(e))
@@ -0,0 +1,166 @@
+"""
+Snapshot compacto de precios de mercado en formato columnar
+"""
+import sys
+import math
+import hashlib
+from array import array
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+class PriceSnapshot:
+    """
+    Precios de mercado guardados en arrays paralelos
+    
+    - symbols: lista de símbolos internados (una sola copia por string)
+    - prices: array('d') con el precio numérico (NaN si no es numérico)
+    - _raw_prices: solo los valores no numéricos ('#N/A', 'Cargando...', ...)
+    - sources: nombre del sheet de origen de cada símbolo (opcional)
+    - _index: símbolo en mayúsculas -> posición, para búsquedas O(1)
+    """
+    
+    __slots__ = ('symbols', 'prices', '_raw_prices', '_index', 'sources', 'fetched_at')
+    
+    def __init__(self, symbols: List[str], prices: array, raw_prices: Optional[Dict[int, str]] = None,
+                 fetched_at: Optional[datetime] = None, sources: Optional[List[str]] = None):
+        self.symbols = symbols
+        self.prices = prices
+        self._raw_prices = raw_prices or {}
+        self.sources = sources
+        self.fetched_at = fetched_at or datetime.now()
+        # Si un símbolo aparece repetido gana la última fila (igual que antes)
+        self._index = {symbol.upper(): i for i, symbol in enumerate(symbols)}
+    
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[str, Union[float, str]]],
+                     fetched_at: Optional[datetime] = None, source: Optional[str] = None) -> 'PriceSnapshot':
+        """Construye el snapshot a partir de tuplas (symbol, price)"""
+        symbols = []
+        prices = array('d')
+        raw_prices = {}
+        
+        for symbol, price in records:
+            if isinstance(price, (int, float)) and math.isfinite(price):
+                prices.append(float(price))
+            else:
+                raw_prices[len(symbols)] = str(price)
+                prices.append(math.nan)
+            symbols.append(sys.intern(symbol))
+        
+        sources = [sys.intern(source)] * len(symbols) if source else None
+        return cls(symbols, prices, raw_prices, fetched_at, sources)
+    
+    @classmethod
+    def merge(cls, snapshots: List['PriceSnapshot']) -> 'PriceSnapshot':
+        """
+        Une varios snapshots en un único espacio de símbolos
+        
+        Los snapshots se reciben en orden de precedencia: si un símbolo aparece
+        en más de uno, gana el primero. Dentro de un mismo snapshot se respeta
+        su propio criterio (gana la última fila). fetched_at es el del snapshot
+        más antiguo.
+        """
+        symbols = []
+        prices = array('d')
+        raw_prices = {}
+        sources = []
+        seen = set()
+        
+        for snapshot in snapshots:
+            # Posición que ganó cada símbolo dentro de este snapshot
+            winners = set(snapshot._index.values())
+            for i, symbol in enumerate(snapshot.symbols):
+                key = symbol.upper()
+                if i not in winners or key in seen:
+                    continue
+                seen.add(key)
+                
+                if i in snapshot._raw_prices:
+                    raw_prices[len(symbols)] = snapshot._raw_prices[i]
+                symbols.append(symbol)
+                prices.append(snapshot.prices[i])
+                sources.append(snapshot.sources[i] if snapshot.sources else None)
+        
+        fetched_at = min((snapshot.fetched_at for snapshot in snapshots), default=None)
+        return cls(symbols, prices, raw_prices, fetched_at, sources if any(sources) else None)
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'PriceSnapshot':
+        """Reconstruye un snapshot a partir de la vista to_dict()"""
+        fetched_at = datetime.fromisoformat(data['fetched_at']) if data.get('fetched_at') else None
+        items = data.get('data', [])
+        snapshot = cls.from_records(((item['symbol'], item['price']) for item in items), fetched_at)
+        if any(item.get('source') for item in items):
+            snapshot.sources = [sys.intern(item['source']) if item.get('source') else None for item in items]
+        return snapshot
+    
+    def age_seconds(self) -> float:
+        """Segundos transcurridos desde que se obtuvieron (o validaron) los precios"""
+        return (datetime.now() - self.fetched_at).total_seconds()
+    
+    def __len__(self) -> int:
+        return len(self.symbols)
+    
+    def __contains__(self, symbol: str) -> bool:
+        return symbol.upper() in self._index
+    
+    def __iter__(self) -> Iterator[Tuple[str, Union[float, str]]]:
+        """Itera tuplas (symbol, price) con el mismo valor que devuelve la API"""
+        raw_prices = self._raw_prices
+        for i, symbol in enumerate(self.symbols):
+            yield symbol, raw_prices[i] if i in raw_prices else self.prices[i]
+    
+    def get_price(self, symbol: str) -> Optional[float]:
+        """Precio numérico de un símbolo, o None si no existe o no es numérico"""
+        i = self._index.get(symbol.upper())
+        if i is None:
+            return None
+        price = self.prices[i]
+        return None if math.isnan(price) else price
+    
+    def get_raw_price(self, symbol: str) -> Union[float, str, None]:
+        """Precio tal como vino del sheet (float o texto como '#N/A')"""
+        i = self._index.get(symbol.upper())
+        if i is None:
+            return None
+        return self._raw_prices.get(i, self.prices[i])
+    
+    def numeric_prices(self) -> List[float]:
+        """Lista de precios numéricos válidos"""
+        return [price for price in self.prices if not math.isnan(price)]
+    
+    def average_price(self) -> float:
+        """Precio promedio de los símbolos con precio numérico"""
+        prices = self.numeric_prices()
+        return sum(prices) / len(prices) if prices else 0
+    
+    def get_source(self, symbol: str) -> Optional[str]:
+        """Nombre del sheet del que proviene el precio de un símbolo"""
+        i = self._index.get(symbol.upper())
+        if i is None or not self.sources:
+            return None
+        return self.sources[i]
+    
+    def content_hash(self) -> str:
+        """Hash del contenido (símbolos, precios y orígenes) para detectar snapshots sin cambios"""
+        digest = hashlib.sha256()
+        sources = self.sources or ()
+        for i, (symbol, price) in enumerate(self):
+            source = sources[i] if sources else ''
+            digest.update(f"{symbol}\x1f{price!r}\x1f{source}\x1e".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def to_list(self) -> List[Dict]:
+        """Vista compatible con las respuestas JSON existentes: [{'symbol', 'price'}]"""
+        if not self.sources:
+            return [{'symbol': symbol, 'price': price} for symbol, price in self]
+        return [{'symbol': symbol, 'price': price, 'source': source}
+                for (symbol, price), source in zip(self, self.sources)]
+    
+    def to_dict(self) -> Dict:
+        """Vista completa para la API"""
+        return {
+            'data': self.to_list(),
+            'count': len(self),
+            'fetched_at': self.fetched_at.isoformat()
+        }
@@ -0,0 +1,177 @@
+"""
+Pipeline del snapshot de mercado por etapas
+
+    fetch     -> precios desde Google Sheets (descarta datos desactualizados)
+    normalize -> filas de market_data_history (y omite si el contenido no cambió)
+    persist   -> upsert masivo, intradiario y resumen diario
+    revalue   -> valuación de todas las carteras con los precios nuevos
+
+Cada etapa se mide por separado (summary['stages']) y una etapa que no tiene
+nada que pasar a la siguiente corta el pipeline.
+"""
+import time
+import logging
+from datetime import date, datetime
+from market_history_model import (build_history_record, upsert_history_records, save_intraday_snapshot,
+                                  save_daily_summary, LAST_SNAPSHOT_STATE_FILE, MARKET_INTRADAY_ENABLED)
+from google_sheets_service import google_sheets_service
+from supabase_client import get_supabase_client
+from file_utils import atomic_write_json, read_json
+from portfolio_model_improved import portfolio_manager
+
+logger = logging.getLogger(__name__)
+
+class SnapshotPipeline:
+    """
+    Una ejecución del snapshot: cada etapa devuelve True si el pipeline sigue
+    
+    progress, si se indica, se llama con stage, stage_index y stages_total al
+    empezar cada etapa (lo usa la cola de jobs para informar el avance).
+    """
+    
+    STAGES = ('fetch', 'normalize', 'persist', 'revalue')
+    
+    def __init__(self, chunk_size=None, force=False, revalue=True, progress=None):
+        self.chunk_size = chunk_size
+        self.force = force
+        self.progress = progress
+        self.stages = self.STAGES if revalue else self.STAGES[:-1]
+        self.snapshot = None
+        self.records = None
+        self.snapshot_date = None
+        self.summary = {
+            'success': False,
+            'rows_fetched': 0,
+            'rows_written': 0,
+            'chunks': 0,
+            'failed_chunks': 0,
+            'errors': [],
+            'stages': {},
+            'fetch_seconds': 0,
+            'write_seconds': 0,
+            'duration_seconds': 0
+        }
+    
+    def run(self):
+        """
+        Ejecuta las etapas en orden
+        
+        Returns:
+            Resumen con success, filas, errores, duración total y por etapa
+            (skipped=True si el contenido no cambió)
+        """
+        started = time.perf_counter()
+        summary = self.summary
+        logger.info("🔄 Iniciando snapshot (%s)", ' -> '.join(self.stages))
+        
+        try:
+            for index, stage in enumerate(self.stages, start=1):
+                if self.progress:
+                    self.progress(stage=stage, stage_index=index, stages_total=len(self.stages))
+                stage_started = time.perf_counter()
+                proceed = getattr(self, f'_{stage}')()
+                summary['stages'][stage] = round(time.perf_counter() - stage_started, 3)
+                if not proceed:
+                    break
+            return summary
+        
+        except Exception as e:
+            logger.error("❌ ERROR al guardar snapshot diario: %s", str(e))
+            summary['errors'].append({'error': str(e)})
+            return summary
+        finally:
+            summary['fetch_seconds'] = summary['stages'].get('fetch', 0)
+            summary['write_seconds'] = summary['stages'].get('persist', 0)
+            summary['duration_seconds'] = round(time.perf_counter() - started, 3)
+    
+    def _fetch(self):
+        """Precios actualizados desde Google Sheets"""
+        snapshot = google_sheets_service.get_price_snapshot(force_refresh=True)
+        
+        if not snapshot:
+            self.summary['errors'].append({'error': 'No hay datos de mercado para guardar'})
+            logger.error("❌ No hay datos de mercado para guardar")
+            return False
+        
+        # Si el sheet está caído se recibe el último snapshot conocido: no se guarda como dato de hoy
+        if google_sheets_service.describe_snapshot(snapshot)['stale']:
+            self.summary['errors'].append({'error': f'Datos de mercado desactualizados ({snapshot.fetched_at.isoformat()})'})
+            logger.error("❌ Datos de mercado desactualizados, snapshot omitido")
+            return False
+        
+        self.snapshot = snapshot
+        self.summary['rows_fetched'] = len(snapshot)
+        return True
+    
+    def _normalize(self):
+        """Arma un registro por símbolo (si se repite, gana la última fila)"""
+        self.snapshot_date = date.today().isoformat()
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        # Mismo contenido que la última escritura de hoy: el upsert no cambiaría nada
+        content_hash = self.snapshot.content_hash()
+        self.summary['content_hash'] = content_hash
+        if not self.force and read_json(LAST_SNAPSHOT_STATE_FILE) == {'date': self.snapshot_date, 'hash': content_hash}:
+            self.summary['success'] = True
+            self.summary['skipped'] = True
+            logger.info("⏭️ Snapshot sin cambios desde la última escritura, se omite el guardado")
+            return False
+        
+        records = {}
+        for symbol, price in self.snapshot:
+            record = build_history_record(symbol, price, self.snapshot_date, timestamp)
+            records[record['symbol']] = record
+        self.records = list(records.values())
+        return True
+    
+    def _persist(self):
+        """Upsert masivo en market_data_history, snapshot intradiario y resumen diario"""
+        summary = self.summary
+        logger.info("💾 Guardando snapshot de %s símbolos...", len(self.records))
+        
+        supabase = get_supabase_client()
+        
+        result = upsert_history_records(supabase, self.records, self.chunk_size)
+        all_rows_written = not result['errors']
+        summary.update(result)
+        summary['success'] = result['rows_written'] > 0
+        
+        if MARKET_INTRADAY_ENABLED:
+            try:
+                summary['intraday'] = save_intraday_snapshot(supabase, self.records, self.snapshot_date,
+                                                             datetime.now().isoformat())
+            except Exception as e:
+                logger.error("❌ Error guardando snapshot intradiario: %s", str(e))
+                summary['errors'].append({'error': f'intraday: {str(e)}'})
+        
+        if summary['success']:
+            try:
+                summary['daily_summary'] = save_daily_summary(supabase, self.records, self.snapshot_date)
+            except Exception as e:
+                logger.error("❌ Error guardando resumen diario: %s", str(e))
+                summary['errors'].append({'error': f'daily_summary: {str(e)}'})
+        
+        # Solo se recuerda el hash si se escribieron todas las filas (si no, se reintenta)
+        if summary['success'] and all_rows_written:
+            try:
+                atomic_write_json(LAST_SNAPSHOT_STATE_FILE,
+                                  {'date': self.snapshot_date, 'hash': summary['content_hash']})
+            except OSError as e:
+                logger.warning("No se pudo guardar el hash del snapshot: %s", str(e))
+        
+        logger.info("🎉 Snapshot completado: %s/%s registros en %s bloques, %s errores",
+                    result['rows_written'], len(self.records), result['chunks'], len(summary['errors']))
+        return summary['success']
+    
+    def _revalue(self):
+        """Valúa todas las carteras con los precios recién guardados y guarda el resultado"""
+        try:
+            self.summary['revaluation'] = portfolio_manager.revalue_all_portfolios()
+        except Exception as e:
+            logger.error("❌ Error revaluando carteras: %s", str(e))
+            self.summary['errors'].append({'error': f'revalue: {str(e)}'})
+        return True
+
+def run_snapshot_pipeline(chunk_size=None, force=False, revalue=True, progress=None):
+    """Función de conveniencia: snapshot completo con revaluación de carteras"""
+    return SnapshotPipeline(chunk_size, force, revalue, progress).run()
@@ -0,0 +1,46 @@
+"""
+Registro de clientes de Supabase compartidos por todo el proceso
+"""
+import threading
+import logging
+from typing import Dict, Tuple
+from supabase import create_client, Client
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Un cliente por (scope, url, key). Cada cliente mantiene su propia sesión HTTP
+# con conexiones keep-alive, que se reutiliza en todas las consultas posteriores
+_clients: Dict[Tuple[str, str, str], Client] = {}
+_clients_lock = threading.Lock()
+
+def get_supabase_client(scope: str = 'data') -> Client:
+    """
+    Obtiene el cliente de Supabase compartido del proceso
+    
+    Args:
+        scope: 'data' para el cliente anónimo de lectura/escritura de datos
+               (market history, carteras); 'auth' para el cliente de Database,
+               que guarda la sesión del usuario y no debe mezclarse con el resto
+    
+    Returns:
+        Cliente de Supabase (se crea una sola vez por scope)
+    """
+    url = Config.SUPABASE_URL
+    key = Config.SUPABASE_KEY
+    
+    if not url or not key:
+        raise ValueError("SUPABASE_URL y SUPABASE_ANON_KEY deben estar configurados")
+    
+    registry_key = (scope, url, key)
+    client = _clients.get(registry_key)
+    if client is not None:
+        return client
+    
+    with _clients_lock:
+        client = _clients.get(registry_key)
+        if client is None:
+            client = create_client(url, key)
+            _clients[registry_key] = client
+            logger.info("Cliente de Supabase '%s' creado", scope)
+        return client
@@ -0,0 +1,29 @@
+from intraday_series import IntradayEncoder, decode_rows
+
+
+def test_interleaved_writers_decode_against_their_own_base():
+    scheduled, manual = IntradayEncoder(), IntradayEncoder()
+    rows = []
+    
+    def write(encoder, snapshot_at, prices):
+        last = rows[-1]['snapshot_at'] if rows else None
+        rows.append({'snapshot_at': snapshot_at, 'payload': encoder.encode('2024-01-02', prices, snapshot_at, last)})
+    
+    write(scheduled, '2024-01-02T11:00:00', {'AL30': 100.0})
+    write(manual, '2024-01-02T11:05:00', {'AL30': 101.0})
+    write(scheduled, '2024-01-02T11:30:00', {'AL30': 102.0})
+    write(scheduled, '2024-01-02T12:00:00', {'AL30': 103.0})
+    
+    assert [bool(row['payload']['k']) for row in rows] == [True, True, True, False]
+    assert [prices['AL30'] for _, prices in decode_rows(rows)] == [100.0, 101.0, 102.0, 103.0]
+
+
+def test_delta_is_applied_to_its_base_row():
+    rows = [
+        {'snapshot_at': '2024-01-02T11:00:00+00:00', 'payload': {'k': 1, 'sym': ['AL30'], 'px': [100000000]}},
+        {'snapshot_at': '2024-01-02T11:05:00+00:00', 'payload': {'k': 1, 'sym': ['AL30'], 'px': [200000000]}},
+        {'snapshot_at': '2024-01-02T11:30:00+00:00',
+         'payload': {'k': 0, 'base': '2024-01-02T11:00:00', 'd': {'AL30': 1000000}}},
+    ]
+    
+    assert [prices['AL30'] for _, prices in decode_rows(rows)] == [100.0, 200.0, 101.0]
@@ -0,0 +1,23 @@
+from price_snapshot import PriceSnapshot
+
+
+def test_repeated_symbol_in_one_sheet_keeps_last_row():
+    snapshot = PriceSnapshot.from_records([('AL30', 1234.5), ('GD30', 50.0), ('al30', 7.0)], source='bonos')
+    
+    assert snapshot.get_price('AL30') == 7.0
+    
+    merged = PriceSnapshot.merge([snapshot])
+    assert merged.get_price('AL30') == 7.0
+    assert len(merged) == 2
+
+
+def test_merge_first_sheet_wins_across_sheets():
+    first = PriceSnapshot.from_records([('AL30', 1234.5), ('AL30', 7.0)], source='bonos')
+    second = PriceSnapshot.from_records([('AL30', 99.0), ('GGAL', '#N/A')], source='acciones')
+    
+    merged = PriceSnapshot.merge([first, second])
+    
+    assert merged.get_price('AL30') == 7.0
+    assert merged.get_source('AL30') == 'bonos'
+    assert merged.get_price('GGAL') is None
+    assert merged.get_raw_price('GGAL') == '#N/A'
@@ -0,0 +1,116 @@
+"""
+Calendario de mercado para programar los snapshots
+
+Define los días hábiles (días de la semana y feriados), el horario de la rueda
+y la zona horaria del mercado. A partir de eso calcula los horarios de
+snapshot: cada MARKET_SNAPSHOT_INTERVAL_MINUTES durante la rueda y uno de
+cierre unos minutos después. Los días sin rueda no tienen snapshots.
+
+Los feriados se configuran con MARKET_HOLIDAYS (fechas separadas por coma) y/o
+MARKET_HOLIDAYS_FILE (una fecha YYYY-MM-DD por línea, se ignoran las líneas
+que empiezan con #).
+"""
+import os
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List, Optional, Set
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+MARKET_TIMEZONE = os.environ.get('MARKET_TIMEZONE', 'America/Argentina/Buenos_Aires')
+MARKET_OPEN_TIME = os.environ.get('MARKET_OPEN_TIME', '11:00')
+MARKET_CLOSE_TIME = os.environ.get('MARKET_CLOSE_TIME', '17:00')
+MARKET_SNAPSHOT_INTERVAL_MINUTES = int(os.environ.get('MARKET_SNAPSHOT_INTERVAL_MINUTES', '30'))
+MARKET_CLOSE_SNAPSHOT_DELAY_MINUTES = int(os.environ.get('MARKET_CLOSE_SNAPSHOT_DELAY_MINUTES', '15'))
+# Días con rueda (0 = lunes ... 6 = domingo)
+MARKET_TRADING_WEEKDAYS = os.environ.get('MARKET_TRADING_WEEKDAYS', '0,1,2,3,4')
+MARKET_HOLIDAYS = os.environ.get('MARKET_HOLIDAYS', '')
+MARKET_HOLIDAYS_FILE = os.environ.get('MARKET_HOLIDAYS_FILE', '')
+
+# Días hacia adelante en los que se busca la próxima rueda
+MAX_LOOKAHEAD_DAYS = 366
+
+def parse_time(value: str) -> time:
+    """'HH:MM' -> time"""
+    hours, minutes = value.strip().split(':')
+    return time(int(hours), int(minutes))
+
+def parse_holidays(spec: str = '', path: str = '') -> Set[date]:
+    """Feriados desde una lista separada por comas y/o un archivo"""
+    values = [value for value in spec.split(',') if value.strip()]
+    if path:
+        try:
+            with open(path, 'r', encoding='utf-8') as holidays_file:
+                values.extend(line for line in holidays_file if line.strip() and not line.startswith('#'))
+        except OSError as e:
+            logger.error("No se pudo leer el archivo de feriados %s: %s", path, str(e))
+    
+    holidays = set()
+    for value in values:
+        try:
+            holidays.add(date.fromisoformat(value.strip()))
+        except ValueError:
+            logger.warning("Feriado inválido ignorado: %s", value.strip())
+    return holidays
+
+class TradingCalendar:
+    """Días y horarios de rueda en la zona horaria del mercado"""
+    
+    def __init__(self, timezone: str = MARKET_TIMEZONE, open_time: str = MARKET_OPEN_TIME,
+                 close_time: str = MARKET_CLOSE_TIME, interval_minutes: int = MARKET_SNAPSHOT_INTERVAL_MINUTES,
+                 close_delay_minutes: int = MARKET_CLOSE_SNAPSHOT_DELAY_MINUTES,
+                 weekdays: Iterable[int] = None, holidays: Optional[Set[date]] = None):
+        self.tz = ZoneInfo(timezone)
+        self.open_time = parse_time(open_time)
+        self.close_time = parse_time(close_time)
+        self.interval = timedelta(minutes=max(1, interval_minutes))
+        self.close_delay = timedelta(minutes=close_delay_minutes)
+        self.weekdays = set(weekdays) if weekdays is not None else \
+            {int(day) for day in MARKET_TRADING_WEEKDAYS.split(',') if day.strip()}
+        self.holidays = holidays if holidays is not None else parse_holidays(MARKET_HOLIDAYS, MARKET_HOLIDAYS_FILE)
+    
+    def now(self) -> datetime:
+        return datetime.now(self.tz)
+    
+    def is_trading_day(self, day: date) -> bool:
+        return day.weekday() in self.weekdays and day not in self.holidays
+    
+    def is_open(self, moment: Optional[datetime] = None) -> bool:
+        """True si el mercado está en horario de rueda"""
+        moment = (moment or self.now()).astimezone(self.tz)
+        return self.is_trading_day(moment.date()) and self.open_time <= moment.time() < self.close_time
+    
+    def snapshot_times(self, day: date) -> List[datetime]:
+        """Horarios de snapshot de un día: cada intervalo durante la rueda y uno de cierre"""
+        if not self.is_trading_day(day):
+            return []
+        current = datetime.combine(day, self.open_time, tzinfo=self.tz)
+        close = datetime.combine(day, self.close_time, tzinfo=self.tz)
+        times = []
+        while current < close:
+            times.append(current)
+            current += self.interval
+        times.append(close + self.close_delay)
+        return times
+    
+    def next_snapshot_time(self, after: Optional[datetime] = None) -> Optional[datetime]:
+        """Próximo horario de snapshot estrictamente posterior a after (None si no hay ruedas)"""
+        after = (after or self.now()).astimezone(self.tz)
+        day = after.date()
+        for offset in range(MAX_LOOKAHEAD_DAYS):
+            for moment in self.snapshot_times(day + timedelta(days=offset)):
+                if moment > after:
+                    return moment
+        return None
+    
+    def describe(self) -> dict:
+        """Configuración y estado actual para el status del scheduler"""
+        next_snapshot = self.next_snapshot_time()
+        return {
+            'timezone': str(self.tz),
+            'market_open': self.is_open(),
+            'hours': f"{self.open_time.strftime('%H:%M')}-{self.close_time.strftime('%H:%M')}",
+            'interval_minutes': int(self.interval.total_seconds() // 60),
+            'next_snapshot': next_snapshot.isoformat() if next_snapshot else None
+        }